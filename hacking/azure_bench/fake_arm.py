@@ -0,0 +1,135 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local HTTPS stand-in for Azure Resource Manager, serving the image reads of
+the compute API next to the token endpoint of fake_token, so that modules can
+be run end to end, over real connections, through the SDK clients
+AzureRMModuleBase builds.
+
+Its url works as cloud_environment, through the metadata endpoint Azure Stack
+serves, as long as its certificate is trusted, with REQUESTS_CA_BUNDLE set to
+``certificate_path``.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import math
+import re
+import threading
+import time
+
+from fake_token import FakeTokenEndpoint, bench_cloud
+
+IMAGE_PATH = re.compile(r'^/subscriptions/([^/]+)/resourceGroups/([^/]+)/providers/Microsoft\.Compute/images/([^/?]+)')
+IMAGES_PATH = re.compile(r'^/subscriptions/([^/]+)(?:/resourceGroups/([^/]+))?/providers/Microsoft\.Compute/images'
+                         r'(?:\?|$)')
+
+
+class FakeResourceManager(FakeTokenEndpoint):
+    """
+    Token endpoint and resource manager in one, holding ``images`` images
+    spread over ten resource groups, named as in FakeAzure. Every request
+    served takes ``arm_latency`` seconds, and ``arm_requests`` counts them.
+
+    With ``quota``, image requests are limited to that many per second, with
+    bursts of up to ``quota_burst``, the way Azure Resource Manager limits the
+    requests of a subscription: the requests remaining are reported in the
+    x-ms-ratelimit-remaining-subscription-reads header, and requests over the
+    limit are refused with a 429 and a Retry-After, counted in ``throttled``.
+    """
+
+    def __init__(self, images=10, arm_latency=0.0, quota=None, quota_burst=None, **kwargs):
+        super(FakeResourceManager, self).__init__(**kwargs)
+        self.images = images
+        self.arm_latency = arm_latency
+        self.arm_requests = 0
+        self.quota = quota
+        self.quota_burst = quota_burst or quota
+        self.throttled = 0
+        self._quota_tokens = float(self.quota_burst or 0)
+        self._quota_updated = time.time()
+        self._arm_lock = threading.Lock()
+        self.cloud = bench_cloud(self.url, resource_manager=self.url)
+
+    def _take_quota(self):
+        """
+        Headers of a request within the quota, or None when it is over it and
+        the Retry-After to refuse it with.
+        """
+        if self.quota is None:
+            return dict(), None
+        with self._arm_lock:
+            now = time.time()
+            self._quota_tokens = min(float(self.quota_burst),
+                                     self._quota_tokens + (now - self._quota_updated) * self.quota)
+            self._quota_updated = now
+            if self._quota_tokens < 1:
+                self.throttled += 1
+                return None, int(math.ceil((1 - self._quota_tokens) / self.quota))
+            self._quota_tokens -= 1
+            return {'x-ms-ratelimit-remaining-subscription-reads': str(int(self._quota_tokens))}, None
+
+    def image(self, subscription_id, index):
+        group = 'rg{}'.format(index % 10)
+        name = 'image{}'.format(index)
+        image_id = '/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/images/{}'.format(
+            subscription_id, group, name)
+        return dict(id=image_id,
+                    name=name,
+                    type='Microsoft.Compute/images',
+                    location='westeurope',
+                    tags=dict(),
+                    properties=dict(provisioningState='Succeeded',
+                                    storageProfile=dict(osDisk=dict(osType='Linux',
+                                                                    osState='Generalized',
+                                                                    managedDisk=dict(id=image_id + '-osdisk')),
+                                                        dataDisks=[])))
+
+    def handle_get(self, path, headers):
+        with self._arm_lock:
+            self.arm_requests += 1
+        time.sleep(self.arm_latency)
+
+        if path.startswith('/metadata/endpoints'):
+            return 200, dict(galleryEndpoint=self.url,
+                             graphEndpoint=self.url,
+                             authentication=dict(loginEndpoint=self.url + '/adfs',
+                                                 audiences=[self.cloud.endpoints.active_directory_resource_id]))
+
+        image_match = IMAGE_PATH.match(path)
+        images_match = IMAGES_PATH.match(path)
+        if image_match or images_match:
+            quota_headers, retry_after = self._take_quota()
+            if quota_headers is None:
+                return 429, dict(error=dict(code='TooManyRequests',
+                                            message="The request is being throttled.")), {'Retry-After': str(retry_after)}
+
+        if image_match:
+            subscription_id, group, name = image_match.groups()
+            index = int(name[len('image'):]) if re.match(r'^image\d+$', name) else -1
+            if 0 <= index < self.images and group == 'rg{}'.format(index % 10):
+                return 200, self.image(subscription_id, index), dict(quota_headers, ETag='"{}"'.format(index))
+            return 404, dict(error=dict(code='ResourceNotFound', message="Image {} not found".format(name))), \
+                quota_headers
+
+        if images_match:
+            subscription_id, group = images_match.groups()
+            return 200, dict(value=[self.image(subscription_id, index) for index in range(self.images)
+                                    if group is None or group == 'rg{}'.format(index % 10)]), quota_headers
+
+        return super(FakeResourceManager, self).handle_get(path, headers)
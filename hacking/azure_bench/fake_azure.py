@@ -0,0 +1,518 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+In-memory stand-ins for the compute and resource management clients used by
+the azure_rm_image, azure_rm_image_facts and azure_rm_snapshot modules.
+
+Every call sleeps for a configurable latency and is counted, listings are
+returned in pages, and long-running operations complete after their own
+latency, so the modules can be measured without network access.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import datetime
+import random
+import threading
+import time
+from collections import Counter
+
+from msrestazure.azure_exceptions import CloudError
+
+SUBSCRIPTION_ID = '00000000-0000-0000-0000-000000000000'
+GIB = 1024 * 1024 * 1024
+PAGE = 512
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _Response(object):
+    headers = {}
+
+    def __init__(self, status_code, message, reason='Not Found'):
+        self.status_code = status_code
+        self.text = message
+        self.reason = reason
+
+    def json(self):
+        return None
+
+    def raise_for_status(self):
+        pass
+
+
+def not_found(message):
+    error = CloudError(_Response(404, message))
+    error.message = message
+    return error
+
+
+def not_modified():
+    error = CloudError(_Response(304, '', reason='Not Modified'))
+    error.message = 'Not Modified'
+    return error
+
+
+def etag(resource):
+    return 'W/"{:x}"'.format(hash((resource.id, resource.location, repr(resource.tags),
+                                   resource.provisioning_state)) & 0xffffffff)
+
+
+class FakePoller(object):
+    def __init__(self, result, latency):
+        self._result = result
+        self._done_at = time.time() + latency
+
+    def done(self):
+        return time.time() >= self._done_at
+
+    def wait(self, timeout=None):
+        remaining = self._done_at - time.time()
+        if timeout is not None:
+            remaining = min(remaining, timeout)
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def result(self, timeout=None):
+        self.wait(timeout)
+        return self._result
+
+
+class FakePaged(object):
+    """
+    Listing that, like msrest's Paged, fetches the next page through
+    advance_page only once the current one has been iterated over.
+    """
+
+    def __init__(self, azure, name, items):
+        self.azure = azure
+        self.name = name
+        self.items = items
+        self.next_index = 0
+        self.current_page = []
+        self.current_index = 0
+
+    def advance_page(self):
+        if self.next_index is None:
+            raise StopIteration("End of paging")
+        if self.next_index:
+            self.azure.record(self.name + '.next_page')
+        with self.azure._lock:
+            self.azure.pages += 1
+        self.current_page = self.items[self.next_index:self.next_index + self.azure.page_size]
+        self.current_index = 0
+        self.next_index += self.azure.page_size
+        if self.next_index >= len(self.items):
+            self.next_index = None
+        return self.current_page
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.current_index < len(self.current_page):
+            self.current_index += 1
+            return self.current_page[self.current_index - 1]
+        self.advance_page()
+        return self.__next__()
+
+    next = __next__
+
+
+class FakeAzure(object):
+    """
+    Shared state and call accounting for the fake clients.
+
+    ``latency`` is slept for every call and every page of a listing,
+    ``operation_latency`` is the time a long-running operation takes.
+    ``snapshot_history`` is the number of daily snapshots every disk of the
+    VMs already has, tagged the way azure_rm_snapshot tags them.
+    ``populated_mb`` is the amount of data on every disk, spread over 1 MiB
+    extents; the rest of the disk is unallocated. Disk and snapshot contents
+    are served by a FakeBlobService attached as ``blob_service``.
+    """
+
+    def __init__(self, images=100, resource_groups=10, disks=4, page_size=100,
+                 latency=0.0, operation_latency=0.0, snapshot_history=0, populated_mb=8):
+        self.page_size = page_size
+        self.latency = latency
+        self.operation_latency = operation_latency
+        self.populated_mb = populated_mb
+        self.blob_service = None
+        self.contents = dict()
+        self.sources = dict()
+        self.calls = Counter()
+        self.pages = 0
+        self._lock = threading.Lock()
+        self.resource_groups = ['rg{}'.format(i) for i in range(resource_groups)]
+        self.images = dict()
+        self.images_ready_at = dict()
+        self.snapshots = dict()
+        self.disks = dict()
+        self.vms = dict()
+        # Images are tagged with a creation time the way azure_rm_image tags
+        # them, one hour apart and the last one created an hour ago.
+        now = time.time()
+        for i in range(images):
+            created = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now - (images - i) * 3600))
+            self.add_image(self.resource_groups[i % resource_groups], 'image{}'.format(i),
+                           tags={'ansible-created': created})
+        for group in self.resource_groups:
+            vm = self.add_vm(group, 'vm0', disks)
+            for day in range(snapshot_history):
+                for disk in [vm.storage_profile.os_disk] + vm.storage_profile.data_disks:
+                    self.add_snapshot(group, 'history{}-{}'.format(day, disk.name), disk.managed_disk.id,
+                                      datetime.datetime.utcnow() - datetime.timedelta(days=day + 1),
+                                      tags={'ansible-source-vm': vm.name,
+                                            'ansible-source-disk': disk.managed_disk.id.lower()})
+
+    def record(self, name):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def paged(self, name, items):
+        self.record(name)
+        return FakePaged(self, name, items)
+
+    def resource_id(self, group, provider, name):
+        return "/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/{}/{}".format(
+            SUBSCRIPTION_ID, group, provider, name)
+
+    def content(self, resource_id):
+        """
+        Sparse page map, offset to 512 bytes, of a disk or snapshot. Disks that
+        were not written to get ``populated_mb`` of data derived from their id,
+        plus the footer page that ends every exported VHD. Snapshots share the
+        map of their source, as only uploaded disks are ever written to.
+        """
+        key = resource_id.lower()
+        while key in self.sources:
+            key = self.sources[key]
+        with self._lock:
+            pages = self.contents.get(key)
+            if pages is None:
+                pages = self.contents[key] = dict()
+                rng = random.Random(key)
+                extent = 1024 * 1024
+                extents = 1024 * GIB // extent
+                for index in rng.sample(range(extents), min(self.populated_mb, extents)):
+                    data = rng.getrandbits(extent * 8).to_bytes(extent, 'little')
+                    for offset in range(0, extent, PAGE):
+                        pages[index * extent + offset] = data[offset:offset + PAGE]
+                pages[1024 * GIB] = b'conectix'.ljust(PAGE, b'\0')
+        return pages
+
+    def add_image(self, group, name, source_vm=None, location='westeurope', tags=None, storage_profile=None):
+        if storage_profile is None:
+            storage_profile = Obj(os_disk=Obj(os_type='Linux',
+                                              os_state='Generalized',
+                                              managed_disk=Obj(id=self.resource_id(group, 'disks', name + '-osdisk')),
+                                              snapshot=None,
+                                              blob_uri=None,
+                                              caching='ReadWrite',
+                                              storage_account_type='Premium_LRS',
+                                              disk_size_gb=1024),
+                                  data_disks=[],
+                                  zone_resilient=None)
+        image = Obj(name=name,
+                    id=self.resource_id(group, 'images', name),
+                    location=location,
+                    tags=tags,
+                    provisioning_state='Succeeded',
+                    hyper_vgeneration='V1',
+                    source_virtual_machine=source_vm,
+                    storage_profile=storage_profile)
+        self.images[(group.lower(), name)] = image
+        return image
+
+    def pending_image(self, group, name, seconds):
+        """
+        Have an image report provisioning state Creating for ``seconds`` more
+        seconds, after which it reports Succeeded.
+        """
+        key = (group.lower(), name)
+        self.images[key].provisioning_state = 'Creating'
+        self.images_ready_at[key] = time.time() + seconds
+
+    def add_vm(self, group, name, disks):
+        def disk(disk_name, lun=None):
+            return Obj(name=disk_name,
+                       lun=lun,
+                       managed_disk=Obj(id=self.resource_id(group, 'disks', disk_name),
+                                        storage_account_type='Premium_LRS'),
+                       vhd=None,
+                       caching='ReadWrite',
+                       disk_size_gb=1024,
+                       os_type='Linux')
+        vm = Obj(name=name,
+                 id=self.resource_id(group, 'virtualMachines', name),
+                 location='westeurope',
+                 tags=None,
+                 provisioning_state='Succeeded',
+                 hardware_profile=Obj(vm_size='Standard_D4s_v3'),
+                 storage_profile=Obj(os_disk=disk(name + '-os'),
+                                     data_disks=[disk('{}-data{}'.format(name, lun), lun) for lun in range(disks)]))
+        self.vms[(group.lower(), name)] = vm
+        return vm
+
+    def add_snapshot(self, group, name, source_id, time_created, location='westeurope', incremental=None,
+                     tags=None):
+        snapshot = Obj(name=name,
+                       id=self.resource_id(group, 'snapshots', name),
+                       location=location,
+                       creation_data=Obj(create_option='Copy', source_resource_id=source_id),
+                       incremental=incremental,
+                       disk_size_gb=1024,
+                       time_created=time_created,
+                       provisioning_state='Succeeded',
+                       tags=tags)
+        self.snapshots[(group.lower(), name)] = snapshot
+        with self._lock:
+            self.sources[snapshot.id.lower()] = source_id.lower()
+        return snapshot
+
+    def add_disk(self, group, name, size_bytes, location='westeurope', tags=None):
+        disk = Obj(name=name,
+                   id=self.resource_id(group, 'disks', name),
+                   location=location,
+                   creation_data=Obj(create_option='Upload', upload_size_bytes=size_bytes),
+                   disk_size_gb=(size_bytes - PAGE) // GIB,
+                   disk_state='ReadyToUpload',
+                   provisioning_state='Succeeded',
+                   tags=tags)
+        self.disks[(group.lower(), name)] = disk
+        with self._lock:
+            self.contents[disk.id.lower()] = dict()
+        return disk
+
+    def grant(self, resource, access):
+        if self.blob_service is None:
+            raise RuntimeError("No FakeBlobService is attached")
+        size = getattr(resource.creation_data, 'upload_size_bytes', None) or resource.disk_size_gb * GIB + PAGE
+        return Obj(access_sas=self.blob_service.grant(resource.id, size))
+
+    def compute_client(self):
+        return Obj(images=FakeImagesOperations(self),
+                   virtual_machines=FakeVirtualMachinesOperations(self),
+                   snapshots=FakeSnapshotsOperations(self),
+                   disks=FakeDisksOperations(self))
+
+    def resource_client(self):
+        return Obj(resource_groups=FakeResourceGroupsOperations(self))
+
+
+class FakeResourceGroupsOperations(object):
+    def __init__(self, azure):
+        self.azure = azure
+
+    def get(self, resource_group_name):
+        self.azure.record('resource_groups.get')
+        return Obj(name=resource_group_name, location='westeurope')
+
+
+class FakeImagesOperations(object):
+    def __init__(self, azure):
+        self.azure = azure
+
+    def list(self):
+        return self.azure.paged('images.list', list(self.azure.images.values()))
+
+    def list_by_resource_group(self, resource_group_name):
+        return self.azure.paged('images.list_by_resource_group',
+                                [image for (group, name), image in self.azure.images.items()
+                                 if group == resource_group_name.lower()])
+
+    def get(self, resource_group_name, image_name, custom_headers=None, raw=False, **kwargs):
+        self.azure.record('images.get')
+        key = (resource_group_name.lower(), image_name)
+        try:
+            image = self.azure.images[key]
+        except KeyError:
+            raise not_found("Image {} not found".format(image_name))
+        if time.time() >= self.azure.images_ready_at.get(key, 0):
+            self.azure.images_ready_at.pop(key, None)
+            image.provisioning_state = 'Succeeded'
+        # Every get returns a new object, as the SDK deserializes every answer.
+        image = Obj(**vars(image))
+        if (custom_headers or {}).get('If-None-Match') == etag(image):
+            self.azure.record('images.get.not_modified')
+            raise not_modified()
+        if raw:
+            return Obj(output=image, response=Obj(headers={'ETag': etag(image)}))
+        return image
+
+    def create_or_update(self, resource_group_name, image_name, parameters, **kwargs):
+        self.azure.record('images.create_or_update')
+        source = parameters.source_virtual_machine
+        storage_profile = getattr(parameters, 'storage_profile', None)
+        if source is not None:
+            group, name = source.id.split('/')[4], source.id.split('/')[-1]
+            vm = self.azure.vms.get((group.lower(), name))
+            if vm is not None:
+                def image_disk(disk):
+                    return Obj(lun=disk.lun,
+                               os_type='Linux',
+                               os_state='Generalized',
+                               managed_disk=Obj(id=disk.managed_disk.id),
+                               snapshot=None,
+                               blob_uri=None,
+                               caching=disk.caching,
+                               storage_account_type=disk.managed_disk.storage_account_type,
+                               disk_size_gb=disk.disk_size_gb)
+                storage_profile = Obj(os_disk=image_disk(vm.storage_profile.os_disk),
+                                      data_disks=[image_disk(disk) for disk in vm.storage_profile.data_disks],
+                                      zone_resilient=None)
+        image = self.azure.add_image(resource_group_name, image_name,
+                                     source_vm=source.id if source else None,
+                                     location=parameters.location,
+                                     tags=parameters.tags,
+                                     storage_profile=storage_profile)
+        return FakePoller(image, self.azure.operation_latency)
+
+    def delete(self, resource_group_name, image_name=None, **kwargs):
+        self.azure.record('images.delete')
+        self.azure.images.pop((resource_group_name.lower(), image_name or kwargs.get('name')), None)
+        return FakePoller(Obj(status='Succeeded'), self.azure.operation_latency)
+
+
+class FakeVirtualMachinesOperations(object):
+    def __init__(self, azure):
+        self.azure = azure
+
+    def get(self, resource_group_name, vm_name, **kwargs):
+        self.azure.record('virtual_machines.get')
+        try:
+            return self.azure.vms[(resource_group_name.lower(), vm_name)]
+        except KeyError:
+            raise not_found("VM {} not found".format(vm_name))
+
+    def instance_view(self, resource_group_name, vm_name, **kwargs):
+        self.azure.record('virtual_machines.instance_view')
+        return Obj(statuses=[Obj(code='ProvisioningState/succeeded'), Obj(code='PowerState/running')])
+
+    def deallocate(self, resource_group_name, vm_name, **kwargs):
+        self.azure.record('virtual_machines.deallocate')
+        return FakePoller(None, self.azure.operation_latency)
+
+    def power_off(self, resource_group_name, vm_name, **kwargs):
+        self.azure.record('virtual_machines.power_off')
+        return FakePoller(None, self.azure.operation_latency)
+
+    def start(self, resource_group_name, vm_name, **kwargs):
+        self.azure.record('virtual_machines.start')
+        return FakePoller(None, self.azure.operation_latency)
+
+    def generalize(self, resource_group_name, vm_name, **kwargs):
+        self.azure.record('virtual_machines.generalize')
+
+
+class FakeSnapshotsOperations(object):
+    def __init__(self, azure):
+        self.azure = azure
+
+    def create_or_update(self, resource_group_name, snapshot_name, snapshot, **kwargs):
+        self.azure.record('snapshots.create_or_update')
+        # Like Azure, a snapshot that exists from the same source is updated
+        # rather than taken again.
+        existing = self.azure.snapshots.get((resource_group_name.lower(), snapshot_name))
+        time_created = datetime.datetime.utcnow()
+        if existing is not None and (existing.creation_data.source_resource_id.lower() ==
+                                     snapshot.creation_data.source_resource_id.lower()):
+            time_created = existing.time_created
+        result = self.azure.add_snapshot(resource_group_name, snapshot_name,
+                                         snapshot.creation_data.source_resource_id,
+                                         time_created,
+                                         location=snapshot.location,
+                                         incremental=getattr(snapshot, 'incremental', None),
+                                         tags=snapshot.tags)
+        return FakePoller(result, self.azure.operation_latency)
+
+    def list_by_resource_group(self, resource_group_name):
+        return self.azure.paged('snapshots.list_by_resource_group',
+                                [snapshot for (group, name), snapshot in self.azure.snapshots.items()
+                                 if group == resource_group_name.lower()])
+
+    def delete(self, resource_group_name, snapshot_name, **kwargs):
+        self.azure.record('snapshots.delete')
+        self.azure.snapshots.pop((resource_group_name.lower(), snapshot_name), None)
+        return FakePoller(None, self.azure.operation_latency)
+
+    def grant_access(self, resource_group_name, snapshot_name, access, duration_in_seconds, **kwargs):
+        self.azure.record('snapshots.grant_access')
+        snapshot = self.azure.snapshots[(resource_group_name.lower(), snapshot_name)]
+        return FakePoller(self.azure.grant(snapshot, access), self.azure.operation_latency)
+
+    def revoke_access(self, resource_group_name, snapshot_name, **kwargs):
+        self.azure.record('snapshots.revoke_access')
+        snapshot = self.azure.snapshots.get((resource_group_name.lower(), snapshot_name))
+        if snapshot is not None and self.azure.blob_service is not None:
+            self.azure.blob_service.revoke(snapshot.id)
+        return FakePoller(None, self.azure.operation_latency)
+
+
+class FakeDisksOperations(object):
+    """
+    Managed disks created for upload; the disks of the generated VMs are only
+    known through the VMs.
+    """
+
+    def __init__(self, azure):
+        self.azure = azure
+
+    def get(self, resource_group_name, disk_name, **kwargs):
+        self.azure.record('disks.get')
+        try:
+            return self.azure.disks[(resource_group_name.lower(), disk_name)]
+        except KeyError:
+            raise not_found("Disk {} not found".format(disk_name))
+
+    def create_or_update(self, resource_group_name, disk_name, disk, **kwargs):
+        self.azure.record('disks.create_or_update')
+        if disk.creation_data.create_option != 'Upload':
+            raise NotImplementedError("Only disks created for upload are supported")
+        result = self.azure.add_disk(resource_group_name, disk_name, disk.creation_data.upload_size_bytes,
+                                     location=disk.location, tags=disk.tags)
+        return FakePoller(result, self.azure.operation_latency)
+
+    def grant_access(self, resource_group_name, disk_name, access, duration_in_seconds, **kwargs):
+        self.azure.record('disks.grant_access')
+        disk = self.azure.disks[(resource_group_name.lower(), disk_name)]
+        disk.disk_state = 'ActiveUpload' if access == 'Write' else 'ActiveSAS'
+        return FakePoller(self.azure.grant(disk, access), self.azure.operation_latency)
+
+    def revoke_access(self, resource_group_name, disk_name, **kwargs):
+        self.azure.record('disks.revoke_access')
+        disk = self.azure.disks.get((resource_group_name.lower(), disk_name))
+        if disk is not None:
+            disk.disk_state = 'Unattached'
+            if self.azure.blob_service is not None:
+                self.azure.blob_service.revoke(disk.id)
+        return FakePoller(None, self.azure.operation_latency)
+
+    def delete(self, resource_group_name, disk_name, **kwargs):
+        self.azure.record('disks.delete')
+        disk = self.azure.disks.pop((resource_group_name.lower(), disk_name), None)
+        if disk is not None:
+            with self.azure._lock:
+                self.azure.contents.pop(disk.id.lower(), None)
+        return FakePoller(None, self.azure.operation_latency)
@@ -0,0 +1,221 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local HTTP stand-in for the page blobs behind the SAS urls that grant_access
+hands out for the disks and snapshots of a FakeAzure.
+
+Blob contents are the sparse page maps FakeAzure keeps per resource. The
+subset of the blob API used by azure_rm_page_blob is understood: HEAD, ranged
+GET, with the MD5 of ranges of up to 4 MiB, Get Page Ranges (also against a previous snapshot) and Put Page, with a
+body or from a source url on this same server.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import base64
+import hashlib
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs, urlparse
+
+PAGE = 512
+RANGE_MD5_MAX_BYTES = 4 * 1024 * 1024
+RANGE = re.compile(r'^bytes=(\d+)-(\d+)$')
+
+
+class BlobError(Exception):
+    def __init__(self, status, message):
+        super(BlobError, self).__init__(message)
+        self.status = status
+
+
+def merge_pages(offsets):
+    """
+    Turn sorted page offsets into inclusive (start, end) byte ranges.
+    """
+    ranges = []
+    for offset in offsets:
+        if ranges and ranges[-1][1] + 1 == offset:
+            ranges[-1][1] = offset + PAGE - 1
+        else:
+            ranges.append([offset, offset + PAGE - 1])
+    return ranges
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeBlobService(object):
+    """
+    Blob endpoint listening on a free localhost port for as long as it is used
+    as a context manager. Attach it to a FakeAzure as ``blob_service`` so that
+    grant_access can open blobs on it.
+    """
+
+    def __init__(self, azure):
+        self.azure = azure
+        self.blobs = dict()
+        self._lock = threading.Lock()
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self, method):
+                body = b''
+                if self.headers.get('Content-Length'):
+                    body = self.rfile.read(int(self.headers['Content-Length']))
+                try:
+                    status, headers, data = service.handle(method, self.path, self.headers, body)
+                except BlobError as e:
+                    status, headers, data = e.status, {}, str(e).encode('utf-8')
+                self.send_response(status)
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                if 'Content-Length' not in headers:
+                    self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if method != 'HEAD':
+                    self.wfile.write(data)
+
+            def do_HEAD(self):
+                self._handle('HEAD')
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def grant(self, resource_id, size):
+        """
+        Open the contents of a resource as a blob of ``size`` bytes and return
+        its SAS url.
+        """
+        name = hashlib.sha1(resource_id.lower().encode('utf-8')).hexdigest()
+        with self._lock:
+            self.blobs[name] = (resource_id.lower(), size)
+        return '{}/md-{}/abcd?sv=2019-07-07&sr=b&sig=fake'.format(self.url, name)
+
+    def revoke(self, resource_id):
+        name = hashlib.sha1(resource_id.lower().encode('utf-8')).hexdigest()
+        with self._lock:
+            self.blobs.pop(name, None)
+
+    def _blob(self, url):
+        path = urlparse(url).path
+        name = path.split('/')[1][len('md-'):]
+        try:
+            resource_id, size = self.blobs[name]
+        except KeyError:
+            raise BlobError(403, "Access to {} is not granted".format(path))
+        return self.azure.content(resource_id), size
+
+    def handle(self, method, path, headers, body):
+        query = parse_qs(urlparse(path).query)
+        comp = query.get('comp', [None])[0]
+        pages, size = self._blob(path)
+
+        if method == 'HEAD':
+            self.azure.record('blob.get_properties')
+            return 200, {'Content-Length': str(size), 'x-ms-blob-type': 'PageBlob'}, b''
+
+        if method == 'GET' and comp == 'pagelist':
+            self.azure.record('blob.get_page_ranges')
+            offsets = set(pages)
+            previous = headers.get('x-ms-previous-snapshot-url')
+            if previous:
+                previous_pages = self._blob(previous)[0]
+                offsets = set(offset for offset in offsets | set(previous_pages)
+                              if pages.get(offset) != previous_pages.get(offset))
+            data = ''.join('<PageRange><Start>{}</Start><End>{}</End></PageRange>'.format(start, end)
+                           for start, end in merge_pages(sorted(offsets)))
+            data = '<?xml version="1.0" encoding="utf-8"?><PageList>{}</PageList>'.format(data)
+            return 200, {'Content-Type': 'application/xml'}, data.encode('utf-8')
+
+        if method == 'GET':
+            self.azure.record('blob.get')
+            start, end = 0, size - 1
+            match = RANGE.match(headers.get('x-ms-range') or headers.get('Range') or '')
+            if match:
+                start, end = int(match.group(1)), min(int(match.group(2)), size - 1)
+            data = bytearray(end - start + 1)
+            for offset in range(start - start % PAGE, end + 1, PAGE):
+                page = pages.get(offset)
+                if page is not None:
+                    lo = max(offset, start)
+                    hi = min(offset + PAGE - 1, end)
+                    data[lo - start:hi - start + 1] = page[lo - offset:hi - offset + 1]
+            headers_out = dict()
+            if headers.get('x-ms-range-get-content-md5') == 'true':
+                if not match or len(data) > RANGE_MD5_MAX_BYTES:
+                    raise BlobError(400, "The MD5 is only returned for ranges of up to 4 MiB")
+                headers_out['Content-MD5'] = base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+            return 206 if match else 200, headers_out, bytes(data)
+
+        if method == 'PUT' and comp == 'page':
+            match = RANGE.match(headers.get('x-ms-range') or '')
+            if not match or int(match.group(1)) % PAGE or (int(match.group(2)) + 1) % PAGE:
+                raise BlobError(400, "Page ranges must be aligned to 512 bytes")
+            start, end = int(match.group(1)), int(match.group(2))
+            if end >= size:
+                raise BlobError(416, "Range beyond the end of the blob")
+            source = headers.get('x-ms-copy-source')
+            if source:
+                self.azure.record('blob.put_page_from_url')
+                source_pages = self._blob(source)[0]
+                source_start = int(RANGE.match(headers['x-ms-source-range']).group(1))
+                updates = dict((offset, source_pages.get(source_start + offset - start))
+                               for offset in range(start, end + 1, PAGE))
+            else:
+                self.azure.record('blob.put_page')
+                if len(body) != end - start + 1:
+                    raise BlobError(400, "Body does not match the range")
+                updates = dict((offset, bytes(body[offset - start:offset - start + PAGE]))
+                               for offset in range(start, end + 1, PAGE))
+            with self._lock:
+                for offset, page in updates.items():
+                    if page is None or headers.get('x-ms-page-write') == 'clear':
+                        pages.pop(offset, None)
+                    else:
+                        pages[offset] = page
+            return 201, {}, b''
+
+        raise BlobError(400, "Unsupported request {} {}".format(method, path))
+
+    def __enter__(self):
+        self.azure.blob_service = self
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.azure.blob_service = None
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,208 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local HTTP stand-in for the Azure Resource Graph resources query API, serving
+the images of a FakeAzure.
+
+Only the subset of KQL that azure_rm_resource_graph.image_query generates is
+understood; any other query is answered with a 400 error.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import json
+import re
+import threading
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+LITERAL = r"@'(?:[^']|'')*'"
+LITERAL_LIST = r"\(((?:{}(?:, )?)*)\)".format(LITERAL)
+
+# Each known condition with a factory turning its matched groups into a test
+# of a row.
+ATOMS = [
+    (re.compile(r"type =~ '([^']*)'"),
+     lambda value: lambda row: row['type'] == value.lower()),
+    (re.compile(r"resourceGroup =~ ({})".format(LITERAL)),
+     lambda value: lambda row, group=literal(value).lower(): row['resourceGroup'] == group),
+    (re.compile(r"name in {}".format(LITERAL_LIST)),
+     lambda value: lambda row, names=literals(value): row['name'] in names),
+    (re.compile(r"strcat\(tolower\(resourceGroup\), '/', name\) in {}".format(LITERAL_LIST)),
+     lambda value: lambda row, names=literals(value): "{}/{}".format(row['resourceGroup'], row['name']) in names),
+    (re.compile(r"name matches regex ({})".format(LITERAL)),
+     lambda value: lambda row, regex=re.compile(literal(value)): regex.search(row['name']) is not None),
+    (re.compile(r"isnotnull\(tags\[({})\]\)".format(LITERAL)),
+     lambda value: lambda row, key=literal(value): key in (row['tags'] or {})),
+    (re.compile(r"tostring\(tags\[({0})\]\) == ({0})".format(LITERAL)),
+     lambda key, value: lambda row, key=literal(key), value=literal(value): (row['tags'] or {}).get(key) == value),
+]
+
+
+class QueryError(Exception):
+    pass
+
+
+def literal(text):
+    return text[2:-1].replace("''", "'")
+
+
+def literals(text):
+    return set(literal(match) for match in re.findall(LITERAL, text))
+
+
+def condition(text):
+    """
+    Compile a where clause made of known atoms joined by ``or``.
+    """
+    tests = []
+    position = 0
+    while True:
+        for pattern, factory in ATOMS:
+            match = pattern.match(text, position)
+            if match:
+                tests.append(factory(*match.groups()))
+                position = match.end()
+                break
+        else:
+            raise QueryError("Unsupported condition: {}".format(text[position:]))
+        if position == len(text):
+            return lambda row: any(test(row) for test in tests)
+        if not text.startswith(' or ', position):
+            raise QueryError("Unsupported condition: {}".format(text[position:]))
+        position += len(' or ')
+
+
+def image_row(image):
+    return dict(id=image.id,
+                name=image.name,
+                type='microsoft.compute/images',
+                resourceGroup=image.id.split('/')[4].lower(),
+                location=image.location,
+                tags=image.tags,
+                properties=dict(storageProfile=dict(osDisk=dict(
+                    managedDisk=None if image.storage_profile.os_disk.managed_disk is None else dict()))))
+
+
+def project(row, columns):
+    projected = dict()
+    for column in columns.split(', '):
+        name, sep, expression = column.partition(' = ')
+        if not sep:
+            projected[name] = row[name]
+        elif expression == 'isnotnull(properties.storageProfile.osDisk.managedDisk)':
+            projected[name] = row['properties']['storageProfile']['osDisk']['managedDisk'] is not None
+        else:
+            raise QueryError("Unsupported projection: {}".format(column))
+    return projected
+
+
+def run_query(azure, query):
+    clauses = query.split('\n| ')
+    if clauses[0] != 'Resources':
+        raise QueryError("Unsupported table: {}".format(clauses[0]))
+    rows = [image_row(image) for image in list(azure.images.values())]
+    for clause in clauses[1:]:
+        if clause.startswith('where '):
+            test = condition(clause[len('where '):])
+            rows = [row for row in rows if test(row)]
+        elif clause == 'order by id asc':
+            rows.sort(key=lambda row: row['id'])
+        elif clause.startswith('project '):
+            rows = [project(row, clause[len('project '):]) for row in rows]
+        elif clause.startswith('limit '):
+            rows = rows[:int(clause[len('limit '):])]
+        else:
+            raise QueryError("Unsupported clause: {}".format(clause))
+    return rows
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeResourceGraph(object):
+    """
+    Resource Graph endpoint listening on a free localhost port for as long as
+    it is used as a context manager. Like the real service, which caps
+    ``$top``, it answers with at most ``page_size`` rows at a time.
+    """
+
+    def __init__(self, azure, page_size=1000):
+        self.azure = azure
+        self.page_size = page_size
+        self.queries = []
+        self._rows = dict()
+        graph = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+                try:
+                    status, response = 200, graph.handle(body)
+                except QueryError as e:
+                    status, response = 400, dict(error=dict(code='BadRequest', message=str(e)))
+                data = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+
+    def handle(self, body):
+        self.azure.record('resource_graph.resources')
+        with self.azure._lock:
+            self.azure.pages += 1
+        self.queries.append(body['query'])
+
+        # Rows are kept per query so that fetching later pages, which the real
+        # service answers from its index, does not re-run the query.
+        rows = self._rows.get(body['query'])
+        if rows is None:
+            rows = self._rows[body['query']] = run_query(self.azure, body['query'])
+        options = body.get('options') or {}
+        offset = int(options.get('$skipToken') or 0)
+        top = min(int(options.get('$top') or self.page_size), self.page_size)
+        page = rows[offset:offset + top]
+        response = dict(totalRecords=len(rows), count=len(page), data=page, resultTruncated='false')
+        if offset + top < len(rows):
+            # Like the real service, results can only be paged through when
+            # the id of the resources is projected; otherwise they are cut
+            # off after the first page.
+            if page and 'id' in page[0]:
+                response['$skipToken'] = str(offset + top)
+            else:
+                response['resultTruncated'] = 'true'
+        return response
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,185 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Local HTTPS stand-in for the Azure AD token endpoint.
+
+ADAL only talks to https authorities, and only skips validating them against
+the public Azure AD instance for ADFS ones, so the endpoint serves the client
+credentials grant at /adfs/oauth2/token with a self-signed certificate made
+up on start. Build credentials with ``cloud`` as their cloud_environment and
+``verify=False`` to use it, or register it under its name for
+AzureRMModuleBase to look up as cloud_environment. While it runs, its
+certificate is at ``certificate_path``.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import datetime
+import ipaddress
+import json
+import os
+import shutil
+import ssl
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import parse_qs
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from msrestazure.azure_cloud import AZURE_PUBLIC_CLOUD, Cloud, CloudEndpoints
+
+TOKEN_PATH = '/adfs/oauth2/token'
+
+
+def self_signed_certificate(directory):
+    """
+    Write a key and a certificate for 127.0.0.1 to ``directory`` and return
+    their paths. The certificate can be trusted through REQUESTS_CA_BUNDLE.
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, u'127.0.0.1')])
+    now = datetime.datetime.utcnow()
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(name)
+                   .issuer_name(name)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now - datetime.timedelta(minutes=5))
+                   .not_valid_after(now + datetime.timedelta(days=1))
+                   .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address(u'127.0.0.1'))]),
+                                  critical=False)
+                   .sign(key, hashes.SHA256(), default_backend()))
+    key_path = os.path.join(directory, 'key.pem')
+    certificate_path = os.path.join(directory, 'certificate.pem')
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    with open(certificate_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+    return key_path, certificate_path
+
+
+def bench_cloud(url, resource_manager=None, name='AnsibleBench'):
+    """
+    The public cloud, with its Azure AD authority replaced by the endpoint at
+    ``url``, and its resource manager by ``resource_manager`` when given.
+    """
+    endpoints = AZURE_PUBLIC_CLOUD.endpoints
+    return Cloud(name,
+                 endpoints=CloudEndpoints(active_directory=url + '/adfs',
+                                          active_directory_resource_id=endpoints.active_directory_resource_id,
+                                          resource_manager=resource_manager or endpoints.resource_manager))
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeTokenEndpoint(object):
+    """
+    Token endpoint listening on a free localhost port for as long as it is
+    used as a context manager. Every token issued is valid for ``lifetime``
+    seconds, ``requests`` counts the token requests served, and a request
+    taking ``latency`` seconds stands for the round trip to Azure AD.
+    ``connections`` counts the connections made to the endpoint, which
+    subclasses serving GET requests through handle_get share.
+    """
+
+    def __init__(self, lifetime=3600, latency=0.0):
+        self.lifetime = lifetime
+        self.latency = latency
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                with endpoint._lock:
+                    endpoint.connections += 1
+
+            def _reply(self, status, data, headers=None):
+                data = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0)).decode('utf-8')
+                self._reply(*endpoint.handle(self.path, dict((key, values[0])
+                                                             for key, values in parse_qs(body).items())))
+
+            def do_GET(self):
+                self._reply(*endpoint.handle_get(self.path, self.headers))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _Server(('127.0.0.1', 0), Handler)
+        self.url = 'https://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.cloud = bench_cloud(self.url)
+
+    def handle(self, path, form):
+        if path.split('?')[0] != TOKEN_PATH:
+            return 404, dict(error='not_found')
+        if form.get('grant_type') != 'client_credentials' or not form.get('client_secret'):
+            return 400, dict(error='invalid_request')
+        with self._lock:
+            self.requests += 1
+            serial = self.requests
+        time.sleep(self.latency)
+        now = int(time.time())
+        return 200, dict(token_type='Bearer',
+                         access_token='fake-token-{}-{}'.format(form.get('client_id'), serial),
+                         expires_in=str(self.lifetime),
+                         expires_on=str(now + self.lifetime),
+                         not_before=str(now),
+                         resource=form.get('resource'))
+
+    def handle_get(self, path, headers):
+        return 404, dict(error=dict(code='NotFound', message="No resource at {}".format(path)))
+
+    def __enter__(self):
+        self._directory = tempfile.mkdtemp(prefix='ansible-fake-token-')
+        key_path, self.certificate_path = self_signed_certificate(self._directory)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(self.certificate_path, key_path)
+        self.server.socket = context.wrap_socket(self.server.socket, server_side=True)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self._directory, ignore_errors=True)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Startup-time benchmark for the azure_rm_image, azure_rm_image_facts,
+azure_rm_image_operation and azure_rm_snapshot modules.
+
+Every module is loaded in a fresh interpreter, the way each task starts on a
+host, and then run once on a path that makes no changes against the fake
+clients of fake_azure.
+
+    python hacking/azure_bench/import_bench.py --repeat 5
+
+The median over the repeats is reported for the seconds spent importing
+AzureRMModuleBase, the seconds the module adds on top of it, and the
+seconds of the no-op run. The number of modules loaded by the import and the
+compute model versions loaded by the run are reported as well, showing which
+SDK models the run actually needed.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+REPO = os.path.abspath(os.path.join(HERE, '..', '..'))
+
+# Run in the child interpreter: argv holds the module name and the JSON of the
+# no-op run's parameters, and a JSON line of measurements is printed.
+PROBE = r'''
+import json
+import os
+import re
+import sys
+import time
+
+repo, here, name, run = sys.argv[1], sys.argv[2], sys.argv[3], json.loads(sys.argv[4])
+
+import ansible.module_utils
+ansible.module_utils.__path__.insert(0, os.path.join(repo, 'lib', 'ansible', 'module_utils'))
+
+started = time.time()
+import ansible.module_utils.azure_rm_common
+base = time.time() - started
+base_modules = len(sys.modules)
+
+import importlib.util
+spec = importlib.util.spec_from_file_location(name, os.path.join(repo, 'lib', 'ansible', 'modules', 'cloud',
+                                                                 'azure', name + '.py'))
+module = importlib.util.module_from_spec(spec)
+started = time.time()
+spec.loader.exec_module(module)
+own = time.time() - started
+own_modules = len(sys.modules) - base_modules
+
+def model_versions():
+    return set(m.group(1) for m in (re.match(r'azure\.mgmt\.compute\.(v\d+_\d+_\d+)\.models$', key)
+                                    for key in list(sys.modules)) if m)
+
+loaded = model_versions()
+result = dict(base=base, own=own, own_modules=own_modules, run=None, models=[])
+if run is not None:
+    sys.path.insert(0, here)
+    sys.argv = [sys.argv[0]]
+    import run_bench
+    from fake_azure import FakeAzure
+    azure = FakeAzure(images=10, disks=2)
+    module_class = getattr(module, run['class'])
+    started = time.time()
+    output, failed = run_bench.run_module(module_class, azure, run['params'], check_mode=run.get('check_mode', False))
+    result['run'] = time.time() - started
+    result['failed'] = failed
+    result['models'] = sorted(model_versions() - loaded)
+print(json.dumps(result))
+'''
+
+MODULES = [
+    ('azure_rm_image', 'capture_existing', dict(cls='AzureRMImage',
+                                                params=dict(resource_group='rg0', vm_name='vm0', name='image0'))),
+    ('azure_rm_image', 'capture_check_mode', dict(cls='AzureRMImage',
+                                                  params=dict(resource_group='rg0', vm_name='vm0', name='new'),
+                                                  check_mode=True)),
+    ('azure_rm_image_facts', 'get_name', dict(cls='AzureRMImageFacts', params=dict(name='image0'))),
+    ('azure_rm_image_operation', None, None),
+    ('azure_rm_snapshot', 'delete_none', dict(cls='AzureRMVMSnapshot',
+                                              params=dict(resource_group='rg0', name='vm0', state='absent'))),
+]
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def probe(python, name, run):
+    if run is not None:
+        run = dict(run, **{'class': run['cls']})
+    output = subprocess.check_output([python, '-c', PROBE, REPO, HERE, name, json.dumps(run)])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of fresh interpreters to measure every module in')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to load the modules with')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON instead of a table')
+    args = parser.parse_args()
+
+    results = []
+    for name, run_name, run in MODULES:
+        samples = [probe(args.python, name, run) for _ in range(args.repeat)]
+        results.append(dict(module=name,
+                            run=run_name,
+                            base=round(median([sample['base'] for sample in samples]), 4),
+                            own=round(median([sample['own'] for sample in samples]), 4),
+                            own_modules=samples[-1]['own_modules'],
+                            run_time=round(median([sample['run'] for sample in samples]), 4) if run else None,
+                            failed=any(sample.get('failed') for sample in samples),
+                            models=samples[-1]['models']))
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    print("{:<26} {:<20} {:>9} {:>9} {:>8} {:>9}  {}".format(
+        'module', 'no-op run', 'base (s)', 'own (s)', 'modules', 'run (s)', 'models loaded by run'))
+    for result in results:
+        print("{module:<26} {run:<20} {base:>9.4f} {own:>9.4f} {own_modules:>8} {run_time:>9}  {models}".format(
+            **dict(result,
+                   run=result['run'] or '-',
+                   run_time='-' if result['run_time'] is None else '{:.4f}'.format(result['run_time']),
+                   models=', '.join(result['models']) or '-' if not result['failed'] else 'failed')))
+
+
+if __name__ == '__main__':
+    main()
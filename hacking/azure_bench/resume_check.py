@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Resume check for the snapshot downloads of azure_rm_snapshot export_to.
+
+A disk of fake_azure, one of whose allocated pieces holds only zeros, is
+downloaded from the blob service of fake_blob with download_page_blob. The
+file is then damaged in that zero piece and in a piece with data, and the
+download run again, resuming the first one.
+
+    python hacking/azure_bench/resume_check.py
+
+Both runs are reported with the pieces resumed and the bytes downloaded, and
+whether the file holds the content of the disk afterwards. The check exits
+with status 1 when it does not.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+from fake_azure import GIB, FakeAzure
+from fake_blob import PAGE, FakeBlobService
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import ansible.module_utils
+ansible.module_utils.__path__.insert(0, os.path.join(REPO, 'lib', 'ansible', 'module_utils'))
+from ansible.module_utils.azure_rm_page_blob import coalesce_ranges, download_page_blob, get_page_ranges
+
+
+def matches(path, pages, pieces):
+    with open(path, 'rb') as f:
+        for start, end in pieces:
+            f.seek(start)
+            data = f.read(end - start + 1)
+            expected = b''.join(pages.get(offset, b'\0' * PAGE) for offset in range(start, end + 1, PAGE))
+            if data != expected:
+                return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--populated-mb', type=int, default=8,
+                        help='MiB of data on the disk')
+    args = parser.parse_args()
+
+    azure = FakeAzure(images=0, resource_groups=1, disks=0, populated_mb=args.populated_mb)
+    directory = tempfile.mkdtemp()
+    try:
+        with FakeBlobService(azure) as blob:
+            disk_id = azure.vms[('rg0', 'vm0')].storage_profile.os_disk.managed_disk.id
+            size = 1024 * GIB + PAGE
+            sas_url = blob.grant(disk_id, size)
+            pages = azure.content(disk_id)
+            ranges = get_page_ranges(sas_url)
+            pieces = coalesce_ranges(ranges)
+            zero, data = pieces[0], pieces[1]
+            # Pages the service still lists after they were zeroed.
+            for offset in range(zero[0], zero[1] + 1, PAGE):
+                pages[offset] = b'\0' * PAGE
+
+            path = os.path.join(directory, 'disk.vhd')
+            identity = dict(snapshot=disk_id)
+            runs = [('fresh', download_page_blob(sas_url, path, size, ranges, identity))]
+            with open(path, 'r+b') as f:
+                for start, end in (zero, data):
+                    f.seek(start)
+                    f.write(b'X' * PAGE)
+            runs.append(('resumed', download_page_blob(sas_url, path, size, ranges, identity)))
+            ok = matches(path, pages, pieces)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print("{:<8} {:>7} {:>15} {:>17}".format('run', 'pieces', 'resumed pieces', 'downloaded bytes'))
+    for name, result in runs:
+        print("{:<8} {pieces:>7} {resumed_pieces:>15} {downloaded_bytes:>17}".format(name, **result))
+    print("content matches: {}".format(ok))
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
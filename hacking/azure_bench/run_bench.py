@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Offline benchmark for the azure_rm_image, azure_rm_image_facts and
+azure_rm_snapshot modules.
+
+The modules are driven through exec_module against the in-memory clients in
+fake_azure, so no credentials or network access are needed. Ansible and the
+Azure SDK packages the modules import still have to be installed. Resource
+Graph queries are answered by the local HTTP endpoint in fake_resource_graph,
+and disk and snapshot contents are served by the one in fake_blob.
+
+    python hacking/azure_bench/run_bench.py --images 10,1000,50000 --disks 8,16 --latency 0.005
+
+For every scenario and size the wall time, the number of API calls and
+listing pages, the peak memory allocated by Python and the size of the
+serialized module result are reported.
+
+With --without-snapshot-api the modules run as with an azure-mgmt-compute
+release that lacks the compute API version of incremental snapshots and
+replication. The scenarios that need it then only pass when the module fails
+with a message naming the azure-mgmt-compute release it requires.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import requests
+
+from fake_azure import SUBSCRIPTION_ID, FakeAzure, Obj
+from fake_blob import FakeBlobService
+from fake_resource_graph import FakeResourceGraph
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+MODULE_DIR = os.path.join(REPO, 'lib', 'ansible', 'modules', 'cloud', 'azure')
+MODULE_UTILS_DIR = os.path.join(REPO, 'lib', 'ansible', 'module_utils')
+
+# Make the module_utils of this tree importable next to the installed ones, the
+# way they would be bundled with the modules when Ansible ships them to a host.
+import ansible.module_utils
+ansible.module_utils.__path__.insert(0, MODULE_UTILS_DIR)
+from ansible.module_utils import basic
+from ansible.module_utils.azure_rm_common import AzureRMModuleBase
+from ansible.module_utils.azure_rm_snapshot_common import SNAPSHOT_API_VERSION
+
+from azure.mgmt.compute import ComputeManagementClient
+
+
+class ModuleFailed(Exception):
+    def __init__(self, result):
+        super(ModuleFailed, self).__init__(result.get('msg'))
+        self.result = result
+
+
+class FakeAnsibleModule(object):
+    def __init__(self, params, check_mode):
+        self.params = params
+        self.check_mode = check_mode
+
+    def fail_json(self, **kwargs):
+        raise ModuleFailed(kwargs)
+
+    def debug(self, msg):
+        pass
+
+    def warn(self, msg):
+        pass
+
+
+class MissingApiClient(object):
+    """
+    The client an azure-mgmt-compute release without SNAPSHOT_API_VERSION
+    would build for it, which fails like the SDK does once it is used.
+    """
+
+    config = None
+
+    def __getattr__(self, name):
+        raise NotImplementedError("APIVersion {} is not available".format(SNAPSHOT_API_VERSION))
+
+
+@contextlib.contextmanager
+def without_snapshot_api():
+    """
+    Have ComputeManagementClient.models fail for SNAPSHOT_API_VERSION, as it
+    does with an azure-mgmt-compute release that does not provide it.
+    """
+    original = ComputeManagementClient.__dict__['models']
+
+    def models(cls, api_version=ComputeManagementClient.DEFAULT_API_VERSION):
+        if api_version == SNAPSHOT_API_VERSION:
+            raise NotImplementedError("APIVersion {} is not available".format(api_version))
+        return original.__func__(cls, api_version)
+
+    ComputeManagementClient.models = classmethod(models)
+    try:
+        yield
+    finally:
+        ComputeManagementClient.models = original
+
+
+def load_module(name):
+    spec = importlib.util.spec_from_file_location(name, os.path.join(MODULE_DIR, name + '.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_module(module_class, azure, params, check_mode=False, snapshot_api=True):
+    """
+    Instantiate a module class with the fake clients in place of the ones
+    AzureRMModuleBase would build, and return the result of exec_module.
+    Without ``snapshot_api`` the client for SNAPSHOT_API_VERSION is a
+    MissingApiClient.
+    """
+    def init(self, derived_arg_spec, supports_check_mode=False, **kwargs):
+        merged = dict((key, spec.get('default')) for key, spec in derived_arg_spec.items())
+        merged['tags'] = None
+        merged.update(params)
+        self.module = FakeAnsibleModule(merged, check_mode)
+        self.check_mode = check_mode
+        self.azure_auth = Obj(subscription_id=SUBSCRIPTION_ID,
+                              azure_credentials=Obj(signed_session=requests.Session))
+        self._compute_client = azure.compute_client()
+        self._resource_client = azure.resource_client()
+        self._snapshot_client = self._compute_client if snapshot_api else MissingApiClient()
+        self.bench_result = self.exec_module(**merged)
+
+    # Task arguments are handed to modules the way AnsiballZ does, for
+    # anything reading them before AzureRMModuleBase does.
+    basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=params)).encode('utf-8')
+    original_init = AzureRMModuleBase.__init__
+    AzureRMModuleBase.__init__ = init
+    try:
+        return module_class().bench_result, False
+    except ModuleFailed as e:
+        return e.result, True
+    finally:
+        AzureRMModuleBase.__init__ = original_init
+        basic._ANSIBLE_ARGS = None
+
+
+def image_scenarios(images):
+    image = load_module('azure_rm_image').AzureRMImage
+    facts = load_module('azure_rm_image_facts').AzureRMImageFacts
+    operation = load_module('azure_rm_image_operation').AzureRMImageOperation
+    last = 'image{}'.format(images - 1)
+    last_group = 'rg{}'.format((images - 1) % 10)
+    token = dict(kind='image_capture', subscription_id=SUBSCRIPTION_ID, resource_group=last_group, name=last)
+
+    return [
+        ('facts_list', facts, dict()),
+        ('facts_get_name', facts, dict(name=last)),
+        ('facts_get_group_and_name', facts, dict(name=last, resource_group=last_group)),
+        ('facts_get_revalidated', facts, dict(name=last, resource_group=last_group, etag_revalidation=True,
+                                              inventory_cache_path='{tmpdir}', warm_up=True)),
+        ('facts_names', facts, dict(names=['image{}'.format(i) for i in range(0, images, max(images // 100, 1))])),
+        ('facts_names_with_group', facts, dict(names=['{}/{}'.format(last_group, last), 'rg0/image0'])),
+        ('facts_name_pattern', facts, dict(name_pattern='image1*')),
+        ('facts_tags', facts, dict(tags=['ansible-created'])),
+        ('facts_tags_dict', facts, dict(tags={'ansible-created': None})),
+        ('facts_index_cold', facts, dict(names=[last], image_index_path='{tmpdir}/images.db')),
+        ('facts_index_warm', facts, dict(names=[last], image_index_path='{tmpdir}/images.db', warm_up=True)),
+        ('facts_index_refresh', facts, dict(names=[last], image_index_path='{tmpdir}/images.db', image_index_ttl=0,
+                                            warm_up=True)),
+        ('facts_graph_list', facts, dict(backend='resource_graph')),
+        ('facts_graph_names', facts, dict(backend='resource_graph',
+                                          names=['image{}'.format(i) for i in range(0, images, max(images // 100, 1))])),
+        ('facts_graph_name_pattern', facts, dict(backend='resource_graph', name_pattern='image1*')),
+        ('image_capture_existing', image, dict(resource_group=last_group, vm_name='vm0', name=last)),
+        ('image_capture_new', image, dict(resource_group='rg0', vm_name='vm0', name='bench-new')),
+        ('image_capture_snapshot', image, dict(resource_group='rg0', vm_name='vm0', name='bench-new',
+                                               capture_mode='snapshot')),
+        ('image_delete', image, dict(resource_group=last_group, name=last, state='absent')),
+        ('operation_wait', operation, dict(tokens=[token], wait=True, poll_interval=0.05, timeout=10,
+                                           pending_image=(last_group, last, 0.3))),
+        ('operation_wait_snapshots', operation, dict(tokens=[dict(token, snapshots=['history0-vm0-os',
+                                                                                    'history0-vm0-data0'])],
+                                                     wait=True, poll_interval=0.05, timeout=10,
+                                                     pending_image=(last_group, last, 0.3))),
+        ('image_prune', image, dict(resource_group='rg0', name_pattern='image*', keep_latest=2, older_than='1d',
+                                    state='pruned')),
+    ]
+
+
+def disk_scenarios(disks):
+    snapshot = load_module('azure_rm_snapshot').AzureRMVMSnapshot
+    image = load_module('azure_rm_image').AzureRMImage
+    regions = ['northeurope', 'eastus', 'westus2']
+
+    return [
+        ('snapshot', snapshot, dict(resource_group='rg0', name='vm0', prefix='bench-')),
+        ('snapshot_rotate', snapshot, dict(resource_group='rg0', name='vm0', keep=3)),
+        ('snapshot_delete', snapshot, dict(resource_group='rg0', name='vm0', state='absent')),
+        ('snapshot_export', snapshot, dict(resource_group='rg0', name='vm0', prefix='bench-',
+                                           export_to='{tmpdir}/export')),
+        ('snapshot_export_resume', snapshot, dict(resource_group='rg0', name='vm0', prefix='bench-',
+                                                  export_to='{tmpdir}/export', warm_up=True)),
+        ('snapshot_incremental', snapshot, dict(resource_group='rg0', name='vm0', prefix='bench-', incremental=True,
+                                                requires_snapshot_api=True)),
+        ('image_replicate', image, dict(resource_group='rg0', vm_name='vm0', name='bench-new',
+                                        replicate_to=regions, requires_snapshot_api=True)),
+        ('image_replicate_current', image, dict(resource_group='rg0', vm_name='vm0', name='bench-new',
+                                                replicate_to=regions, warm_up=True, requires_snapshot_api=True)),
+    ]
+
+
+def measure(name, module_class, params, args, size, images=0, disks=1):
+    """
+    Run one scenario against fresh fake clients. ``{tmpdir}`` in a parameter
+    is replaced by a scratch directory, and with ``warm_up`` set the module is
+    run once before the measured run, so that caches and indexes are filled.
+    Without the snapshot API, a scenario with ``requires_snapshot_api`` set
+    passes when the module fails asking for a newer azure-mgmt-compute.
+    """
+    azure = FakeAzure(images=images,
+                      disks=disks,
+                      page_size=args.page_size,
+                      latency=args.latency,
+                      operation_latency=args.operation_latency,
+                      snapshot_history=args.snapshot_history,
+                      populated_mb=args.populated_mb)
+
+    with contextlib.ExitStack() as stack:
+        tmpdir = tempfile.mkdtemp()
+        stack.callback(shutil.rmtree, tmpdir)
+        params = dict((key, value.format(tmpdir=tmpdir) if isinstance(value, str) else value)
+                      for key, value in params.items())
+        warm_up = params.pop('warm_up', False)
+        pending_image = params.pop('pending_image', None)
+        requires_snapshot_api = params.pop('requires_snapshot_api', False)
+        if pending_image is not None:
+            azure.pending_image(*pending_image)
+        stack.enter_context(FakeBlobService(azure))
+        if params.get('backend') == 'resource_graph':
+            graph = stack.enter_context(FakeResourceGraph(azure, page_size=azure.page_size))
+            params = dict(params, resource_graph_endpoint=graph.url)
+
+        if not args.snapshot_api:
+            stack.enter_context(without_snapshot_api())
+
+        if warm_up:
+            run_module(module_class, azure, params, snapshot_api=args.snapshot_api)
+            azure.calls.clear()
+            azure.pages = 0
+
+        tracemalloc.start()
+        started = time.time()
+        result, failed = run_module(module_class, azure, params, snapshot_api=args.snapshot_api)
+        # A wait that ended with operations still running did not do its job.
+        failed = failed or result.get('done') is False
+        if requires_snapshot_api and not args.snapshot_api:
+            failed = not failed or 'azure-mgmt-compute >=' not in result.get('msg', '')
+        wall_time = time.time() - started
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return dict(scenario=name,
+                size=size,
+                failed=failed,
+                wall_time=round(wall_time, 4),
+                api_calls=sum(azure.calls.values()),
+                pages=azure.pages,
+                calls=dict(azure.calls),
+                peak_memory=peak_memory,
+                result_size=len(json.dumps(result, default=str)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--images', default='10,1000,10000,50000',
+                        help='comma separated image counts to benchmark the image scenarios with')
+    parser.add_argument('--disks', default='4,16',
+                        help='comma separated data disk counts to benchmark snapshots and replication with')
+    parser.add_argument('--page-size', type=int, default=100,
+                        help='number of items per listing page')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds slept for every API call and listing page')
+    parser.add_argument('--operation-latency', type=float, default=0.0,
+                        help='seconds a long-running operation takes to complete')
+    parser.add_argument('--snapshot-history', type=int, default=5,
+                        help='number of earlier snapshots every disk already has')
+    parser.add_argument('--populated-mb', type=int, default=8,
+                        help='MiB of data on every disk, the rest being unallocated')
+    parser.add_argument('--without-snapshot-api', dest='snapshot_api', action='store_false',
+                        help='run as with an azure-mgmt-compute release without compute API version {}'.format(
+                            SNAPSHOT_API_VERSION))
+    parser.add_argument('--scenario', action='append',
+                        help='only run the named scenario; may be given more than once')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON instead of a table')
+    args = parser.parse_args()
+
+    image_counts = [int(count) for count in args.images.split(',')]
+    disk_counts = [int(count) for count in args.disks.split(',')]
+
+    selected = set(args.scenario or [])
+    results = []
+    for images in image_counts:
+        for name, module_class, params in image_scenarios(images):
+            if not selected or name in selected:
+                results.append(measure(name, module_class, params, args, images, images=images))
+    for disks in disk_counts:
+        for name, module_class, params in disk_scenarios(disks):
+            if not selected or name in selected:
+                results.append(measure(name, module_class, params, args, disks, disks=disks))
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    print("{:<26} {:>7} {:>10} {:>9} {:>7} {:>12} {:>11}  {}".format(
+        'scenario', 'size', 'wall (s)', 'api calls', 'pages', 'peak mem (B)', 'result (B)', 'status'))
+    for result in results:
+        print("{scenario:<26} {size:>7} {wall_time:>10.4f} {api_calls:>9} {pages:>7} "
+              "{peak_memory:>12} {result_size:>11}  {status}".format(
+                  status='failed' if result['failed'] else 'ok', **result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Throttling benchmark for the request scheduling of the Azure image and
+snapshot modules.
+
+Image reads are sent from ``threads`` threads at once, the way concurrent
+operations of the modules send them, through a compute management client of
+the Azure SDK, to the resource manager of fake_arm limited to ``quota``
+requests per second, over real HTTPS connections.
+
+    python hacking/azure_bench/throttle_bench.py --requests 200 --threads 16 --quota 20
+
+The reads are sent with the retries of the SDK connections alone, which wait
+out the Retry-After of a throttled request on their own, and through the
+ClientProxy of the modules with a RequestScheduler. For both, the reads that
+succeeded and failed, the requests the resource manager received and
+throttled, the wall time and the reads per second are reported.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import argparse
+import json
+import os
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from fake_arm import FakeResourceManager
+
+REPO = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+import ansible.module_utils
+ansible.module_utils.__path__.insert(0, os.path.join(REPO, 'lib', 'ansible', 'module_utils'))
+from ansible.module_utils.azure_rm_client_proxy import ClientProxy
+from ansible.module_utils.azure_rm_throttle import RequestScheduler, RequestThrottle
+
+from azure.mgmt.compute import ComputeManagementClient
+from msrest.authentication import BasicTokenAuthentication
+
+SUBSCRIPTION_ID = '00000000-0000-0000-0000-000000000000'
+
+
+def read_images(client, requests, threads, images):
+    def read(i):
+        index = i % images
+        try:
+            client.images.get('rg{}'.format(index % 10), 'image{}'.format(index))
+            return None
+        except Exception as e:
+            return str(e).splitlines()[0]
+
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(read, range(requests))
+    finally:
+        pool.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200,
+                        help='number of image reads to send')
+    parser.add_argument('--threads', type=int, default=16,
+                        help='number of reads sent at the same time')
+    parser.add_argument('--quota', type=float, default=20,
+                        help='requests per second the fake resource manager allows')
+    parser.add_argument('--quota-burst', type=int, default=20,
+                        help='requests the fake resource manager allows at once')
+    parser.add_argument('--request-rate', type=float,
+                        help='request_rate of the scheduler, unlimited by default')
+    parser.add_argument('--request-burst', type=int, default=10,
+                        help='request_burst of the scheduler')
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds the fake resource manager takes to answer')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON instead of a table')
+    args = parser.parse_args()
+
+    results = []
+    for scheduled in (False, True):
+        with FakeResourceManager(images=10, arm_latency=args.latency, quota=args.quota,
+                                 quota_burst=args.quota_burst) as arm:
+            os.environ['REQUESTS_CA_BUNDLE'] = arm.certificate_path
+            client = ComputeManagementClient(BasicTokenAuthentication(dict(access_token='bench-token')),
+                                             SUBSCRIPTION_ID, base_url=arm.url)
+            throttle = None
+            if scheduled:
+                throttle = RequestThrottle(args.request_rate, args.request_burst)
+                client = ClientProxy(client, scheduler=RequestScheduler(throttle))
+            started = time.time()
+            errors = read_images(client, args.requests, args.threads, arm.images)
+            elapsed = time.time() - started
+            failures = [error for error in errors if error]
+            results.append(dict(scheduler=scheduled,
+                                reads=args.requests,
+                                succeeded=args.requests - len(failures),
+                                failed=len(failures),
+                                arm_requests=arm.arm_requests,
+                                throttled=arm.throttled,
+                                wall_time=round(elapsed, 4),
+                                reads_per_second=round((args.requests - len(failures)) / elapsed, 2),
+                                quota=args.quota,
+                                final_rate=throttle.state()['rate'] if throttle else None,
+                                failures=sorted(set(failures))))
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    print("{:<10} {:>6} {:>10} {:>7} {:>13} {:>10} {:>14} {:>10} {:>7}".format(
+        'scheduler', 'reads', 'succeeded', 'failed', 'ARM requests', 'throttled', 'wall time (s)', 'reads/s',
+        'quota'))
+    for result in results:
+        print("{scheduler!s:<10} {reads:>6} {succeeded:>10} {failed:>7} {arm_requests:>13} {throttled:>10} "
+              "{wall_time:>14.4f} {reads_per_second:>10.2f} {quota:>7}".format(**result))
+        for failure in result['failures'][:3]:
+            print("  failed: {}".format(failure))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Authentication benchmark for the token_cache option of the Azure image and
+snapshot modules.
+
+Every task is a fresh interpreter running azure_rm_image_operation with no
+tokens, through the real AzureRMModuleBase start-up and service principal
+authentication, against the local token endpoint of fake_token.
+
+    python hacking/azure_bench/token_bench.py --tasks 10 --latency 0.2
+
+The tasks are run once with token_cache off and once on, and for both the
+number of token requests made, the cache status reported by every task and
+the median seconds a task spent starting up are reported.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from fake_token import FakeTokenEndpoint
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+REPO = os.path.abspath(os.path.join(HERE, '..', '..'))
+
+# Run in the child interpreter: argv holds the token endpoint url and the JSON
+# of the module parameters, and a JSON line of measurements is printed.
+PROBE = r'''
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+repo, here, url, params = sys.argv[1], sys.argv[2], sys.argv[3], json.loads(sys.argv[4])
+
+import ansible.module_utils
+ansible.module_utils.__path__.insert(0, os.path.join(repo, 'lib', 'ansible', 'module_utils'))
+from ansible.module_utils import basic
+basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=params)).encode('utf-8')
+
+sys.path.insert(0, here)
+from fake_token import bench_cloud
+from msrestazure import azure_cloud
+azure_cloud.ANSIBLE_BENCH_CLOUD = bench_cloud(url)
+
+import importlib.util
+spec = importlib.util.spec_from_file_location('azure_rm_image_operation',
+                                              os.path.join(repo, 'lib', 'ansible', 'modules', 'cloud', 'azure',
+                                                           'azure_rm_image_operation.py'))
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+
+output = io.StringIO()
+started = time.time()
+with contextlib.redirect_stdout(output):
+    try:
+        module.main()
+    except SystemExit:
+        pass
+elapsed = time.time() - started
+result = json.loads(output.getvalue())
+print(json.dumps(dict(elapsed=elapsed, failed=result.get('failed', False), msg=result.get('msg'),
+                      token_cache=result.get('token_cache'))))
+'''
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def probe(python, url, params):
+    output = subprocess.check_output([python, '-W', 'ignore', '-c', PROBE, REPO, HERE, url, json.dumps(params)])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=10,
+                        help='number of tasks to run with the cache off and on')
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='seconds the fake token endpoint takes to answer')
+    parser.add_argument('--lifetime', type=int, default=3600,
+                        help='seconds the tokens issued stay valid')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to run the tasks with')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON instead of a table')
+    args = parser.parse_args()
+
+    cache_path = tempfile.mkdtemp(prefix='ansible-token-bench-')
+    params = dict(tokens=[],
+                  client_id='00000000-0000-0000-0000-00000000c11e',
+                  secret='bench-secret',
+                  tenant='00000000-0000-0000-0000-0000000be7c4',
+                  subscription_id='00000000-0000-0000-0000-000000000000',
+                  cloud_environment='AnsibleBench',
+                  cert_validation_mode='ignore',
+                  token_cache_path=cache_path)
+
+    results = []
+    try:
+        for token_cache in (False, True):
+            with FakeTokenEndpoint(lifetime=args.lifetime, latency=args.latency) as endpoint:
+                samples = [probe(args.python, endpoint.url, dict(params, token_cache=token_cache))
+                           for _ in range(args.tasks)]
+                requests = endpoint.requests
+            failures = [sample['msg'] for sample in samples if sample['failed']]
+            results.append(dict(token_cache=token_cache,
+                                tasks=args.tasks,
+                                token_requests=requests,
+                                statuses=[sample['token_cache'] for sample in samples],
+                                task_time=round(median([sample['elapsed'] for sample in samples]), 4),
+                                first_task_time=round(samples[0]['elapsed'], 4),
+                                failures=failures))
+    finally:
+        shutil.rmtree(cache_path, ignore_errors=True)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    print("{:<12} {:>6} {:>15} {:>14} {:>15}  {}".format(
+        'token_cache', 'tasks', 'token requests', 'first task (s)', 'median task (s)', 'cache status per task'))
+    for result in results:
+        print("{token_cache!s:<12} {tasks:>6} {token_requests:>15} {first_task_time:>14.4f} {task_time:>15.4f}  "
+              "{statuses}".format(**dict(result,
+                                         statuses=', '.join(str(status) for status in result['statuses'])
+                                         if not result['failures'] else 'failed: ' + result['failures'][0])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Per-task overhead benchmark for the worker option of the Azure image and
+snapshot modules.
+
+Every task is a fresh interpreter running azure_rm_image_facts as a script,
+the way AnsiballZ runs it, looking up one image by resource group and name
+with service principal credentials, against the token endpoint and resource
+manager of fake_arm, over real HTTPS connections.
+
+    python hacking/azure_bench/worker_bench.py --tasks 20 --forks 5
+
+The tasks are run with the worker option off and on, ``forks`` at a time like
+the forks of a play. For both, the median and slowest wall time of a task,
+interpreter start included, are reported along with the token and resource
+manager requests and the connections made over all tasks.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import argparse
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from multiprocessing.pool import ThreadPool
+
+from fake_arm import FakeResourceManager
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+REPO = os.path.abspath(os.path.join(HERE, '..', '..'))
+MODULE = os.path.join(REPO, 'lib', 'ansible', 'modules', 'cloud', 'azure', 'azure_rm_image_facts.py')
+
+# Run in the child interpreter: argv holds the module path and the JSON of its
+# arguments. The module prints its result and exits, as it does under Ansible.
+PROBE = r'''
+import json
+import os
+import runpy
+import sys
+
+repo, module, args = sys.argv[1], sys.argv[2], sys.argv[3]
+
+import ansible.module_utils
+ansible.module_utils.__path__.insert(0, os.path.join(repo, 'lib', 'ansible', 'module_utils'))
+from ansible.module_utils import basic
+basic._ANSIBLE_ARGS = json.dumps(dict(ANSIBLE_MODULE_ARGS=json.loads(args))).encode('utf-8')
+
+# Ansible 2.9 predates Python 3.11, which dropped inspect.getargspec.
+import inspect
+if not hasattr(inspect, 'getargspec'):
+    inspect.getargspec = inspect.getfullargspec
+
+# azure-mgmt-compute 5.0 and later no longer have the VERSION the version check
+# of AzureRMModuleBase reads from their client module; it is added back on
+# import, so that tasks not importing the SDK do not pay for it.
+import importlib.abc
+import importlib.util
+
+class ComputeVersion(importlib.abc.MetaPathFinder):
+    def find_spec(self, name, path, target=None):
+        if name != 'azure.mgmt.compute._compute_management_client':
+            return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(name)
+        exec_module = spec.loader.exec_module
+
+        def exec_with_version(module):
+            exec_module(module)
+            from azure.mgmt.compute.version import VERSION
+            module.VERSION = VERSION
+        spec.loader.exec_module = exec_with_version
+        return spec
+
+sys.meta_path.insert(0, ComputeVersion())
+
+runpy.run_path(module, run_name='__main__')
+'''
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def run_task(python, params, environment):
+    started = time.time()
+    process = subprocess.Popen([python, '-c', PROBE, REPO, MODULE, json.dumps(params)],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=environment)
+    output, errors = process.communicate()
+    elapsed = time.time() - started
+    lines = [line for line in output.decode('utf-8').splitlines() if line.strip()]
+    try:
+        result = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        result = dict(failed=True, msg=errors.decode('utf-8').strip().splitlines()[-1:])
+    return dict(elapsed=elapsed, rc=process.returncode, result=result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=20,
+                        help='number of tasks to run with the worker off and on')
+    parser.add_argument('--forks', type=int, default=5,
+                        help='number of tasks run at the same time')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='seconds the fake token endpoint and resource manager take to answer')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to run the tasks with')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON instead of a table')
+    args = parser.parse_args()
+
+    worker_path = tempfile.mkdtemp(prefix='ansible-worker-bench-')
+    params = dict(name='image3',
+                  resource_group='rg3',
+                  client_id='00000000-0000-0000-0000-00000000c11e',
+                  secret='bench-secret',
+                  tenant='00000000-0000-0000-0000-0000000be7c4',
+                  subscription_id='00000000-0000-0000-0000-000000000000',
+                  worker_path=worker_path,
+                  worker_idle_timeout=30)
+
+    results = []
+    workers = set()
+    try:
+        for worker in (False, True):
+            with FakeResourceManager(images=10, latency=args.latency, arm_latency=args.latency) as arm:
+                environment = dict(os.environ, REQUESTS_CA_BUNDLE=arm.certificate_path)
+                task_params = dict(params, worker=worker, cloud_environment=arm.url)
+                pool = ThreadPool(args.forks)
+                try:
+                    tasks = pool.map(lambda i: run_task(args.python, task_params, environment), range(args.tasks))
+                finally:
+                    pool.close()
+                counts = dict(token_requests=arm.requests, arm_requests=arm.arm_requests,
+                              connections=arm.connections)
+            failures = [task['result'].get('msg') for task in tasks if task['rc'] or task['result'].get('failed')]
+            workers.update(task['result']['worker']['pid'] for task in tasks
+                           if 'pid' in task['result'].get('worker', {}))
+            elapsed = [task['elapsed'] for task in tasks]
+            results.append(dict(counts,
+                                worker=worker,
+                                tasks=args.tasks,
+                                median_task=round(median(elapsed), 4),
+                                slowest_task=round(max(elapsed), 4),
+                                workers=len(set(task['result'].get('worker', {}).get('pid') for task in tasks
+                                                if task['result'].get('worker'))),
+                                failures=failures))
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+        shutil.rmtree(worker_path, ignore_errors=True)
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
+
+    print("{:<7} {:>6} {:>16} {:>17} {:>15} {:>13} {:>12} {:>8}".format(
+        'worker', 'tasks', 'median task (s)', 'slowest task (s)', 'token requests', 'ARM requests', 'connections',
+        'workers'))
+    for result in results:
+        print("{worker!s:<7} {tasks:>6} {median_task:>16.4f} {slowest_task:>17.4f} {token_requests:>15} "
+              "{arm_requests:>13} {connections:>12} {workers:>8}".format(**result))
+        for failure in result['failures'][:3]:
+            print("  failed: {}".format(failure))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,331 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import threading
+import time
+
+from ansible.module_utils.azure_rm_throttle import THROTTLE_ARGS, RequestScheduler, shared_throttle
+
+CLIENT_PROXY_ARGS = dict(
+    diagnostics=dict(
+        type='bool',
+        required=False,
+        default=False
+    )
+)
+
+
+class CallMetrics(object):
+    """
+    Thread-safe record of the SDK calls made during one module run.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def start(self, call):
+        entry = dict(call=call, duration=0.0)
+        with self._lock:
+            self.calls.append(entry)
+        return entry
+
+    def add(self, entry, key, value):
+        with self._lock:
+            entry[key] = entry.get(key, 0) + value
+
+    def summary(self):
+        with self._lock:
+            calls = [dict(entry, duration=round(entry['duration'], 4)) for entry in self.calls]
+        totals = dict()
+        for entry in calls:
+            total = totals.setdefault(entry['call'], dict(count=0, duration=0.0))
+            total['count'] += 1
+            total['duration'] = round(total['duration'] + entry['duration'], 4)
+        return dict(calls=calls,
+                    totals=totals,
+                    total_calls=len(calls),
+                    total_pages=sum(entry.get('pages', 0) for entry in calls),
+                    total_polls=sum(entry.get('polls', 0) for entry in calls),
+                    total_throttle_retries=sum(entry.get('throttle_retries', 0) for entry in calls),
+                    total_throttle_wait=round(sum(entry.get('throttle_wait', 0.0) for entry in calls), 4),
+                    wall_time=round(time.time() - self.started, 4))
+
+
+class _InstrumentedPaged(object):
+    """
+    Iterator over an SDK listing that adds every page fetch to its metrics entry.
+    """
+
+    def __init__(self, paged, metrics, entry):
+        self._paged = paged
+        self._metrics = metrics
+        self._entry = entry
+        metrics.add(entry, 'pages', 0)
+        advance_page = getattr(paged, 'advance_page', None)
+        if advance_page is not None:
+            # The pager calls self.advance_page() whenever a page is used up, so
+            # shadowing the bound method on the instance sees every page request.
+            def counted_advance_page():
+                started = time.time()
+                try:
+                    return advance_page()
+                finally:
+                    metrics.add(entry, 'duration', time.time() - started)
+                    metrics.add(entry, 'pages', 1)
+            paged.advance_page = counted_advance_page
+
+    def __iter__(self):
+        return iter(self._paged)
+
+    def __getattr__(self, name):
+        return getattr(self._paged, name)
+
+
+class _InstrumentedPoller(object):
+    """
+    Poller wrapper that counts status requests and records how long the
+    operation took once it is seen to be done.
+    """
+
+    def __init__(self, poller, metrics, entry):
+        self._poller = poller
+        self._metrics = metrics
+        self._entry = entry
+        self._started = time.time()
+        self._counts_server_polls = False
+        polling_method = getattr(poller, '_polling_method', None)
+        update_status = getattr(polling_method, 'update_status', None)
+        if update_status is not None:
+            def counted_update_status():
+                metrics.add(entry, 'polls', 1)
+                return update_status()
+            polling_method.update_status = counted_update_status
+            self._counts_server_polls = True
+        metrics.add(entry, 'polls', 0)
+
+    def _check(self, done):
+        if not self._counts_server_polls:
+            self._metrics.add(self._entry, 'polls', 1)
+        if done and 'operation_duration' not in self._entry:
+            self._metrics.add(self._entry, 'operation_duration', round(time.time() - self._started, 4))
+        return done
+
+    def done(self):
+        return self._check(self._poller.done())
+
+    def wait(self, *args, **kwargs):
+        self._poller.wait(*args, **kwargs)
+        self._check(self._poller.done())
+
+    def result(self, *args, **kwargs):
+        result = self._poller.result(*args, **kwargs)
+        self._check(True)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self._poller, name)
+
+
+class _OperationGroupProxy(object):
+    def __init__(self, operations, group, proxy, memoized=False):
+        self._operations = operations
+        self._group = group
+        self._proxy = proxy
+        self._memoized = memoized
+
+    def __getattr__(self, name):
+        attr = getattr(self._operations, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        return self._proxy.wrap_call(attr, self._group, name, memoized=self._memoized)
+
+
+class _MemoizedView(object):
+    def __init__(self, proxy):
+        self._proxy = proxy
+
+    def __getattr__(self, name):
+        return self._proxy.operation_group(name, memoized=True)
+
+
+class ClientProxy(object):
+    """
+    Proxy for an SDK management client that passes every operation call of its
+    operation groups (``client.images.get`` and the like) through ``wrap_call``.
+
+    With ``metrics``, every call is timed, and listings and long-running
+    operations returned by those calls stay observed until they have been fully
+    consumed or have finished. With ``memoize``, the result of a ``get`` made
+    through ``memoized`` (``proxy.memoized.images.get``) is kept for the
+    lifetime of the proxy and returned for identical later calls made the same
+    way; any other call on the same operation group, which may change what
+    ``get`` would return, drops the results kept for that group. Gets made
+    directly always reach Azure, so that status reads see changes. With
+    ``scheduler``, a RequestScheduler, calls and the page requests of listings
+    are paced and sent again when throttled.
+    """
+
+    def __init__(self, client, metrics=None, memoize=False, scheduler=None):
+        self._client = client
+        self._metrics = metrics
+        self._memo = dict() if memoize else None
+        self._memo_lock = threading.Lock()
+        self._groups = dict()
+        self._scheduler = scheduler
+        if scheduler is not None:
+            scheduler.attach(client)
+
+    def _send(self, method, args, kwargs, record=None):
+        if self._scheduler is None:
+            return method(*args, **kwargs)
+        result = self._scheduler.call(method, args, kwargs, record=record)
+        if hasattr(result, 'advance_page'):
+            self._scheduler.wrap_paged(result)
+        return result
+
+    def _instrumented(self, method, call, args, kwargs):
+        metrics = self._metrics
+        if metrics is None:
+            return self._send(method, args, kwargs)
+
+        entry = metrics.start(call)
+        started = time.time()
+        try:
+            result = self._send(method, args, kwargs, record=lambda key, value: metrics.add(entry, key, value))
+        finally:
+            metrics.add(entry, 'duration', time.time() - started)
+        if hasattr(result, 'done') and hasattr(result, 'result'):
+            return _InstrumentedPoller(result, metrics, entry)
+        if hasattr(result, 'advance_page'):
+            return _InstrumentedPaged(result, metrics, entry)
+        return result
+
+    def wrap_call(self, method, group, name, memoized=False):
+        call = "{}.{}".format(group, name)
+
+        def proxied(*args, **kwargs):
+            if self._memo is None:
+                return self._instrumented(method, call, args, kwargs)
+
+            if name != 'get':
+                with self._memo_lock:
+                    for key in [key for key in self._memo if key[0] == group]:
+                        del self._memo[key]
+                return self._instrumented(method, call, args, kwargs)
+
+            if not memoized:
+                return self._instrumented(method, call, args, kwargs)
+
+            key = (group, repr(args), repr(sorted(kwargs.items())))
+            with self._memo_lock:
+                if key in self._memo:
+                    if self._metrics is not None:
+                        self._metrics.start(call)['memoized'] = True
+                    return self._memo[key]
+            result = self._instrumented(method, call, args, kwargs)
+            with self._memo_lock:
+                self._memo[key] = result
+            return result
+
+        return proxied
+
+    @property
+    def memoized(self):
+        """
+        The operation groups of the client, with gets returning the result kept
+        from an identical earlier get, for reads whose result cannot change
+        within the module run unless the module itself changes it.
+        """
+        return _MemoizedView(self)
+
+    def operation_group(self, name, memoized=False):
+        attr = getattr(self._client, name)
+        if not type(attr).__name__.endswith('Operations'):
+            return attr
+        key = (name, memoized)
+        if key not in self._groups:
+            self._groups[key] = _OperationGroupProxy(attr, name, self, memoized=memoized)
+        return self._groups[key]
+
+    def __getattr__(self, name):
+        return self.operation_group(name)
+
+
+class ClientProxyMixin(object):
+    """
+    Mixin for AzureRMModuleBase subclasses that routes the compute and resource
+    management clients through a ClientProxy for the duration of the module
+    run, memoizing the reads made through its ``memoized`` view. With the
+    diagnostics option set the proxy also collects call metrics, which are
+    added to the module result.
+
+    Calls are scheduled through the RequestThrottle the process shares for the
+    subscription, configured by the THROTTLE_ARGS options.
+    """
+
+    _client_proxies = None
+    _call_metrics = None
+    _request_scheduler = None
+
+    @property
+    def call_metrics(self):
+        if self._call_metrics is None:
+            self._call_metrics = CallMetrics()
+        return self._call_metrics
+
+    @property
+    def request_scheduler(self):
+        if self._request_scheduler is None:
+            options = dict((key, getattr(self, key, spec.get('default'))) for key, spec in THROTTLE_ARGS.items())
+            throttle = shared_throttle(self.subscription_id, options['request_rate'], options['request_burst'])
+            self._request_scheduler = RequestScheduler(throttle,
+                                                       retries=options['throttle_retries'],
+                                                       max_delay=options['throttle_max_delay'])
+        return self._request_scheduler
+
+    def proxy_client(self, client):
+        if self._client_proxies is None:
+            self._client_proxies = dict()
+        key = id(client)
+        if key not in self._client_proxies:
+            metrics = self.call_metrics if getattr(self, 'diagnostics', False) else None
+            self._client_proxies[key] = ClientProxy(client, metrics=metrics, memoize=True,
+                                                    scheduler=self.request_scheduler)
+        return self._client_proxies[key]
+
+    @property
+    def compute_client(self):
+        return self.proxy_client(super(ClientProxyMixin, self).compute_client)
+
+    @property
+    def rm_client(self):
+        return self.proxy_client(super(ClientProxyMixin, self).rm_client)
+
+    def add_metrics(self, results):
+        if getattr(self, 'diagnostics', False):
+            results['metrics'] = self.call_metrics.summary()
+            if self._request_scheduler is not None:
+                results['metrics']['throttle'] = self._request_scheduler.throttle.state()
+        return results
+
+    def fail(self, msg, **kwargs):
+        self.add_metrics(kwargs)
+        super(ClientProxyMixin, self).fail(msg, **kwargs)
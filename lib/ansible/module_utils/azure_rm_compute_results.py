@@ -0,0 +1,72 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+
+def _enum_value(value):
+    return getattr(value, 'value', value)
+
+
+def _timestamp(value):
+    return value.isoformat() if value is not None else None
+
+
+def vm_disk_to_dict(disk):
+    managed_disk = disk.managed_disk
+    return dict(name=disk.name,
+                lun=getattr(disk, 'lun', None),
+                id=managed_disk.id if managed_disk else None,
+                storage_account_type=_enum_value(managed_disk.storage_account_type) if managed_disk else None,
+                vhd=disk.vhd.uri if getattr(disk, 'vhd', None) else None,
+                caching=_enum_value(disk.caching),
+                disk_size_gb=disk.disk_size_gb)
+
+
+def vm_to_dict(vm):
+    storage_profile = vm.storage_profile
+    return dict(name=vm.name,
+                id=vm.id,
+                location=vm.location,
+                vm_size=_enum_value(vm.hardware_profile.vm_size) if vm.hardware_profile else None,
+                os_type=_enum_value(storage_profile.os_disk.os_type),
+                provisioning_state=vm.provisioning_state,
+                os_disk=vm_disk_to_dict(storage_profile.os_disk),
+                data_disks=[vm_disk_to_dict(disk) for disk in storage_profile.data_disks or []],
+                tags=vm.tags)
+
+
+def snapshot_to_dict(snapshot):
+    return dict(name=snapshot.name,
+                id=snapshot.id,
+                location=snapshot.location,
+                source_resource_id=snapshot.creation_data.source_resource_id,
+                incremental=getattr(snapshot, 'incremental', None),
+                disk_size_gb=snapshot.disk_size_gb,
+                time_created=_timestamp(snapshot.time_created),
+                provisioning_state=snapshot.provisioning_state,
+                tags=snapshot.tags)
+
+
+def select_fields(result, fields):
+    """
+    Reduce a result dict to the requested keys. The name is always kept so that
+    entries in a list can still be told apart.
+    """
+    if not fields:
+        return result
+    return dict((key, value) for key, value in result.items() if key in fields or key == 'name')
@@ -0,0 +1,327 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import fcntl
+import fnmatch
+import hashlib
+import json
+import os
+import re
+import tempfile
+import time
+
+IMAGE_CACHE_ARGS = dict(
+    inventory_cache_ttl=dict(
+        type='int',
+        required=False,
+        default=0
+    ),
+    inventory_cache_path=dict(
+        type='path',
+        required=False,
+        default='~/.ansible/azure_image_cache'
+    ),
+    etag_revalidation=dict(
+        type='bool',
+        required=False,
+        default=False
+    )
+)
+
+LOOKUP_FETCHED = 'fetched'
+LOOKUP_REVALIDATED = 'revalidated'
+
+
+def image_to_dict(image):
+    return dict(name=image.name,
+                location=image.location,
+                resource_group=image.id.split("/")[4],
+                managed=(not (image.storage_profile.os_disk.managed_disk is None)),
+                tags=image.tags
+                )
+
+
+def iter_images(compute_client, resource_group=None):
+    """
+    Yield images one at a time. The SDK fetches the next page of the listing only
+    when the previous one is exhausted, so a caller that stops early never pulls
+    the remaining pages.
+    """
+    images = compute_client.images
+    if resource_group:
+        image_list = images.list_by_resource_group(resource_group_name=resource_group)
+    else:
+        image_list = images.list()
+    for image in image_list:
+        yield image_to_dict(image)
+
+
+class ImageFilter(object):
+    """
+    Selection of images by name, name pattern, resource group and tags, applied
+    to a stream of image dicts as returned by iter_images.
+
+    ``names`` are looked up in hashed sets, so the cost per image does not grow
+    with the number of names asked for. A name may be given as
+    ``resource_group/name`` to match only the image in that group. ``pattern``
+    is a shell-style glob matched against the whole name, or a regular
+    expression searched for in the name with ``pattern_type`` set to ``regex``.
+    ``tags`` is a list of ``key`` or ``key:value`` strings, or a dict of tag
+    values, which must all be present on an image.
+    """
+
+    def __init__(self, names=None, pattern=None, pattern_type='glob', resource_group=None, tags=None):
+        self.names = set()
+        self.group_names = set()
+        for name in names or []:
+            if '/' in name:
+                group, name = name.split('/', 1)
+                self.group_names.add((group.lower(), name))
+            else:
+                self.names.add(name)
+        self.pattern_text = pattern
+        self.pattern_type = pattern_type
+        if pattern is None:
+            self.pattern = None
+        elif pattern_type == 'regex':
+            self.pattern = re.compile(pattern).search
+        else:
+            self.pattern = re.compile(fnmatch.translate(pattern)).match
+        self.resource_group = resource_group.lower() if resource_group else None
+        self.tags = []
+        if isinstance(tags, dict):
+            for key, value in sorted(tags.items()):
+                self.tags.append((key, None if value is None else str(value)))
+        else:
+            for tag in tags or []:
+                key, sep, value = tag.partition(':')
+                self.tags.append((key, value if sep else None))
+
+    @property
+    def exact(self):
+        """
+        True when only exact names were asked for, every one of them qualified
+        with its resource group, so that a listing can be abandoned once they
+        have all been found.
+        """
+        return bool(self.group_names) and not self.names and self.pattern is None
+
+    def matches(self, image):
+        group = image['resource_group'].lower()
+        if self.resource_group is not None and group != self.resource_group:
+            return False
+        if (self.names or self.group_names) and not (image['name'] in self.names or
+                                                     (group, image['name']) in self.group_names):
+            return False
+        if self.pattern is not None and not self.pattern(image['name']):
+            return False
+        if self.tags:
+            image_tags = image.get('tags') or dict()
+            for key, value in self.tags:
+                if key not in image_tags or (value is not None and image_tags[key] != value):
+                    return False
+        return True
+
+    def filter(self, images):
+        """
+        Yield the matching images of ``images`` in a single pass. With exact,
+        group-qualified names the stream is abandoned as soon as all of them
+        have been seen.
+        """
+        wanted = set(self.group_names) if self.exact else None
+        for image in images:
+            if self.matches(image):
+                yield image
+                if wanted is not None:
+                    wanted.discard((image['resource_group'].lower(), image['name']))
+                    if not wanted:
+                        return
+
+
+class ImageInventoryCache(object):
+    """
+    On-disk cache of image listings, keyed by subscription and resource group.
+
+    Entries expire after ``ttl`` seconds; a ttl of 0 disables the cache. Each
+    entry is guarded by an exclusive file lock while it is being refreshed, so
+    parallel forks asking for the same listing wait for the first one to fetch
+    it instead of all listing the subscription themselves.
+    """
+
+    ALL_GROUPS = '*'
+
+    def __init__(self, path, ttl):
+        self.path = os.path.expanduser(path) if path else None
+        self.ttl = ttl or 0
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and self.path is not None
+
+    def _entry_path(self, subscription_id, resource_group):
+        key = "{}/{}".format(subscription_id, (resource_group or self.ALL_GROUPS).lower())
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _lock(self, entry_path):
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path, 0o700)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        lock_file = open(entry_path + '.lock', 'a')
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _read(self, entry_path):
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if time.time() - entry.get('timestamp', 0) > self.ttl:
+            return None
+        return entry.get('images')
+
+    def _write(self, entry_path, images):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(timestamp=time.time(), images=images), f)
+        os.rename(tmp_path, entry_path)
+
+    def get_or_fetch(self, subscription_id, resource_group, fetch):
+        """
+        Return the cached listing for the subscription and resource group, or
+        call ``fetch`` and store its result when there is no fresh entry. With the
+        cache disabled the iterable returned by ``fetch`` is passed through as is,
+        so streaming listings stay lazy.
+        """
+        if not self.enabled:
+            return fetch()
+
+        entry_path = self._entry_path(subscription_id, resource_group)
+        lock_file = self._lock(entry_path)
+        try:
+            images = self._read(entry_path)
+            if images is None:
+                images = list(fetch())
+                self._write(entry_path, images)
+            return images
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def invalidate(self, subscription_id, resource_group=None):
+        """
+        Drop the cached listing of a resource group after a write to it, together
+        with the subscription-wide listing that includes it.
+        """
+        if not self.enabled:
+            return
+
+        groups = set([None, resource_group])
+        for group in groups:
+            entry_path = self._entry_path(subscription_id, group)
+            lock_file = self._lock(entry_path)
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+
+
+class ImageETagCache(object):
+    """
+    On-disk store of single images together with the ETag they were served
+    with, keyed by subscription, resource group and name. Entries never
+    expire: they are only ever used to revalidate the image with the service.
+    """
+
+    def __init__(self, path, enabled):
+        self.path = os.path.join(os.path.expanduser(path), 'etags') if path else None
+        self.enabled = bool(enabled) and self.path is not None
+
+    def _entry_path(self, subscription_id, resource_group, name):
+        key = "{}/{}/{}".format(subscription_id, resource_group.lower(), name)
+        return os.path.join(self.path, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, subscription_id, resource_group, name):
+        if not self.enabled:
+            return None
+        try:
+            with open(self._entry_path(subscription_id, resource_group, name)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def put(self, subscription_id, resource_group, name, etag, image):
+        if not self.enabled:
+            return
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path, 0o700)
+            except OSError:
+                if not os.path.isdir(self.path):
+                    raise
+        fd, tmp_path = tempfile.mkstemp(dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dict(etag=etag, image=image), f)
+        os.rename(tmp_path, self._entry_path(subscription_id, resource_group, name))
+
+    def drop(self, subscription_id, resource_group, name):
+        if not self.enabled:
+            return
+        try:
+            os.remove(self._entry_path(subscription_id, resource_group, name))
+        except OSError:
+            pass
+
+
+def get_image(compute_client, etag_cache, subscription_id, resource_group, name):
+    """
+    Fetch a single image as an image_to_dict dict, revalidating a stored copy
+    when there is one.
+
+    With a stored ETag the request carries If-None-Match, and a 304 answer,
+    which has no body, returns the stored copy. Returns the image and either
+    LOOKUP_REVALIDATED or LOOKUP_FETCHED. A missing image raises the 404
+    CloudError of the SDK, as a plain get does.
+    """
+    entry = etag_cache.get(subscription_id, resource_group, name)
+    headers = {'If-None-Match': entry['etag']} if entry else None
+    try:
+        response = compute_client.images.get(resource_group_name=resource_group, image_name=name,
+                                             custom_headers=headers, raw=True)
+    except Exception as e:
+        status_code = getattr(e, 'status_code', None)
+        if entry is not None and status_code == 304:
+            return entry['image'], LOOKUP_REVALIDATED
+        if status_code == 404:
+            etag_cache.drop(subscription_id, resource_group, name)
+        raise
+
+    image = image_to_dict(response.output)
+    etag = response.response.headers.get('ETag') if response.response is not None else None
+    if etag:
+        etag_cache.put(subscription_id, resource_group, name, etag, image)
+    else:
+        etag_cache.drop(subscription_id, resource_group, name)
+    return image, LOOKUP_FETCHED
@@ -0,0 +1,239 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from ansible.module_utils.azure_rm_image_common import image_to_dict
+
+IMAGE_INDEX_ARGS = dict(
+    image_index_path=dict(
+        type='path',
+        required=False
+    ),
+    image_index_ttl=dict(
+        type='int',
+        required=False,
+        default=300
+    )
+)
+
+ALL_GROUPS = '*'
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS images (
+        id TEXT PRIMARY KEY,
+        subscription_id TEXT NOT NULL,
+        group_key TEXT NOT NULL,
+        name TEXT NOT NULL,
+        resource_group TEXT NOT NULL,
+        location TEXT,
+        managed INTEGER,
+        tags TEXT,
+        source_vm TEXT,
+        provisioning_state TEXT,
+        marker TEXT NOT NULL,
+        first_seen REAL NOT NULL,
+        updated REAL NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS images_by_name ON images (subscription_id, name)",
+    "CREATE INDEX IF NOT EXISTS images_by_group ON images (subscription_id, group_key, name)",
+    "CREATE INDEX IF NOT EXISTS images_by_source_vm ON images (source_vm)",
+    """CREATE TABLE IF NOT EXISTS image_tags (
+        id TEXT NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+        key TEXT NOT NULL,
+        value TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS image_tags_by_key ON image_tags (key, value)",
+    "CREATE INDEX IF NOT EXISTS image_tags_by_id ON image_tags (id)",
+    """CREATE TABLE IF NOT EXISTS refreshes (
+        subscription_id TEXT NOT NULL,
+        scope TEXT NOT NULL,
+        refreshed REAL NOT NULL,
+        PRIMARY KEY (subscription_id, scope)
+    )""",
+]
+
+
+def image_record(image):
+    """
+    Everything the index keeps about an SDK image: the fields of image_to_dict
+    plus the id, source VM and provisioning state, and a change marker that
+    differs whenever any of them does.
+    """
+    record = image_to_dict(image)
+    source_vm = getattr(image, 'source_virtual_machine', None)
+    record.update(id=image.id.lower(),
+                  source_vm=source_vm.id.lower() if source_vm is not None and source_vm.id else None,
+                  provisioning_state=getattr(image, 'provisioning_state', None))
+    record['marker'] = hashlib.sha1(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+    return record
+
+
+class ImageIndex(object):
+    """
+    SQLite index of image listings, kept per subscription.
+
+    A refresh still reads the image listing, as the compute API has no change
+    feed, but only rows whose change marker differs are written and ids that
+    disappeared are dropped, so an unchanged subscription costs no writes.
+    Between refreshes, which happen at most every ``ttl`` seconds per scope,
+    lookups are answered from the indexed tables alone.
+    """
+
+    def __init__(self, path, ttl):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl or 0
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, 0o700)
+        self.connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    def is_fresh(self, subscription_id, resource_group=None):
+        """
+        True when the scope, or the whole subscription, was refreshed less than
+        ``ttl`` seconds ago.
+        """
+        scopes = [ALL_GROUPS] + ([resource_group.lower()] if resource_group else [])
+        row = self.connection.execute(
+            "SELECT MAX(refreshed) FROM refreshes WHERE subscription_id = ? AND scope IN ({})".format(
+                ", ".join("?" * len(scopes))),
+            [subscription_id] + scopes).fetchone()
+        return row[0] is not None and time.time() - row[0] < self.ttl
+
+    def refresh(self, subscription_id, resource_group, images):
+        """
+        Bring the rows of a subscription, or of one resource group of it, in line
+        with ``images``, an iterable of SDK images. Returns counts of the rows
+        added, updated, removed and left unchanged.
+        """
+        scope = resource_group.lower() if resource_group else ALL_GROUPS
+        query = "SELECT id, marker, first_seen FROM images WHERE subscription_id = ?"
+        params = [subscription_id]
+        if resource_group:
+            query += " AND group_key = ?"
+            params.append(scope)
+
+        known = dict()
+        first_seen = dict()
+        for image_id, marker, seen_at in self.connection.execute(query, params):
+            known[image_id] = marker
+            first_seen[image_id] = seen_at
+
+        # The listing is diffed before the write lock is taken, so that other
+        # processes can keep querying the index while pages are being fetched.
+        now = time.time()
+        stats = dict(added=0, updated=0, removed=0, unchanged=0)
+        seen = set()
+        changed = []
+        for image in images:
+            record = image_record(image)
+            seen.add(record['id'])
+            marker = known.get(record['id'])
+            if marker == record['marker']:
+                stats['unchanged'] += 1
+                continue
+            stats['added' if marker is None else 'updated'] += 1
+            changed.append(record)
+        removed = [image_id for image_id in known if image_id not in seen]
+        stats['removed'] = len(removed)
+
+        cursor = self.connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Changed rows are replaced as a whole; new ids are deleted as well in
+            # case another process added them since the diff was made.
+            cursor.executemany("DELETE FROM images WHERE id = ?",
+                               [(image_id,) for image_id in removed] + [(record['id'],) for record in changed])
+            cursor.executemany(
+                "INSERT INTO images (id, subscription_id, group_key, name, resource_group, location, managed, tags, "
+                "source_vm, provisioning_state, marker, first_seen, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(record['id'], subscription_id, record['resource_group'].lower(), record['name'],
+                  record['resource_group'], record['location'], int(record['managed']), json.dumps(record['tags']),
+                  record['source_vm'], record['provisioning_state'], record['marker'],
+                  first_seen.get(record['id'], now), now)
+                 for record in changed])
+            cursor.executemany("INSERT INTO image_tags (id, key, value) VALUES (?, ?, ?)",
+                               [(record['id'], key, value)
+                                for record in changed for key, value in (record['tags'] or {}).items()])
+            cursor.execute("INSERT OR REPLACE INTO refreshes (subscription_id, scope, refreshed) VALUES (?, ?, ?)",
+                           (subscription_id, scope, now))
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        return stats
+
+    def query(self, subscription_id, image_filter=None, limit=None):
+        """
+        Return the image dicts of a subscription matching an ImageFilter, in the
+        shape of image_to_dict. Resource group, names and tags are answered from
+        the indexes; a name pattern is checked on the rows they leave.
+        """
+        clauses = ["subscription_id = ?"]
+        params = [subscription_id]
+        if image_filter is not None:
+            if image_filter.resource_group:
+                clauses.append("group_key = ?")
+                params.append(image_filter.resource_group)
+            names = []
+            if image_filter.names:
+                names.append("name IN ({})".format(", ".join("?" * len(image_filter.names))))
+                params.extend(sorted(image_filter.names))
+            for group, name in sorted(image_filter.group_names):
+                names.append("(group_key = ? AND name = ?)")
+                params.extend([group, name])
+            if names:
+                clauses.append("({})".format(" OR ".join(names)))
+            for key, value in image_filter.tags:
+                if value is None:
+                    clauses.append("id IN (SELECT id FROM image_tags WHERE key = ?)")
+                    params.append(key)
+                else:
+                    clauses.append("id IN (SELECT id FROM image_tags WHERE key = ? AND value = ?)")
+                    params.extend([key, value])
+
+        rows = self.connection.execute(
+            "SELECT name, location, resource_group, managed, tags FROM images WHERE {} ORDER BY id".format(
+                " AND ".join(clauses)),
+            params)
+
+        images = []
+        for name, location, resource_group, managed, tags in rows:
+            if image_filter is not None and image_filter.pattern is not None and not image_filter.pattern(name):
+                continue
+            images.append(dict(name=name,
+                               location=location,
+                               resource_group=resource_group,
+                               managed=bool(managed),
+                               tags=json.loads(tags) if tags else None))
+            if limit and len(images) >= limit:
+                break
+        return images
@@ -0,0 +1,215 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import time
+
+try:
+    from msrestazure.polling.arm_polling import ARMPolling
+except ImportError:
+    ARMPolling = None
+
+POLL_MAX_INTERVAL = 30
+# Shortest wait between two status requests of an SDK poller, whatever the
+# interval or Retry-After, so that no operation is polled in a busy loop.
+POLL_MIN_INTERVAL = 1
+
+POLLING_ARGS = dict(
+    poll_interval=dict(
+        type='float',
+        required=False,
+        default=2
+    ),
+    poll_backoff=dict(
+        type='float',
+        required=False,
+        default=1.5
+    ),
+    timeout=dict(
+        type='int',
+        required=False,
+        default=3600
+    )
+)
+
+
+class OperationTimeout(Exception):
+    pass
+
+
+if ARMPolling is not None:
+    class AdaptivePolling(ARMPolling):
+        """
+        ARM polling method that checks the status of an operation after
+        ``interval`` seconds and then waits ``backoff`` times longer after every
+        check, up to POLL_MAX_INTERVAL. A Retry-After sent by the service is
+        the least the wait can be, and no wait is shorter than
+        POLL_MIN_INTERVAL.
+        """
+
+        def __init__(self, interval, backoff, **kwargs):
+            super(AdaptivePolling, self).__init__(timeout=interval, **kwargs)
+            self._interval = interval
+            self._backoff = backoff
+
+        def _delay(self):
+            if self._response is None:
+                return
+            delay = max(self._interval, POLL_MIN_INTERVAL)
+            try:
+                delay = max(delay, float(self._response.headers.get('retry-after')))
+            except (TypeError, ValueError):
+                pass
+            time.sleep(delay)
+            self._interval = min(self._interval * self._backoff, POLL_MAX_INTERVAL)
+
+
+class OperationPolicy(object):
+    """
+    Polling settings for the long-running operations of one module run.
+
+    ``timeout`` is a deadline for the run as a whole: every wait gives up once
+    it is reached, raising OperationTimeout, so that the module can report the
+    operations that are still running instead of blocking the play.
+    """
+
+    def __init__(self, interval=2, backoff=1.5, timeout=None):
+        self.interval = interval
+        self.backoff = max(backoff, 1)
+        self.deadline = time.time() + timeout if timeout else None
+
+    def polling(self):
+        """
+        Polling method to pass as ``polling`` to an SDK operation. A new one is
+        needed for every operation, as it keeps the state of that operation.
+        """
+        if ARMPolling is None:
+            return True
+        return AdaptivePolling(self.interval, self.backoff)
+
+    def remaining(self):
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.time(), 0)
+
+    def intervals(self):
+        """
+        Yield the pauses between checks made by the module itself, growing by
+        ``backoff`` and stopping at the deadline.
+        """
+        interval = self.interval
+        while True:
+            remaining = self.remaining()
+            if remaining is not None and remaining <= 0:
+                return
+            yield interval if remaining is None else min(interval, remaining)
+            interval = min(interval * self.backoff, POLL_MAX_INTERVAL)
+
+    def wait(self, poller, description="operation"):
+        """
+        Wait for a single poller and return its result.
+        """
+        poller.wait(timeout=self.remaining())
+        if not poller.done():
+            raise OperationTimeout("Timed out waiting for {}".format(description))
+        return poller.result()
+
+
+def run_concurrently(func, items, max_concurrency):
+    """
+    Call ``func`` for every item with at most ``max_concurrency`` calls in flight.
+
+    Returns a list of ``(result, error)`` tuples in the order of ``items``. An
+    exception raised for one item is captured in its tuple instead of aborting
+    the calls for the other items.
+    """
+    def call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            return None, e
+
+    items = list(items)
+    if not items:
+        return []
+
+    # Imported here as most module runs never start concurrent calls.
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(max(1, min(max_concurrency, len(items))))
+    try:
+        return pool.map(call, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def wait_for_pollers(pollers, policy):
+    """
+    Wait for several long-running operations together.
+
+    ``pollers`` maps a key to an SDK poller. The pollers make progress in the
+    background, so checking them all in one loop takes as long as the slowest
+    operation rather than the sum of all of them. Returns a dict mapping each key
+    to the time at which its operation was seen as done. Operations still
+    running when the deadline of ``policy`` passes are left out.
+    """
+    pending = dict(pollers)
+    finished = dict()
+
+    def check():
+        for key, poller in list(pending.items()):
+            if poller.done():
+                finished[key] = time.time()
+                del pending[key]
+
+    check()
+    for interval in policy.intervals():
+        if not pending:
+            break
+        # Waiting on a pending poller instead of sleeping returns as soon as
+        # that operation is done, without polling it any more often.
+        next(iter(pending.values())).wait(timeout=interval)
+        check()
+
+    return finished
+
+
+def poller_operation_url(poller):
+    """
+    Return the URL the SDK polls for a long-running operation, or None when it
+    cannot be determined. Both the msrestazure AzureOperationPoller and the newer
+    msrest LROPoller keep it on their internal operation object.
+    """
+    operation = getattr(poller, '_operation', None)
+    if operation is None:
+        operation = getattr(getattr(poller, '_polling_method', None), '_operation', None)
+    if operation is None:
+        return None
+    return getattr(operation, 'async_url', None) or getattr(operation, 'location_url', None)
+
+
+def operation_token(poller, kind, **resource):
+    """
+    Serialize a started long-running operation into a plain dict that can be
+    registered by a play and handed to a status module later on.
+    """
+    token = dict(resource)
+    token.update(kind=kind,
+                 operation_url=poller_operation_url(poller),
+                 started=time.time())
+    return token
@@ -0,0 +1,296 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import base64
+import hashlib
+import json
+import os
+import threading
+import time
+
+from ansible.module_utils.azure_rm_operations import run_concurrently
+from ansible.module_utils.six.moves.urllib.parse import quote
+
+BLOB_API_VERSION = '2019-07-07'
+# Largest range a single Put Page From URL request may write.
+PUT_PAGE_MAX_BYTES = 4 * 1024 * 1024
+# Largest range Get Blob returns the MD5 of, with x-ms-range-get-content-md5.
+GET_RANGE_MD5_MAX_BYTES = 4 * 1024 * 1024
+# Populated ranges less than this far apart are read in one request, along
+# with the unallocated bytes between them.
+DOWNLOAD_MAX_GAP = 64 * 1024
+DOWNLOAD_RETRIES = 3
+MANIFEST_SUFFIX = '.manifest'
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+def _with_query(url, query):
+    return url + ('&' if '?' in url else '?') + query
+
+
+def _open_url(url, **kwargs):
+    # The modules importing this only reach blobs on a few code paths, so the
+    # HTTP stack is loaded on the first request rather than at import time.
+    from ansible.module_utils.urls import open_url
+    return open_url(url, **kwargs)
+
+
+def get_page_ranges(sas_url, previous_sas_url=None, timeout=60):
+    """
+    Return the populated byte ranges of a page blob, such as a managed disk
+    snapshot opened for reading through a SAS url, as inclusive (start, end)
+    tuples. With previous_sas_url, only the ranges that changed since that
+    earlier incremental snapshot of the same disk are returned.
+    """
+    import xml.etree.ElementTree as ET
+
+    headers = {'x-ms-version': BLOB_API_VERSION}
+    if previous_sas_url:
+        headers['x-ms-previous-snapshot-url'] = previous_sas_url
+
+    ranges = []
+    marker = None
+    while True:
+        url = _with_query(sas_url, 'comp=pagelist')
+        if marker:
+            url = _with_query(url, 'marker=' + quote(marker))
+        response = _open_url(url, headers=headers, method='GET', timeout=timeout)
+        root = ET.fromstring(response.read())
+        for page_range in root.findall('PageRange'):
+            ranges.append((int(page_range.find('Start').text), int(page_range.find('End').text)))
+        marker = root.findtext('NextMarker')
+        if not marker:
+            return ranges
+
+
+def range_bytes(ranges):
+    return sum(end - start + 1 for start, end in ranges)
+
+
+def get_blob_size(sas_url, timeout=60):
+    """
+    Return the length in bytes of a blob, such as a managed disk snapshot opened
+    for reading through a SAS url.
+    """
+    response = _open_url(sas_url, headers={'x-ms-version': BLOB_API_VERSION}, method='HEAD', timeout=timeout)
+    return int(response.headers.get('Content-Length'))
+
+
+def split_ranges(ranges, size=PUT_PAGE_MAX_BYTES):
+    """
+    Yield inclusive (start, end) ranges covering ``ranges`` in pieces of at most
+    ``size`` bytes.
+    """
+    for start, end in ranges:
+        while start <= end:
+            piece_end = min(end, start + size - 1)
+            yield start, piece_end
+            start = piece_end + 1
+
+
+def copy_page_ranges(source_sas_url, target_sas_url, ranges, max_concurrency=8, timeout=60, progress=None):
+    """
+    Copy the given inclusive byte ranges of a page blob into the same offsets of
+    another page blob with Put Page From URL, so that the data is moved between
+    the storage accounts without passing through this host. Ranges left out,
+    such as the unallocated parts of a sparse disk, stay zero in the target.
+
+    ``progress`` is called with the number of bytes of every piece written.
+    Returns the number of bytes copied; the first failed piece is raised once
+    all pieces have been tried.
+    """
+    def put(piece):
+        start, end = piece
+        page_range = 'bytes={}-{}'.format(start, end)
+        _open_url(_with_query(target_sas_url, 'comp=page'),
+                  data=b'',
+                  headers={'x-ms-version': BLOB_API_VERSION,
+                           'x-ms-page-write': 'update',
+                           'x-ms-range': page_range,
+                           'x-ms-source-range': page_range,
+                           'x-ms-copy-source': source_sas_url},
+                  method='PUT', timeout=timeout)
+        if progress is not None:
+            progress(end - start + 1)
+        return end - start + 1
+
+    copied = 0
+    for count, error in run_concurrently(put, list(split_ranges(ranges)), max_concurrency):
+        if error is not None:
+            raise error
+        copied += count
+    return copied
+
+
+def coalesce_ranges(ranges, max_gap=DOWNLOAD_MAX_GAP, size=GET_RANGE_MD5_MAX_BYTES):
+    """
+    Return inclusive (start, end) pieces of at most ``size`` bytes covering the
+    sorted ``ranges``, joining ranges separated by no more than ``max_gap``
+    bytes into one piece.
+    """
+    merged = []
+    for start, end in ranges:
+        if merged and start - merged[-1][1] - 1 <= max_gap and end - merged[-1][0] < size:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return list(split_ranges([(start, end) for start, end in merged], size))
+
+
+def _md5(data):
+    return base64.b64encode(hashlib.md5(data).digest()).decode('ascii')
+
+
+_sessions = threading.local()
+
+
+def _read_range(sas_url, start, end, timeout):
+    """
+    Read an inclusive byte range of a blob, checked against the MD5 the blob
+    service computes for it. Returns the data and its base64 MD5.
+    """
+    session = getattr(_sessions, 'session', None)
+    if session is None:
+        # One session per download thread, so that its connection is kept
+        # from one range to the next rather than set up for every range as
+        # open_url does. Imported here for the same reason as _open_url.
+        import requests
+        session = _sessions.session = requests.Session()
+    response = session.get(sas_url,
+                           headers={'x-ms-version': BLOB_API_VERSION,
+                                    'x-ms-range': 'bytes={}-{}'.format(start, end),
+                                    'x-ms-range-get-content-md5': 'true'},
+                           timeout=timeout)
+    response.raise_for_status()
+    data = response.content
+    md5 = _md5(data)
+    if len(data) != end - start + 1:
+        raise ChecksumMismatch("Read {} bytes of range {}-{} instead of {}".format(len(data), start, end,
+                                                                                   end - start + 1))
+    expected = response.headers.get('Content-MD5')
+    if expected and expected != md5:
+        raise ChecksumMismatch("MD5 of range {}-{} is {} instead of {}".format(start, end, md5, expected))
+    return data, md5
+
+
+def _resumable_pieces(path, manifest_path, header):
+    """
+    The pieces already written to ``path`` by an earlier download with the
+    same ``header``, as a dict of (start, end) to MD5, checked against the
+    data in the file. Returns None when there is no such download to resume.
+    """
+    try:
+        with open(manifest_path) as f:
+            if json.loads(f.readline() or 'null') != header:
+                return None
+            entries = [json.loads(line) for line in f if line.endswith('\n')]
+    except (IOError, OSError, ValueError):
+        return None
+    if not os.path.exists(path) or os.path.getsize(path) != header['size']:
+        return None
+
+    done = dict()
+    with open(path, 'rb') as f:
+        for entry in entries:
+            f.seek(entry['start'])
+            if _md5(f.read(entry['end'] - entry['start'] + 1)) == entry['md5']:
+                done[(entry['start'], entry['end'])] = entry['md5']
+    return done
+
+
+def download_page_blob(sas_url, path, size, ranges, identity, max_concurrency=16, timeout=60):
+    """
+    Download the populated ``ranges`` of a page blob of ``size`` bytes, such
+    as a managed disk snapshot opened for reading through a SAS url, to the
+    same offsets of the local file ``path``. The file is sparse: unallocated
+    ranges are not read, and stay holes where the file system supports them,
+    as do zeroed pages of a download that does not resume an earlier one.
+    Ranges are read in pieces of up to 4 MiB, ``max_concurrency`` at a time,
+    every piece checked against the MD5 the blob service reports for it.
+
+    The MD5 of every piece written is recorded in a manifest next to the file.
+    A later download of the same blob, as told by ``identity``, a dict such as
+    the snapshot id and creation time, skips the pieces the manifest lists
+    whose data in the file still matches their MD5.
+
+    Returns a dict with the bytes and pieces downloaded and resumed. The first
+    failed piece is raised once all pieces have been tried.
+    """
+    pieces = coalesce_ranges(ranges)
+    manifest_path = path + MANIFEST_SUFFIX
+    header = dict(identity, size=size, piece_bytes=GET_RANGE_MD5_MAX_BYTES, max_gap=DOWNLOAD_MAX_GAP)
+
+    done = _resumable_pieces(path, manifest_path, header)
+    fresh = done is None
+    if fresh:
+        done = dict()
+        with open(path, 'wb') as f:
+            f.truncate(size)
+        with open(manifest_path, 'w') as manifest:
+            manifest.write(json.dumps(header, sort_keys=True) + '\n')
+    todo = [piece for piece in pieces if piece not in done]
+
+    lock = threading.Lock()
+    stats = dict(downloaded_bytes=0, retries=0)
+
+    with open(path, 'r+b') as f:
+        with open(manifest_path, 'a') as manifest:
+            def fetch(piece):
+                start, end = piece
+                attempt = 0
+                while True:
+                    try:
+                        data, md5 = _read_range(sas_url, start, end, timeout)
+                        break
+                    except Exception:
+                        attempt += 1
+                        if attempt > DOWNLOAD_RETRIES:
+                            raise
+                        with lock:
+                            stats['retries'] += 1
+                        time.sleep(attempt)
+                with lock:
+                    # Zeroed pages the service still lists are left holes in a
+                    # freshly truncated file. When resuming, the file may hold
+                    # other data where the piece was rejected, so they are
+                    # written like any other.
+                    if not fresh or data.count(b'\0') != len(data):
+                        f.seek(start)
+                        f.write(data)
+                        f.flush()
+                    manifest.write(json.dumps(dict(start=start, end=end, md5=md5), sort_keys=True) + '\n')
+                    manifest.flush()
+                    stats['downloaded_bytes'] += len(data)
+
+            errors = [error for result, error in run_concurrently(fetch, todo, max_concurrency) if error is not None]
+            if errors:
+                raise errors[0]
+            os.fsync(f.fileno())
+
+    resumed = [piece for piece in pieces if piece in done]
+    return dict(size=size,
+                allocated_bytes=range_bytes(ranges),
+                pieces=len(pieces),
+                downloaded_bytes=stats['downloaded_bytes'],
+                resumed_pieces=len(resumed),
+                resumed_bytes=range_bytes(resumed),
+                retries=stats['retries'])
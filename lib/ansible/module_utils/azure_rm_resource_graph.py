@@ -0,0 +1,189 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import re
+
+RESOURCE_GRAPH_API_VERSION = '2021-03-01'
+RESOURCE_GRAPH_PATH = '/providers/Microsoft.ResourceGraph/resources'
+RESOURCE_GRAPH_PAGE_SIZE = 1000
+
+RESOURCE_GRAPH_ARGS = dict(
+    backend=dict(
+        type='str',
+        required=False,
+        default='listing',
+        choices=['listing', 'resource_graph']
+    ),
+    resource_graph_endpoint=dict(
+        type='str',
+        required=False
+    )
+)
+
+
+class ResourceGraphError(Exception):
+    pass
+
+
+def kql_string(value):
+    """
+    Quote a value as a KQL verbatim string literal, in which backslashes have
+    no special meaning and a single quote is written twice.
+    """
+    return "@'{}'".format(value.replace("'", "''"))
+
+
+def glob_to_regex(pattern):
+    """
+    Translate a shell-style wildcard pattern into an anchored regular
+    expression using only syntax understood by both Python and the RE2 engine
+    behind KQL's ``matches regex``.
+    """
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        i += 1
+        if char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        elif char == '[':
+            end = pattern.find(']', i + 1 if pattern[i:i + 1] in ('!', ']') else i)
+            if end == -1:
+                parts.append('\\[')
+                continue
+            chars = pattern[i:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            parts.append('[{}]'.format(chars))
+            i = end + 1
+        else:
+            parts.append(re.escape(char))
+    return '^{}$'.format(''.join(parts))
+
+
+def image_query(image_filter, limit=None):
+    """
+    Build the Resource Graph query selecting the images an ImageFilter would
+    select, projected to the fields of image_to_dict.
+    """
+    clauses = ["Resources",
+               "where type =~ 'microsoft.compute/images'"]
+
+    if image_filter.resource_group:
+        clauses.append("where resourceGroup =~ {}".format(kql_string(image_filter.resource_group)))
+
+    if image_filter.names or image_filter.group_names:
+        conditions = []
+        if image_filter.names:
+            conditions.append("name in ({})".format(
+                ", ".join(kql_string(name) for name in sorted(image_filter.names))))
+        if image_filter.group_names:
+            conditions.append("strcat(tolower(resourceGroup), '/', name) in ({})".format(
+                ", ".join(kql_string("{}/{}".format(group, name))
+                          for group, name in sorted(image_filter.group_names))))
+        clauses.append("where {}".format(" or ".join(conditions)))
+
+    if image_filter.pattern_text is not None:
+        regex = image_filter.pattern_text
+        if image_filter.pattern_type != 'regex':
+            regex = glob_to_regex(regex)
+        clauses.append("where name matches regex {}".format(kql_string(regex)))
+
+    for key, value in image_filter.tags:
+        if value is None:
+            clauses.append("where isnotnull(tags[{}])".format(kql_string(key)))
+        else:
+            clauses.append("where tostring(tags[{}]) == {}".format(kql_string(key), kql_string(value)))
+
+    # Resource Graph only pages through results, returning a $skipToken, when
+    # the id of the resources is projected; without it a query silently stops
+    # at the first page. The id also gives the resource group in its original
+    # case, see image_row_to_dict.
+    clauses.append("order by id asc")
+    clauses.append("project id, name, location, "
+                   "managed = isnotnull(properties.storageProfile.osDisk.managedDisk), "
+                   "tags")
+    if limit:
+        clauses.append("limit {}".format(int(limit)))
+
+    return "\n| ".join(clauses)
+
+
+def image_row_to_dict(row):
+    """
+    Map a row of image_query to the fields of image_to_dict.
+    """
+    return dict(name=row['name'],
+                location=row['location'],
+                resource_group=row['id'].split("/")[4],
+                managed=bool(row['managed']),
+                tags=row.get('tags')
+                )
+
+
+def session_transport(session, timeout=60):
+    """
+    Transport posting queries with a requests session, such as the signed
+    session of the module's Azure credentials.
+    """
+    def post(url, body):
+        response = session.post(url, json=body, timeout=timeout)
+        if response.status_code != 200:
+            raise ResourceGraphError("Resource Graph query failed with status {}: {}".format(response.status_code,
+                                                                                             response.text))
+        return response.json()
+    return post
+
+
+class ResourceGraphClient(object):
+    """
+    Minimal client for the Resource Graph resources query API.
+
+    ``transport`` is a callable taking the request URL and the JSON body as a
+    dict and returning the decoded JSON response, so that queries can be sent
+    through any HTTP stack, or answered by a local stand-in.
+    """
+
+    def __init__(self, transport, endpoint, subscriptions, page_size=RESOURCE_GRAPH_PAGE_SIZE):
+        self.transport = transport
+        self.url = "{}{}?api-version={}".format(endpoint.rstrip('/'), RESOURCE_GRAPH_PATH,
+                                                RESOURCE_GRAPH_API_VERSION)
+        self.subscriptions = list(subscriptions)
+        self.page_size = page_size
+
+    def query(self, query):
+        """
+        Yield the rows of a query one at a time, requesting the next page only
+        once the previous one has been consumed.
+        """
+        skip_token = None
+        while True:
+            options = {'resultFormat': 'objectArray', '$top': self.page_size}
+            if skip_token:
+                options['$skipToken'] = skip_token
+            response = self.transport(self.url, dict(subscriptions=self.subscriptions,
+                                                     query=query,
+                                                     options=options))
+            for row in response.get('data') or []:
+                yield row
+            skip_token = response.get('$skipToken')
+            if not skip_token:
+                return
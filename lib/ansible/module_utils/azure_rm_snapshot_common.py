@@ -0,0 +1,141 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import time
+
+from ansible.module_utils.azure_rm_operations import run_concurrently, wait_for_pollers
+
+try:
+    from azure.mgmt.compute import ComputeManagementClient
+except ImportError:
+    pass
+
+SNAPSHOT_API_VERSION = '2019-07-01'
+# The first azure-mgmt-compute release that provides SNAPSHOT_API_VERSION.
+SNAPSHOT_SDK_VERSION = '10.0.0'
+SOURCE_VM_TAG = 'ansible-source-vm'
+SOURCE_DISK_TAG = 'ansible-source-disk'
+
+
+def vm_disks(vm):
+    """
+    The managed disks of a VM, OS disk first, as dicts with the disk name, id
+    and lun, which is None for the OS disk, and the SDK disk of the VM.
+    """
+    disks = [vm.storage_profile.os_disk] + list(vm.storage_profile.data_disks or [])
+    return [dict(name=disk.managed_disk.id.rsplit('/', 1)[-1],
+                 id=disk.managed_disk.id,
+                 lun=getattr(disk, 'lun', None) if disk is not vm.storage_profile.os_disk else None,
+                 disk=disk) for disk in disks if disk.managed_disk is not None]
+
+
+class SnapshotClientMixin(object):
+    """
+    Mixin for ClientProxyMixin modules that need compute operations newer than
+    the API version of compute_client: incremental snapshots, disk uploads and
+    access grants on snapshots and disks.
+    """
+
+    _snapshot_client = None
+
+    @property
+    def snapshot_client(self):
+        if not self._snapshot_client:
+            self._snapshot_client = self.get_mgmt_svc_client(ComputeManagementClient,
+                                                             base_url=self._cloud_environment.endpoints.resource_manager,
+                                                             api_version=SNAPSHOT_API_VERSION)
+        return self.proxy_client(self._snapshot_client)
+
+    @property
+    def snapshot_models(self):
+        return ComputeManagementClient.models(SNAPSHOT_API_VERSION)
+
+    def check_snapshot_api(self, feature):
+        """
+        Fail the module when the installed azure-mgmt-compute does not provide
+        SNAPSHOT_API_VERSION, which ``feature`` needs.
+        """
+        try:
+            ComputeManagementClient.models(SNAPSHOT_API_VERSION)
+        except NotImplementedError:
+            self.fail("{} requires azure-mgmt-compute >= {}, which provides compute API version {}".format(
+                feature, SNAPSHOT_SDK_VERSION, SNAPSHOT_API_VERSION))
+
+    def snapshot_disks(self, vm_name, disks, names, location, tags=None, incremental=False, max_concurrency=8):
+        """
+        Snapshot disks of a VM, as returned by vm_disks, all at once into the
+        module's resource group, waiting with its polling_policy. ``names`` maps
+        every disk name to the name of its snapshot. Snapshots are tagged with
+        ``tags`` and the VM and disk they were taken of.
+
+        Only ``incremental`` snapshots are taken through snapshot_client; other
+        snapshots go through compute_client, whose API version every SDK that
+        Ansible supports provides.
+
+        Returns one dict per disk with the disk and snapshot names, the status,
+        the duration in seconds and, once created, the SDK snapshot. The status
+        is the provisioning state, or Timed out or Failed with the error.
+        """
+        if incremental:
+            models = self.snapshot_models
+            snapshots = self.snapshot_client.snapshots
+        else:
+            models = self.compute_models
+            snapshots = self.compute_client.snapshots
+        policy = self.polling_policy
+
+        def start(disk):
+            disk_tags = dict(tags or {})
+            disk_tags[SOURCE_VM_TAG] = vm_name
+            disk_tags[SOURCE_DISK_TAG] = disk['id'].lower()
+            params = dict(location=location,
+                          creation_data=models.CreationData(create_option='Copy', source_resource_id=disk['id']),
+                          sku=models.SnapshotSku(name='Standard_LRS'),
+                          tags=disk_tags)
+            if incremental:
+                params['incremental'] = True
+            disk['started'] = time.time()
+            return snapshots.create_or_update(resource_group_name=self.resource_group,
+                                              snapshot_name=names[disk['name']],
+                                              snapshot=models.Snapshot(**params),
+                                              polling=policy.polling())
+
+        operations = run_concurrently(start, disks, max_concurrency)
+        finished = wait_for_pollers(dict((disk['name'], operation)
+                                         for disk, (operation, error) in zip(disks, operations)
+                                         if error is None),
+                                    policy)
+
+        taken = []
+        for disk, (operation, error) in zip(disks, operations):
+            info = dict(disk=disk['name'], name=names[disk['name']], snapshot=None)
+            if error is None and disk['name'] not in finished:
+                info['status'] = "Timed out"
+            elif error is None:
+                try:
+                    info['snapshot'] = operation.result()
+                    info['status'] = info['snapshot'].provisioning_state
+                except Exception as e:
+                    error = e
+            if error is not None:
+                info['status'] = "Failed"
+                info['error'] = str(error)
+            info['duration'] = round(finished.get(disk['name'], time.time()) - disk.get('started', time.time()), 3)
+            taken.append(info)
+        return taken
@@ -0,0 +1,309 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import collections
+import random
+import re
+import threading
+import time
+
+from email.utils import mktime_tz, parsedate_tz
+
+THROTTLE_ARGS = dict(
+    request_rate=dict(
+        type='float',
+        required=False
+    ),
+    request_burst=dict(
+        type='int',
+        required=False,
+        default=10
+    ),
+    throttle_retries=dict(
+        type='int',
+        required=False,
+        default=6
+    ),
+    throttle_max_delay=dict(
+        type='int',
+        required=False,
+        default=60
+    )
+)
+
+THROTTLED_STATUS = 429
+
+# Backoff before the first retry of a throttled request that came without a
+# Retry-After, doubled for every further retry.
+RETRY_BASE_DELAY = 1.0
+
+# Adaptive rate: halved when a request is throttled, lowered by a tenth when
+# Azure reports few requests remaining, at most once per
+# RATE_DECREASE_INTERVAL seconds as concurrent requests report the same
+# throttling, and raised by RATE_INCREASE requests per second for every
+# request answered without either.
+RATE_DECREASE = 0.5
+LOW_REMAINING_DECREASE = 0.9
+RATE_DECREASE_INTERVAL = 1.0
+RATE_INCREASE = 0.1
+MIN_RATE = 0.1
+
+REMAINING_HEADER_PREFIX = 'x-ms-ratelimit-remaining-'
+REMAINING_COUNT = re.compile(r';(\d+)')
+
+
+def retry_after(headers):
+    """
+    Seconds asked for by the Retry-After header, as a number of seconds or a
+    date, or None.
+    """
+    value = (headers or {}).get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        parsed = parsedate_tz(value)
+        return max(mktime_tz(parsed) - time.time(), 0.0) if parsed else None
+
+
+def remaining_requests(headers):
+    """
+    The lowest number of requests Azure reports as remaining in any of the
+    x-ms-ratelimit-remaining-* headers, such as the subscription reads and
+    writes or the per-policy counts of the compute resource provider, or None.
+    """
+    counts = []
+    for key, value in (headers or {}).items():
+        if not key.lower().startswith(REMAINING_HEADER_PREFIX):
+            continue
+        value = str(value).strip()
+        if value.isdigit():
+            counts.append(int(value))
+        else:
+            counts.extend(int(count) for count in REMAINING_COUNT.findall(value))
+    return min(counts) if counts else None
+
+
+def throttled_error(e):
+    """
+    Whether an SDK exception is Azure refusing a request because of throttling,
+    in which case the request was not carried out and can be sent again.
+    """
+    response = getattr(e, 'response', None)
+    status_code = getattr(e, 'status_code', None) or getattr(response, 'status_code', None)
+    return status_code == THROTTLED_STATUS
+
+
+class RequestThrottle(object):
+    """
+    Token bucket pacing the Azure requests of every operation in the process
+    that shares it, at an adaptive rate.
+
+    The rate starts unlimited, or at ``rate`` requests per second, and is
+    lowered whenever Azure throttles a request or reports no more requests
+    remaining than ``burst``, and raised again while it does not, up to
+    ``rate``. A Retry-After stops all requests for as long as asked, after
+    which they resume at the lowered rate rather than all at once.
+    """
+
+    def __init__(self, rate=None, burst=10):
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.updated = time.time()
+        self.not_before = 0.0
+        self.throttled = 0
+        self._decreased = 0.0
+        self._sent = collections.deque(maxlen=max(2 * self.burst, 10))
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now < self.updated:
+            return
+        if self.rate is None:
+            self.tokens = float(self.burst)
+        else:
+            self.tokens = min(float(self.burst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """
+        Wait for the next request to be allowed, and return the seconds waited.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                delay = self.not_before - now
+                if delay <= 0:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self._sent.append(now)
+                        return waited
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def _observed_rate(self, now):
+        if len(self._sent) < 2 or now <= self._sent[0]:
+            return float(self.burst)
+        return len(self._sent) / (now - self._sent[0])
+
+    def slow_down(self, pause=None, factor=RATE_DECREASE):
+        """
+        Lower the rate by ``factor``, and with ``pause`` hold all requests for
+        that many seconds.
+        """
+        with self._lock:
+            now = time.time()
+            self._refill(now)
+            if pause:
+                self.throttled += 1
+                if now + pause > self.not_before:
+                    self.not_before = now + pause
+                    # No tokens are gathered during the pause, so that the
+                    # requests held do not all go out together once it ends.
+                    self.tokens = 0.0
+                    self.updated = self.not_before
+            if now - self._decreased >= RATE_DECREASE_INTERVAL:
+                self._decreased = now
+                current = self.rate if self.rate is not None else self._observed_rate(now)
+                self.rate = max(current * factor, MIN_RATE)
+
+    def speed_up(self):
+        with self._lock:
+            if self.rate is None:
+                return
+            self._refill(time.time())
+            self.rate += RATE_INCREASE
+            if self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+
+    def observe(self, response, *args, **kwargs):
+        """
+        Response hook for the SDK clients: adapt to the throttling Azure reports
+        on every response, including those of status polls and listing pages.
+        """
+        headers = getattr(response, 'headers', None)
+        if getattr(response, 'status_code', None) == THROTTLED_STATUS:
+            self.slow_down(pause=retry_after(headers) or RETRY_BASE_DELAY)
+            return
+        remaining = remaining_requests(headers)
+        if remaining is not None and remaining <= self.burst:
+            self.slow_down(factor=LOW_REMAINING_DECREASE)
+        elif getattr(response, 'status_code', 500) < 400:
+            self.speed_up()
+
+    def state(self):
+        with self._lock:
+            return dict(rate=round(self.rate, 3) if self.rate is not None else None,
+                        throttled=self.throttled)
+
+
+_throttles = dict()
+_throttles_lock = threading.Lock()
+
+
+def shared_throttle(subscription_id, rate=None, burst=10):
+    """
+    The RequestThrottle of the process for a subscription, the scope of the
+    Azure Resource Manager request limits, and the given settings.
+    """
+    key = (subscription_id, rate, burst)
+    with _throttles_lock:
+        if key not in _throttles:
+            _throttles[key] = RequestThrottle(rate, burst)
+        return _throttles[key]
+
+
+class RequestScheduler(object):
+    """
+    Sends the requests of one module through a shared RequestThrottle, and
+    sends throttled requests again after the delay Azure asks for, or after a
+    jittered exponential backoff, up to ``retries`` times. A throttled request
+    is given up on when Azure asks for more than ``max_delay`` seconds.
+    """
+
+    def __init__(self, throttle, retries=6, max_delay=60):
+        self.throttle = throttle
+        self.retries = retries
+        self.max_delay = max_delay
+
+    def attach(self, client):
+        """
+        Let the throttle observe every response of an SDK client, and leave
+        throttled requests to this scheduler rather than to the retries of the
+        HTTP connection, which wait out a Retry-After on their own.
+        """
+        config = getattr(client, 'config', None)
+        if config is None:
+            return
+        hooks = getattr(config, 'hooks', None)
+        if hooks is not None and self.throttle.observe not in hooks:
+            hooks.append(self.throttle.observe)
+        policy = getattr(getattr(config, 'retry_policy', None), 'policy', None)
+        codes = getattr(policy, 'RETRY_AFTER_STATUS_CODES', None)
+        if codes is not None and THROTTLED_STATUS in codes:
+            policy.RETRY_AFTER_STATUS_CODES = frozenset(code for code in codes if code != THROTTLED_STATUS)
+
+    def call(self, method, args, kwargs, record=None):
+        """
+        Call an SDK method once the throttle allows it, until it is not
+        throttled. ``record``, when given, is called with the seconds waited
+        and the retries made.
+        """
+        attempt = 0
+        while True:
+            waited = self.throttle.acquire()
+            if record is not None and waited:
+                record('throttle_wait', waited)
+            try:
+                return method(*args, **kwargs)
+            except Exception as e:
+                if not throttled_error(e) or attempt >= self.retries:
+                    raise
+                delay = retry_after(getattr(getattr(e, 'response', None), 'headers', None))
+                if delay is None:
+                    delay = random.uniform(0, min(self.max_delay, RETRY_BASE_DELAY * 2 ** attempt))
+                elif delay > self.max_delay:
+                    raise
+                else:
+                    # Requests throttled together are spread over a tenth of
+                    # the delay asked for, instead of all coming back at once.
+                    delay += random.uniform(0, delay / 10)
+                self.throttle.slow_down(pause=delay)
+                attempt += 1
+                if record is not None:
+                    record('throttle_retries', 1)
+
+    def wrap_paged(self, paged):
+        """
+        Send the page requests of an SDK listing through the scheduler.
+        """
+        advance_page = getattr(paged, 'advance_page', None)
+        if advance_page is not None:
+            # Shadowing the bound method on the instance, as the pager calls
+            # self.advance_page() for every page.
+            def scheduled_advance_page():
+                return self.call(advance_page, (), {})
+            paged.advance_page = scheduled_advance_page
+        return paged
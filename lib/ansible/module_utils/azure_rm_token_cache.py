@@ -0,0 +1,212 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import base64
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from ansible.module_utils import azure_rm_common
+from ansible.module_utils.basic import missing_required_lib
+
+try:
+    from msrestazure.azure_active_directory import ServicePrincipalCredentials
+except ImportError:
+    ServicePrincipalCredentials = object
+
+TOKEN_CACHE_ARGS = dict(
+    token_cache=dict(
+        type='bool',
+        required=False,
+        default=False
+    ),
+    token_cache_path=dict(
+        type='path',
+        required=False,
+        default='~/.ansible/azure_token_cache'
+    )
+)
+
+# A cached token is only reused while it stays valid for at least this long,
+# so that it cannot expire in the middle of a module run.
+TOKEN_EXPIRY_MARGIN = 300
+
+TOKEN_CACHE_HIT = 'hit'
+TOKEN_CACHE_MISS = 'miss'
+TOKEN_CACHE_UNSUPPORTED = 'unsupported'
+
+TOKEN_FIELDS = ('access_token', 'token_type', 'expires_on', 'resource')
+
+
+class TokenCache(object):
+    """
+    Directory of access tokens, one file per authority, tenant, client and
+    scope, named after a hash of them.
+
+    Every file is encrypted and authenticated with a key derived from the
+    client secret the token was acquired with, so a token can only be read
+    back by a holder of that secret, and a rotated secret simply misses.
+    """
+
+    def __init__(self, path):
+        # cryptography is imported here rather than with the module, so that
+        # tasks not using the cache do not pay for loading it. ImportError is
+        # left to the caller.
+        from cryptography.fernet import Fernet, InvalidToken
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+        self.path = os.path.expanduser(path)
+        self._invalid_token = InvalidToken
+
+        def locate(identity, secret):
+            identity = json.dumps(list(identity)).encode('utf-8')
+            key = HKDF(algorithm=hashes.SHA256(), length=32, salt=identity, info=b'ansible-azure-token-cache',
+                       backend=default_backend()).derive(secret.encode('utf-8'))
+            return (os.path.join(self.path, hashlib.sha256(identity).hexdigest() + '.token'),
+                    Fernet(base64.urlsafe_b64encode(key)))
+        self._locate = locate
+
+    def get(self, identity, secret):
+        """
+        Return the cached token for an identity, as stored by put, or None when
+        there is none that stays valid for TOKEN_EXPIRY_MARGIN seconds.
+        """
+        path, fernet = self._locate(identity, secret)
+        try:
+            with open(path, 'rb') as f:
+                token = json.loads(fernet.decrypt(f.read()).decode('utf-8'))
+        except (IOError, OSError, ValueError, self._invalid_token):
+            return None
+        if float(token.get('expires_on') or 0) - time.time() < TOKEN_EXPIRY_MARGIN:
+            return None
+        return token
+
+    def put(self, identity, secret, token):
+        """
+        Store the fields of a token needed to sign requests. The file is written
+        under a temporary name and renamed, so concurrent tasks never read a
+        partial file.
+        """
+        path, fernet = self._locate(identity, secret)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        data = fernet.encrypt(json.dumps(dict((key, token.get(key)) for key in TOKEN_FIELDS)).encode('utf-8'))
+        fd, temp_path = tempfile.mkstemp(dir=self.path, prefix='.token-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+
+class CachedServicePrincipalCredentials(ServicePrincipalCredentials):
+    """
+    Service principal credentials that look a token up in a TokenCache before
+    acquiring one from Azure AD, and store the ones they acquire.
+    ``cache_status`` tells whether the first token came from the cache.
+    """
+
+    def __init__(self, client_id, secret, token_cache=None, **kwargs):
+        self.token_cache = token_cache
+        self.cache_status = None
+        super(CachedServicePrincipalCredentials, self).__init__(client_id, secret, **kwargs)
+
+    def _identity(self):
+        return (self.cloud_environment.endpoints.active_directory, self._tenant, self.id, self.resource)
+
+    def set_token(self):
+        # Called again before every signed session; a token held in memory
+        # is kept while it is valid, as it is by the ADAL cache otherwise.
+        if self.token and float(self.token.get('expires_on') or 0) - time.time() >= TOKEN_EXPIRY_MARGIN:
+            return
+        token = self.token_cache.get(self._identity(), self.secret)
+        if token is not None:
+            self.token = token
+            self.cache_status = self.cache_status or TOKEN_CACHE_HIT
+            return
+        super(CachedServicePrincipalCredentials, self).set_token()
+        self.cache_status = self.cache_status or TOKEN_CACHE_MISS
+        self.token_cache.put(self._identity(), self.secret, self.token)
+
+
+_building = threading.local()
+
+
+def _service_principal_credentials(client_id, secret, **kwargs):
+    """
+    Stand-in for the ServicePrincipalCredentials of azure_rm_common, building
+    CachedServicePrincipalCredentials for the TokenCacheMixin module being
+    initialized in the calling thread when its token_cache option is set.
+    """
+    module = getattr(_building, 'module', None)
+    if module is None or not module.module.params.get('token_cache'):
+        return ServicePrincipalCredentials(client_id, secret, **kwargs)
+    try:
+        token_cache = TokenCache(module.module.params['token_cache_path'])
+    except ImportError:
+        module.fail(missing_required_lib('cryptography'))
+    module._token_credentials = CachedServicePrincipalCredentials(client_id, secret, token_cache=token_cache, **kwargs)
+    return module._token_credentials
+
+
+class TokenCacheMixin(object):
+    """
+    Mixin for AzureRMModuleBase subclasses adding the token_cache options.
+
+    AzureRMModuleBase authenticates while it is being initialized, so the
+    service principal credentials azure_rm_common builds are replaced by
+    CachedServicePrincipalCredentials for modules initialized with token_cache
+    set. Other kinds of credentials are left alone and reported as
+    unsupported.
+    """
+
+    _token_credentials = None
+
+    def __init__(self, *args, **kwargs):
+        # Kept in place once set, as modules may be initialized concurrently,
+        # in a worker; it only acts for the module of the calling thread.
+        azure_rm_common.ServicePrincipalCredentials = _service_principal_credentials
+        _building.module = self
+        try:
+            super(TokenCacheMixin, self).__init__(*args, **kwargs)
+        finally:
+            _building.module = None
+
+    @property
+    def token_cache_status(self):
+        if self._token_credentials is not None:
+            return self._token_credentials.cache_status
+        if isinstance(getattr(getattr(self, 'azure_auth', None), 'azure_credentials', None),
+                      CachedServicePrincipalCredentials):
+            # Credentials built for an earlier task in the same process, as a
+            # worker does, with their token already acquired.
+            return TOKEN_CACHE_HIT
+        return TOKEN_CACHE_UNSUPPORTED
+
+    def add_metrics(self, results):
+        if getattr(self, 'token_cache', False):
+            results['token_cache'] = self.token_cache_status
+        return super(TokenCacheMixin, self).add_metrics(results)
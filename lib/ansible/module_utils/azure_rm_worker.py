@@ -0,0 +1,523 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Long-lived local worker processes for Azure modules.
+
+With the worker option set, a task hands its arguments to a worker listening
+on a Unix socket and prints the result the worker sends back, instead of
+authenticating, building SDK clients and running the module itself. The
+worker runs every task it is handed in a thread of its own, with the module
+class it was started for, reusing the authentication and the SDK clients,
+with their pooled connections, of earlier tasks run with the same
+credentials.
+
+A task that finds no worker running starts one by forking itself before it
+authenticates. Workers exit once they have been idle for worker_idle_timeout
+seconds. There is one worker per module, version of its code, user and set
+of AZURE_* environment variables, as the worker keeps the code and the
+environment of the task that started it.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+import copy
+import errno
+import hashlib
+import importlib
+import json
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+import zipfile
+
+from ansible.module_utils import basic
+from ansible.module_utils.ansible_release import __version__ as ANSIBLE_VERSION
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.module_utils.six.moves import queue
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+WORKER_ARGS = dict(
+    worker=dict(
+        type='bool',
+        required=False,
+        default=False
+    ),
+    worker_path=dict(
+        type='path',
+        required=False,
+        default='~/.ansible/azure_worker'
+    ),
+    worker_idle_timeout=dict(
+        type='int',
+        required=False,
+        default=300
+    )
+)
+
+# Seconds a task waits for the worker it started to listen.
+WORKER_START_TIMEOUT = 10
+
+# Seconds between the checks of a worker for having been idle long enough.
+WORKER_IDLE_CHECK_INTERVAL = 1.0
+
+_local = threading.local()
+
+# The Worker serving in this process, if it is a worker.
+_serving = None
+
+
+class WorkerError(Exception):
+    pass
+
+
+def _module_name(module_file):
+    return os.path.splitext(os.path.basename(module_file))[0]
+
+
+def _code_version(module_file):
+    """
+    Digest of the code of the module at module_file and of the module_utils it
+    runs with. A module run by Ansible is imported from the AnsiballZ payload,
+    a zip holding exactly that code, whose members are told apart by their
+    names and checksums without reading them. Outside of a payload, as when
+    run from a checkout, the module and the Azure module_utils next to this
+    file are read instead.
+    """
+    digest = hashlib.sha1()
+    archive = module_file
+    while not os.path.isfile(archive) and os.path.dirname(archive) != archive:
+        archive = os.path.dirname(archive)
+    if archive != module_file and zipfile.is_zipfile(archive):
+        with zipfile.ZipFile(archive) as payload:
+            for info in sorted(payload.infolist(), key=lambda info: info.filename):
+                digest.update('{0}:{1}:{2}\n'.format(info.filename, info.CRC, info.file_size).encode('utf-8'))
+        return digest.hexdigest()
+
+    module_utils = os.path.dirname(os.path.abspath(__file__))
+    paths = [module_file] + sorted(os.path.join(module_utils, name) for name in os.listdir(module_utils)
+                                   if name.startswith('azure_rm') and name.endswith('.py'))
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def worker_socket_path(worker_path, module_file):
+    """
+    Path of the socket of the worker for the module at module_file. The name
+    covers everything the worker keeps from the task that started it besides
+    the arguments it is handed: the code of the module and its module_utils,
+    the Ansible version, the user and the Azure environment variables. A task
+    shipped with changed code thus starts a worker of its own rather than
+    being run by one still holding the old code.
+    """
+    module_name = _module_name(module_file)
+    environment = sorted((key, value) for key, value in os.environ.items()
+                         if key.startswith('AZURE_') or key.startswith('ANSIBLE_AZURE_'))
+    digest = hashlib.sha1(json.dumps([ANSIBLE_VERSION, module_name, _code_version(module_file), os.getuid(),
+                                      environment]).encode('utf-8'))
+    return os.path.join(os.path.expanduser(worker_path), '{0}-{1}.sock'.format(module_name, digest.hexdigest()[:16]))
+
+
+def _connect(socket_path):
+    """
+    Connect to the worker listening on socket_path, or return None when there
+    is none.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error as e:
+        sock.close()
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise WorkerError("Worker socket {0} could not be connected to: {1}".format(socket_path, str(e)))
+    return sock
+
+
+def _run_in_worker(sock, args):
+    """
+    Hand a task's arguments to a worker and return the exit code and output of
+    the module run, or None when the worker went away before accepting the
+    task, so that it is safe to run it elsewhere.
+    """
+    try:
+        sock.sendall(json.dumps(dict(args=args)).encode('utf-8') + b'\n')
+        reply = sock.makefile('rb')
+        accepted = reply.readline()
+        if not accepted:
+            return None
+        result = reply.readline()
+    except socket.error:
+        return None
+    finally:
+        sock.close()
+    if not result:
+        raise WorkerError("Worker exited while running the task")
+    result = json.loads(result.decode('utf-8'))
+    return result['rc'], result['output']
+
+
+def hand_off_to_worker(module_file, module_class=None):
+    """
+    Run the task in the worker of the module at module_file, when the worker
+    option of the task is set, and exit with the result. With module_class, a
+    worker serving it is started when none is running yet, and WorkerError is
+    raised when no worker can be used. Without, this returns when no worker is
+    running or can be used, as it does when the worker option is not set.
+
+    This reads the task arguments the way AnsibleModule does, so it only is to
+    be called where the module is run, not imported.
+    """
+    if _serving is not None:
+        return
+    args = basic._load_params()
+    if not boolean(args.get('worker', False), strict=False):
+        return
+    try:
+        result = _hand_off(args, module_file, module_class)
+    except (WorkerError, IOError, OSError):
+        if module_class is None:
+            return
+        raise
+    if result is None:
+        return
+
+    rc, output = result
+    sys.stdout.write(output)
+    sys.stdout.flush()
+    sys.exit(rc)
+
+
+def _hand_off(args, module_file, module_class):
+    if not hasattr(socket, 'AF_UNIX') or not hasattr(os, 'fork') or fcntl is None:
+        raise WorkerError("Workers are not supported on this platform")
+
+    socket_path = worker_socket_path(args.get('worker_path') or WORKER_ARGS['worker_path']['default'], module_file)
+    sock = _connect(socket_path)
+    result = _run_in_worker(sock, args) if sock is not None else None
+    if result is None and module_class is not None:
+        idle_timeout = int(args.get('worker_idle_timeout') or WORKER_ARGS['worker_idle_timeout']['default'])
+        result = _run_in_worker(start_worker(module_class, socket_path, idle_timeout), args)
+        if result is None:
+            raise WorkerError("Worker {0} did not accept the task".format(socket_path))
+    return result
+
+
+def start_worker(module_class, socket_path, idle_timeout):
+    """
+    Start a worker serving module_class on socket_path, unless another task
+    did so first, and return a connection to it.
+    """
+    directory = os.path.dirname(socket_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+
+    with open(socket_path + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        sock = _connect(socket_path)
+        if sock is not None:
+            return sock
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        pid = os.fork()
+        if pid == 0:
+            # Detach from the task twice over, so that neither the task nor
+            # the connection it was started over wait for the worker.
+            lock.close()
+            os.setsid()
+            if os.fork() != 0:
+                os._exit(0)
+            try:
+                Worker(module_class, socket_path, idle_timeout).serve()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        deadline = time.time() + WORKER_START_TIMEOUT
+        while time.time() < deadline:
+            sock = _connect(socket_path)
+            if sock is not None:
+                return sock
+            time.sleep(0.01)
+    raise WorkerError("Worker {0} did not start within {1} seconds".format(socket_path, WORKER_START_TIMEOUT))
+
+
+def _preload_payload():
+    """
+    Load all module_utils of the AnsiballZ payload the module runs from, as
+    the payload is removed once the task that started the worker ends.
+    """
+    import zipfile
+
+    for entry in list(sys.path):
+        if not entry.endswith('.zip') or not os.path.isfile(entry):
+            continue
+        with zipfile.ZipFile(entry) as payload:
+            names = payload.namelist()
+        for name in names:
+            if not name.startswith('ansible/module_utils/') or not name.endswith('.py'):
+                continue
+            name = name[:-len('.py')].replace('/', '.')
+            if name.endswith('.__init__'):
+                name = name[:-len('.__init__')]
+            try:
+                importlib.import_module(name)
+            except Exception:
+                pass
+
+
+class _ThreadOutput(object):
+    """
+    Standard output sending what the module run of a thread prints to that
+    run's output, and anything else to the stream it replaces.
+    """
+
+    def __init__(self, stream):
+        self._stream = stream
+
+    def write(self, data):
+        output = getattr(_local, 'output', None)
+        if output is None:
+            return self._stream.write(data)
+        output.append(data)
+
+    def flush(self):
+        if getattr(_local, 'output', None) is None:
+            self._stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+def _thread_params():
+    return copy.deepcopy(_local.args)
+
+
+class Worker(object):
+    """
+    Server running module_class for every task handed to it on socket_path,
+    until it has been idle for idle_timeout seconds.
+    """
+
+    def __init__(self, module_class, socket_path, idle_timeout):
+        self.module_class = module_class
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self.started = time.time()
+        self.last_used = self.started
+        self.active = 0
+        self.runs = 0
+        self._idle = 0
+        self._connections = queue.Queue()
+        self._lock = threading.Lock()
+        self._shared_lock = threading.Lock()
+        self._auths = dict()
+        self._clients = dict()
+
+    def info(self):
+        with self._lock:
+            return dict(pid=os.getpid(),
+                        runs=self.runs,
+                        uptime=round(time.time() - self.started, 3))
+
+    def install(self):
+        """
+        Prepare this process for running modules in threads: module arguments
+        and output are kept per thread, and authentication and SDK clients
+        are shared between the runs using the same credentials.
+        """
+        from ansible.module_utils import azure_rm_common
+        from ansible.module_utils.azure_rm_token_cache import TOKEN_CACHE_ARGS
+
+        global _serving
+        _serving = self
+        basic._load_params = _thread_params
+        sys.stdout = _ThreadOutput(sys.stdout)
+
+        auth_keys = sorted(list(azure_rm_common.AZURE_COMMON_ARGS.keys()) + list(TOKEN_CACHE_ARGS.keys()))
+        azure_rm_auth = azure_rm_common.AzureRMAuth
+        get_mgmt_svc_client = azure_rm_common.AzureRMModuleBase.get_mgmt_svc_client
+        worker = self
+
+        # Tasks arriving together with the same credentials wait for the
+        # first of them to authenticate rather than all authenticating.
+        def shared_auth(fail_impl=None, **kwargs):
+            key = repr([(name, kwargs.get(name)) for name in auth_keys])
+            with worker._shared_lock:
+                if key not in worker._auths:
+                    worker._auths[key] = azure_rm_auth(fail_impl=fail_impl, **kwargs)
+                return worker._auths[key]
+
+        def shared_client(module, client_type, base_url=None, api_version=None):
+            key = (id(module.azure_auth), client_type, base_url, api_version, module.api_profile)
+            with worker._shared_lock:
+                if key not in worker._clients:
+                    client = get_mgmt_svc_client(module, client_type, base_url=base_url, api_version=api_version)
+                    # msrest closes the connection pool of a client after
+                    # every request unless it is kept alive.
+                    client.config.keep_alive = True
+                    worker._clients[key] = client
+                return worker._clients[key]
+
+        azure_rm_common.AzureRMAuth = shared_auth
+        azure_rm_common.AzureRMModuleBase.get_mgmt_svc_client = shared_client
+
+    def serve(self):
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.close(devnull)
+        os.chdir('/')
+        os.umask(0o077)
+        _preload_payload()
+        self.install()
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        inode = os.stat(self.socket_path).st_ino
+        server.listen(64)
+        server.settimeout(WORKER_IDLE_CHECK_INTERVAL)
+        try:
+            while True:
+                try:
+                    conn = server.accept()[0]
+                except socket.timeout:
+                    with self._lock:
+                        if not self.active and time.time() - self.last_used > self.idle_timeout:
+                            break
+                    continue
+                self.dispatch(conn)
+        finally:
+            server.close()
+            # A worker started after this one went idle may own the path by now.
+            if os.path.exists(self.socket_path) and os.stat(self.socket_path).st_ino == inode:
+                os.unlink(self.socket_path)
+
+    def dispatch(self, conn):
+        """
+        Hand a connection to an idle thread, or to a new one when all are busy.
+        Threads are kept for the next tasks, as the SDK clients keep a session,
+        and with it pooled connections, per thread.
+        """
+        with self._lock:
+            self.active += 1
+            if self._idle:
+                self._idle -= 1
+                spawn = False
+            else:
+                spawn = True
+        if spawn:
+            thread = threading.Thread(target=self._handle_connections)
+            thread.daemon = True
+            thread.start()
+        self._connections.put(conn)
+
+    def _handle_connections(self):
+        while True:
+            self.handle(self._connections.get())
+            with self._lock:
+                self._idle += 1
+
+    def _peer_allowed(self, conn):
+        if not hasattr(socket, 'SO_PEERCRED'):
+            return True
+        uid = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))[1]
+        return uid == os.getuid()
+
+    def handle(self, conn):
+        try:
+            conn.settimeout(None)
+            if not self._peer_allowed(conn):
+                return
+            request = conn.makefile('rb').readline()
+            if not request:
+                return
+            args = json.loads(request.decode('utf-8'))['args']
+            conn.sendall(b'{"accepted": true}\n')
+            rc, output = self.run(args)
+            conn.sendall(json.dumps(dict(rc=rc, output=output)).encode('utf-8') + b'\n')
+        except Exception:
+            pass
+        finally:
+            conn.close()
+            with self._lock:
+                self.active -= 1
+                self.last_used = time.time()
+
+    def run(self, args):
+        """
+        Run the module with a task's arguments and return its exit code and
+        everything it printed.
+        """
+        with self._lock:
+            self.runs += 1
+        _local.args = args
+        _local.output = []
+        rc = 1
+        try:
+            self.module_class()
+            _local.output.append(json.dumps(dict(failed=True, msg="Module did not exit")))
+        except SystemExit as e:
+            rc = e.code if isinstance(e.code, int) else int(e.code is not None)
+        except Exception as e:
+            _local.output.append(json.dumps(dict(failed=True, msg="Worker could not run the module: {0}".format(str(e)),
+                                                 exception=traceback.format_exc())))
+        finally:
+            output = ''.join(_local.output)
+            _local.args = None
+            _local.output = None
+        return rc, output
+
+
+class WorkerMixin(object):
+    """
+    Mixin for AzureRMModuleBase subclasses adding the worker options. It has to
+    come first in the bases, so that a task is handed to the worker before the
+    module authenticates. Modules also call hand_off_to_worker before importing
+    the Azure SDK, which spares a task that finds its worker running the import.
+
+    Tasks run by a worker report it as ``worker`` in their results. When no
+    worker can be used, the task runs as if the option was not set and reports
+    why as ``worker.error``.
+    """
+
+    _worker_error = None
+
+    def __init__(self, *args, **kwargs):
+        module_file = getattr(sys.modules.get(type(self).__module__), '__file__', None)
+        if module_file:
+            try:
+                hand_off_to_worker(module_file, module_class=type(self))
+            except (WorkerError, IOError, OSError) as e:
+                self._worker_error = str(e)
+        super(WorkerMixin, self).__init__(*args, **kwargs)
+
+    def add_metrics(self, results):
+        if getattr(self, 'worker', False):
+            results['worker'] = _serving.info() if _serving is not None else dict(error=self._worker_error)
+        return super(WorkerMixin, self).add_metrics(results)
@@ -24,7 +24,8 @@ author: "Emma Laurijssens van Engelenhoven"
 description:
   - "Capture an Azure Virtual Machine image for the deployment of other VMs in Azure 
      The VM should be generalized usimg sysprep. After this command runs, the Virtual Machine will be unusable.
-     Depends on pip azure module 2.0.0 or above and azure-mgmt-compute 2.1.0 and above."
+     Depends on pip azure module 2.0.0 or above and azure-mgmt-compute 2.1.0 and above.
+     I(replicate_to) depends on azure-mgmt-compute 10.0.0 and above."
 module: azure_rm_image
 options:
   resource_group_name:
@@ -33,11 +34,27 @@ options:
     required: true
   name:
     description:
-      - "The name of the image being created."
-    required: True
+      - "The name of the image being created. Required unless I(images) is used."
+    required: false
   vm_name:
     description:
-      - "The name of the VM within the resource group to capture. Required when state=present."
+      - "The name of the VM within the resource group to capture. Required when state=present, unless
+         I(images) is used."
+    required: false
+  images:
+    description:
+      - "List of images to capture in one run, each a dict with I(vm_name), I(name) and optionally
+         I(location) and I(tags). The VMs are deallocated, generalized and captured concurrently. The
+         result holds one entry per image in I(images); captures that fail are reported there without
+         stopping the others, and the module fails once all captures have finished."
+    type: list
+    required: false
+  max_concurrency:
+    description:
+      - "Maximum number of VMs captured at the same time when I(images) is used, or of images deleted at the
+         same time when pruning."
+    type: int
+    default: 8
     required: false
   location:
     description:
@@ -46,13 +63,206 @@ options:
     required: false
   state:
     description:
-      - "The desired state of the image"
+      - "The desired state of the image. C(pruned) deletes the images of the resource group matching
+         I(name_pattern) that fall outside the retention given by I(keep_latest) and I(older_than)."
     default: present
-    choices: present, absent
+    choices: present, absent, pruned
     required: false
   tags:
     description:
-        - Tags to assign to the image.
+        - Tags to assign to the image. Captured images also get a tag named after I(created_tag) holding
+          the time of the capture, unless I(tags) already sets it.
+    required: false
+  name_pattern:
+    description:
+      - "Images considered for pruning when state=pruned, see I(name_pattern_type)."
+    required: false
+  name_pattern_type:
+    description:
+      - "How I(name_pattern) is interpreted: C(glob) matches the whole name against a shell-style wildcard
+         pattern, C(regex) searches the name for a Python regular expression."
+    choices:
+      - glob
+      - regex
+    default: glob
+    required: false
+  keep_latest:
+    description:
+      - "When pruning, number of most recently created matching images that are always kept."
+    type: int
+    required: false
+  older_than:
+    description:
+      - "When pruning, only delete images created longer ago than this. A number followed by an optional
+         unit of C(s), C(m), C(h), C(d) or C(w); days when no unit is given. Combined with I(keep_latest),
+         an image is deleted only when it is both outside the latest ones and older than this."
+    required: false
+  created_tag:
+    description:
+      - "Name of the tag holding the creation time of an image, as C(YYYY-MM-DDTHH:MM:SSZ) in UTC or
+         C(YYYY-MM-DD). Image resources carry no creation time of their own, so pruning orders images by
+         this tag, and images without it are never pruned but reported as I(skipped)."
+    default: ansible-created
+    required: false
+  replicate_to:
+    description:
+      - "List of regions to copy the image given by I(name) to once it has been captured, or found to exist
+         already. All regions are copied to at the same time, at most I(max_concurrency) at once. The disks of
+         the image are snapshotted once in its own region, and only their allocated ranges are copied, server
+         side, into disks uploaded in every target region, from which the regional images are created. A
+         region whose copy was made from the current version of the image, as told by I(created_tag), is left
+         alone, and an outdated copy is replaced. The result lists in I(replicas) the status, duration and
+         bytes copied of every region. Requires I(wait)."
+      - "Requires azure-mgmt-compute 10.0.0 or above, which provides compute API version 2019-07-01."
+    type: list
+    required: false
+  replica_name:
+    description:
+      - "Name of the copy of the image in each region of I(replicate_to), in the resource group of the image.
+         C({name}) and C({location}) are replaced by the name of the image and the region."
+    default: "{name}-{location}"
+    required: false
+  capture_mode:
+    description:
+      - "How VMs are captured. C(generalize) deallocates the VM, marks it generalized and creates the image
+         from it, which leaves the VM unusable. C(snapshot) stops the VM only for as long as it takes to
+         snapshot its managed disks, starts it again if it was running, and creates the image from the
+         snapshots afterwards, deleting them once the image exists, or once the copies of I(replicate_to)
+         have been made from them. When the module stops waiting before the image exists, because of
+         I(wait=false) or I(timeout), the snapshots are listed in its I(token) and deleted by
+         azure_rm_image_operation once the image has been created or has failed. The operating system
+         inside the VM must have been prepared for imaging, for example with sysprep or waagent -deprovision,
+         as the image is created as generalized. The result reports the seconds the VM was stopped in I(downtime) next to
+         the total I(duration) of the capture."
+    choices:
+      - generalize
+      - snapshot
+    default: generalize
+    required: false
+  wait:
+    description:
+      - "Wait for the image to be created. When false the VM is still deallocated and generalized, but the
+         module returns as soon as image creation has been started, with a I(token) describing the operation.
+         Pass registered tokens to azure_rm_image_operation to check on or wait for them."
+    type: bool
+    default: true
+    required: false
+  inventory_cache_ttl:
+    description:
+      - "Number of seconds an image listing is cached on disk and shared with other tasks and
+         with azure_rm_image_facts. 0 disables the cache."
+    type: int
+    default: 0
+    required: false
+  inventory_cache_path:
+    description:
+      - "Directory holding the image listing cache."
+    type: path
+    default: ~/.ansible/azure_image_cache
+    required: false
+  etag_revalidation:
+    description:
+      - "When checking whether the image given by I(name) exists, keep it in I(inventory_cache_path) with the
+         ETag it was served with, and revalidate it with a conditional request on later checks. The result
+         reports in I(lookup) whether the image was C(revalidated) or C(fetched)."
+    type: bool
+    default: false
+    required: false
+  poll_interval:
+    description:
+      - "Number of seconds before the first status check of a long-running operation such as deallocating
+         a VM or creating an image. Later checks are spaced further apart, see I(poll_backoff)."
+    type: float
+    default: 2
+    required: false
+  poll_backoff:
+    description:
+      - "Factor by which the time between two status checks grows, up to 30 seconds."
+    type: float
+    default: 1.5
+    required: false
+  timeout:
+    description:
+      - "Maximum number of seconds to wait for long-running operations in total. Operations that have not
+         finished by then are reported with status C(Timed out) instead of being waited for."
+    type: int
+    default: 3600
+    required: false
+  diagnostics:
+    description:
+      - "Add a C(metrics) block to the result listing every Azure API call made, its duration, the number of
+         pages read for listings and the number of status polls for long-running operations."
+    type: bool
+    default: false
+    required: false
+  token_cache:
+    description:
+      - "Keep the Azure AD access token acquired for I(client_id) and I(tenant) in I(token_cache_path), and reuse
+         it in later tasks for as long as it stays valid for at least five more minutes, instead of acquiring a
+         new one every task. Tokens are kept per tenant, client and scope, encrypted with a key derived from
+         I(secret). Only service principal credentials are cached. The result reports in I(token_cache)
+         whether the token was a C(hit) or a C(miss), or C(unsupported) for other credentials. Requires the
+         cryptography package."
+    type: bool
+    default: false
+    required: false
+  token_cache_path:
+    description:
+      - "Directory holding the token cache."
+    type: path
+    default: ~/.ansible/azure_token_cache
+    required: false
+  request_rate:
+    description:
+      - "Most Azure API requests per second sent by the tasks of this module for the subscription, in the
+         same process. Without it, requests are only slowed down once Azure reports that few requests remain
+         in the C(x-ms-ratelimit-remaining-*) response headers or throttles one with HTTP 429, and sped up
+         again while it does not, up to I(request_rate)."
+    type: float
+    required: false
+  request_burst:
+    description:
+      - "Requests that may be sent at once before I(request_rate) applies. Requests are also slowed down once
+         Azure reports no more than this many remaining."
+    type: int
+    default: 10
+    required: false
+  throttle_retries:
+    description:
+      - "Times a request throttled by Azure is sent again, after the delay given by its C(Retry-After) header,
+         or after a randomized exponential backoff. Requests of all the operations running in the process wait
+         out a C(Retry-After) together."
+    type: int
+    default: 6
+    required: false
+  throttle_max_delay:
+    description:
+      - "Longest backoff, in seconds, before sending a throttled request again. A request is failed instead
+         when Azure asks for a longer delay."
+    type: int
+    default: 60
+    required: false
+  worker:
+    description:
+      - "Hand the task to a long-lived local worker process for this module, listening on a Unix socket in
+         I(worker_path), and start one when none is running. The worker keeps the authentication and the Azure
+         API connections of earlier tasks run with the same credentials, sparing every later task the Azure SDK
+         imports, the authentication and the connection setup. Tasks run by a worker report it in I(worker).
+         Not supported on Windows."
+    type: bool
+    default: false
+    required: false
+  worker_path:
+    description:
+      - "Directory holding the worker sockets."
+    type: path
+    default: ~/.ansible/azure_worker
+    required: false
+  worker_idle_timeout:
+    description:
+      - "Seconds after which a worker that was not handed any task exits."
+    type: int
+    default: 300
     required: false
 
 short_description: "Capture Azure Virtual Machine Images"
@@ -78,6 +288,32 @@ EXAMPLES = '''
         location: "{{ location }}"
         state: present
 
+    - name: Capture several images at once
+      azure_rm_image:
+        resource_group_name: "{{ resource_group_name }}"
+        images:
+          - vm_name: web-template
+            name: web-image
+          - vm_name: db-template
+            name: db-image
+            tags:
+              role: db
+        max_concurrency: 4
+
+    - name: Start capturing images without waiting for them
+      azure_rm_image:
+        resource_group_name: "{{ resource_group_name }}"
+        vm_name: "{{ item }}"
+        name: "{{ item }}-image"
+        wait: false
+      loop: "{{ vm_names }}"
+      register: captures
+
+    - name: Wait for all captures to finish
+      azure_rm_image_operation:
+        tokens: "{{ captures.results | map(attribute='token') | list }}"
+        wait: true
+
     - name: Delete image
       azure_rm_image:
         subscription_id: "{{ subscription_id }}"
@@ -88,20 +324,116 @@ EXAMPLES = '''
         name: "{{ vm-name }}-image"
         location: "{{ location }}"
         state: absent
+
+    - name: Delete golden images older than 30 days, keeping the 3 latest
+      azure_rm_image:
+        resource_group_name: "{{ resource_group_name }}"
+        name_pattern: "golden-*"
+        keep_latest: 3
+        older_than: 30d
+        state: pruned
+
+    - name: Capture an image from disk snapshots, keeping the VM in service
+      azure_rm_image:
+        resource_group_name: "{{ resource_group_name }}"
+        vm_name: web-template
+        name: web-image
+        capture_mode: snapshot
+
+    - name: Capture an image and copy it to two more regions
+      azure_rm_image:
+        resource_group_name: "{{ resource_group_name }}"
+        vm_name: web-template
+        name: web-image
+        replicate_to:
+          - northeurope
+          - eastus
 '''
 
+import calendar
+import re
+import threading
+import time
+
+from ansible.module_utils.azure_rm_worker import WORKER_ARGS, WorkerMixin, hand_off_to_worker
+
+if __name__ == '__main__':
+    # Hand the task to its worker, when one is running, before the Azure SDK
+    # is imported. See azure_rm_worker.
+    hand_off_to_worker(__file__)
+
 from ansible.module_utils.azure_rm_common import AzureRMModuleBase
+from ansible.module_utils.azure_rm_client_proxy import CLIENT_PROXY_ARGS, ClientProxyMixin
+from ansible.module_utils.azure_rm_token_cache import TOKEN_CACHE_ARGS, TokenCacheMixin
+from ansible.module_utils.azure_rm_throttle import THROTTLE_ARGS
+from ansible.module_utils.azure_rm_image_common import (IMAGE_CACHE_ARGS, LOOKUP_FETCHED, ImageETagCache, ImageFilter,
+                                                        ImageInventoryCache, get_image, iter_images)
+from ansible.module_utils.azure_rm_operations import (POLLING_ARGS, OperationPolicy, OperationTimeout,
+                                                      operation_token, run_concurrently)
+from ansible.module_utils.azure_rm_page_blob import copy_page_ranges, get_blob_size, get_page_ranges, range_bytes
+from ansible.module_utils.azure_rm_snapshot_common import SnapshotClientMixin, vm_disks
 
 try:
     from msrestazure.azure_exceptions import CloudError
-    from azure.mgmt.compute.models import Image
-    from azure.mgmt.compute.models import SubResource
-# from azure.mgmt.compute.models import VirtualMachineCaptureParameters
 except:
     pass
 
+IMAGE_ID_FORMAT = "/subscriptions/{}/resourceGroups/{}/providers/Microsoft.Compute/images/{}"
+CREATED_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+DURATION_UNITS = dict(s=1, m=60, h=3600, d=86400, w=604800)
+CAPTURE_TAG = 'ansible-capture-of'
+REPLICA_OF_TAG = 'ansible-replica-of'
+REPLICA_VERSION_TAG = 'ansible-replica-version'
+# Seconds a SAS url handed out for copying disks between regions stays valid.
+REPLICATION_ACCESS_SECONDS = 86400
+
+
+class ImageCaptureError(Exception):
+    pass
+
+
+def normalize_location(location):
+    return location.replace(' ', '').lower()
+
+
+def resource_group_and_name(resource_id):
+    parts = resource_id.split('/')
+    return parts[4], parts[-1]
+
+
+def failed_snapshots(taken):
+    """
+    Describe the snapshots of snapshot_disks that did not succeed.
+    """
+    return ["{} ({})".format(info['name'], info.get('error', info['status']))
+            for info in taken if info['status'] != "Succeeded"]
+
+
+def parse_created(value):
+    """
+    Return the creation time held by a creation tag as a timestamp, or None
+    when it is missing or not in a supported format.
+    """
+    for time_format in (CREATED_FORMAT, "%Y-%m-%d"):
+        try:
+            return calendar.timegm(time.strptime(value, time_format))
+        except (TypeError, ValueError):
+            pass
+    return None
+
+
+def parse_duration(value):
+    """
+    Return the number of seconds in a duration like 90m or 30d, or None when
+    it cannot be parsed. Plain numbers are days.
+    """
+    match = re.match(r'^\s*(\d+)\s*([smhdw]?)\s*$', str(value))
+    if not match:
+        return None
+    return int(match.group(1)) * DURATION_UNITS[match.group(2) or 'd']
 
-class AzureRMImage(AzureRMModuleBase):
+
+class AzureRMImage(WorkerMixin, SnapshotClientMixin, TokenCacheMixin, ClientProxyMixin, AzureRMModuleBase):
     def __init__(self):
 
         self.module_arg_spec = dict(
@@ -115,7 +447,23 @@ class AzureRMImage(AzureRMModuleBase):
             ),
             name=dict(
                 type='str',
-                required=True
+                required=False
+            ),
+            images=dict(
+                type='list',
+                elements='dict',
+                required=False,
+                options=dict(
+                    vm_name=dict(type='str', required=True),
+                    name=dict(type='str', required=True),
+                    location=dict(type='str', required=False),
+                    tags=dict(type='dict', required=False)
+                )
+            ),
+            max_concurrency=dict(
+                type='int',
+                required=False,
+                default=8
             ),
             location=dict(
                 type='str',
@@ -125,19 +473,105 @@ class AzureRMImage(AzureRMModuleBase):
                 type='str',
                 required=False,
                 default='present',
-                choices=['present', 'absent']
+                choices=['present', 'absent', 'pruned']
+            ),
+            wait=dict(
+                type='bool',
+                required=False,
+                default=True
+            ),
+            name_pattern=dict(
+                type='str',
+                required=False
+            ),
+            name_pattern_type=dict(
+                type='str',
+                required=False,
+                default='glob',
+                choices=['glob', 'regex']
+            ),
+            keep_latest=dict(
+                type='int',
+                required=False
+            ),
+            older_than=dict(
+                type='str',
+                required=False
+            ),
+            created_tag=dict(
+                type='str',
+                required=False,
+                default='ansible-created'
+            ),
+            replicate_to=dict(
+                type='list',
+                elements='str',
+                required=False
+            ),
+            replica_name=dict(
+                type='str',
+                required=False,
+                default='{name}-{location}'
+            ),
+            capture_mode=dict(
+                type='str',
+                required=False,
+                default='generalize',
+                choices=['generalize', 'snapshot']
             )
         )
+        self.module_arg_spec.update(IMAGE_CACHE_ARGS)
+        self.module_arg_spec.update(CLIENT_PROXY_ARGS)
+        self.module_arg_spec.update(TOKEN_CACHE_ARGS)
+        self.module_arg_spec.update(THROTTLE_ARGS)
+        self.module_arg_spec.update(WORKER_ARGS)
+        self.module_arg_spec.update(POLLING_ARGS)
 
         required_if = [
-            ('state', 'present', ['vm_name'])
+            ('state', 'absent', ['name']),
+            ('state', 'pruned', ['name_pattern'])
+        ]
+
+        mutually_exclusive = [
+            ['images', 'vm_name'],
+            ['images', 'name'],
+            ['images', 'replicate_to']
         ]
 
         self.resource_group = None
         self.vm_name = None
         self.name = None
+        self.images = None
+        self.max_concurrency = None
         self.state = None
         self.location = None
+        self.wait = None
+        self.name_pattern = None
+        self.name_pattern_type = None
+        self.keep_latest = None
+        self.older_than = None
+        self.created_tag = None
+        self.replicate_to = None
+        self.replica_name = None
+        self.capture_mode = None
+        self.capture_snapshots = []
+        self.inventory_cache_ttl = None
+        self.inventory_cache_path = None
+        self.image_cache = None
+        self.etag_revalidation = None
+        self.etag_cache = None
+        self.lookup = None
+        self.diagnostics = None
+        self.token_cache = None
+        self.token_cache_path = None
+        self.request_rate = None
+        self.request_burst = None
+        self.throttle_retries = None
+        self.throttle_max_delay = None
+        self.poll_interval = None
+        self.poll_backoff = None
+        self.timeout = None
+        self.polling_policy = None
 
         self.results = dict(
             changed=False,
@@ -147,6 +581,7 @@ class AzureRMImage(AzureRMModuleBase):
         super(AzureRMImage, self).__init__(
             derived_arg_spec=self.module_arg_spec,
             required_if=required_if,
+            mutually_exclusive=mutually_exclusive,
             supports_check_mode=True,
             supports_tags=True)
 
@@ -155,6 +590,10 @@ class AzureRMImage(AzureRMModuleBase):
         for key in list(self.module_arg_spec.keys()) + ['tags']:
             setattr(self, key, kwargs[key])
 
+        self.image_cache = ImageInventoryCache(self.inventory_cache_path, self.inventory_cache_ttl)
+        self.etag_cache = ImageETagCache(self.inventory_cache_path, self.etag_revalidation)
+        self.polling_policy = OperationPolicy(self.poll_interval, self.poll_backoff, self.timeout)
+
         try:
             resource_group = self.get_resource_group(self.resource_group)
         except CloudError:
@@ -162,84 +601,314 @@ class AzureRMImage(AzureRMModuleBase):
         if not self.location:
             self.location = resource_group.location
         if self.state == 'present':
-            self.results = self.capture_image()
+            if self.images:
+                self.results = self.capture_images()
+            elif self.vm_name and self.name:
+                if self.replicate_to and not self.wait:
+                    self.fail("replicate_to requires wait")
+                if self.replicate_to:
+                    self.check_snapshot_api('replicate_to')
+                try:
+                    self.results = self.capture_image()
+                    if self.replicate_to and self.results['status'] in ("Succeeded", "Image already exists"):
+                        self.replicate_image()
+                finally:
+                    self._delete_capture_snapshots(self.capture_snapshots)
+            else:
+                self.fail("vm_name and name, or images, are required when state is present")
         elif self.state == 'absent':
             self.results = self.delete_image()
-        return self.results
+        elif self.state == 'pruned':
+            self.results = self.prune_images()
+        return self.add_metrics(self.results)
 
-    def _list_images(self):
+    def _iter_images(self):
         try:
-            images = self.compute_client.images
-            image_list = images.list()  # (resource_group_name=self.resource_group, name=self.name)
+            for image in self.image_cache.get_or_fetch(self.subscription_id, self.resource_group,
+                                                       lambda: iter_images(self.compute_client,
+                                                                           self.resource_group)):
+                yield image
         except CloudError:
             self.fail("No images found!")
         except Exception as e:
             self.fail("An exception occurred: {}".format(str(e)))
 
-        named_images = []
+    def _image_exists(self, name):
+        try:
+            self.lookup = get_image(self.compute_client.memoized, self.etag_cache, self.subscription_id,
+                                    self.resource_group, name)[1]
+        except CloudError as e:
+            if e.status_code == 404:
+                self.lookup = LOOKUP_FETCHED
+                return False
+            raise
+        return True
 
-        for image in image_list:
-            image_info = dict(name=image.name,
-                              location=image.location,
-                              resource_group=image.id.split("/")[4],
-                              managed=(not (image.storage_profile.os_disk.managed_disk is None))
-                              )
-            named_images.append(image_info)
+    def capture_image(self):
 
-        return named_images
+        spec = dict(vm_name=self.vm_name,
+                    name=self.name,
+                    location=self.location,
+                    tags=self.tags)
+        try:
+            return dict(self._capture(spec, self._image_exists), lookup=self.lookup)
+        except ImageCaptureError as e:
+            self.fail(str(e))
+        except Exception as e:
+            self.fail("An exception occurred: {}".format(str(e)))
 
-    def capture_image(self):
+    def capture_images(self):
+
+        existing = set(elem['name'] for elem in self._iter_images())
+        specs = [dict(vm_name=image['vm_name'],
+                      name=image['name'],
+                      location=image.get('location') or self.location,
+                      tags=image.get('tags') or self.tags) for image in self.images]
+
+        outcomes = run_concurrently(lambda spec: self._capture(spec, existing.__contains__),
+                                    specs, self.max_concurrency)
+
+        images = []
+        for spec, (return_data, error) in zip(specs, outcomes):
+            if error is not None:
+                return_data = dict(name=spec['name'],
+                                   vm_name=spec['vm_name'],
+                                   status="Failed",
+                                   error=str(error),
+                                   changed=False)
+            images.append(return_data)
+
+        results = dict(changed=any(image['changed'] for image in images),
+                       images=images)
 
+        failed = [image['name'] for image in images if image['status'] == "Failed"]
+        if failed:
+            self.fail("Capturing failed for {}".format(", ".join(failed)), **results)
+
+        return results
+
+    def _capture(self, spec, exists):
+        """
+        Capture a single VM described by spec. Errors are raised rather than
+        failing the module, so that one capture of a batch cannot abort the others.
+        """
         try:
             vms = self.compute_client.virtual_machines
-            vms.get(resource_group_name=self.resource_group, vm_name=self.vm_name)
+            vm = vms.get(resource_group_name=self.resource_group, vm_name=spec['vm_name'])
         except CloudError:
-            self.fail("VM {} not found!".format(self.vm_name))
-        except Exception as e:
-            self.fail("An exception occurred: {}".format(str(e)))
+            raise ImageCaptureError("VM {} not found!".format(spec['vm_name']))
 
-        image_names = self._list_images()
+        if exists(spec['name']):
+            return dict(name=spec['name'],
+                        status="Image already exists",
+                        changed=False)
 
-        found = any(elem['name'] == self.name for elem in image_names)
+        source_vm = vm.id
+        tags = dict(spec['tags'] or {})
+        tags.setdefault(self.created_tag, time.strftime(CREATED_FORMAT, time.gmtime()))
+        if self.check_mode:
+            return dict(name=spec['name'],
+                        status="Succeeded",
+                        location=spec['location'],
+                        resource_group=self.resource_group,
+                        changed=True)
 
-        if not found:
+        policy = self.polling_policy
+        started = time.time()
+        downtime = None
+        snapshot_names = []
+        images = self.compute_client.images
+        if self.capture_mode == 'snapshot':
+            downtime, snapshots, params = self._snapshot_vm(spec, vm, tags)
+            snapshot_names = [snapshot.name for snapshot in snapshots]
+        else:
+            models = self.compute_models
+            params = models.Image(location=spec['location'], source_virtual_machine=models.SubResource(id=source_vm),
+                                  tags=tags)
+            try:
+                policy.wait(vms.deallocate(self.resource_group, spec['vm_name'], polling=policy.polling()),
+                            "VM {} to be deallocated".format(spec['vm_name']))
+            except OperationTimeout as e:
+                raise ImageCaptureError(str(e))
+            vms.generalize(self.resource_group, spec['vm_name'])
+        try:
+            operation = images.create_or_update(resource_group_name=self.resource_group,
+                                                image_name=spec['name'], parameters=params,
+                                                polling=policy.polling())
+        except Exception:
+            self._delete_capture_snapshots(snapshot_names)
+            raise
+        self.image_cache.invalidate(self.subscription_id, self.resource_group)
+        self.etag_cache.drop(self.subscription_id, self.resource_group, spec['name'])
+        resource = dict()
+        if snapshot_names:
+            # The image is read from the snapshots until it exists, so when
+            # this run stops waiting before then, azure_rm_image_operation
+            # deletes them once it sees the image finished.
+            resource['snapshots'] = snapshot_names
+        token = operation_token(operation, 'image_capture',
+                                subscription_id=self.subscription_id,
+                                resource_group=self.resource_group,
+                                name=spec['name'],
+                                image_id=IMAGE_ID_FORMAT.format(self.subscription_id,
+                                                                self.resource_group,
+                                                                spec['name']),
+                                vm_id=source_vm,
+                                **resource)
+        timing = dict()
+        if downtime is not None:
+            timing['downtime'] = downtime
+        if not self.wait:
+            return dict(name=spec['name'],
+                        status="Creating",
+                        location=spec['location'],
+                        resource_group=self.resource_group,
+                        token=token,
+                        snapshots=snapshot_names,
+                        duration=round(time.time() - started, 3),
+                        changed=True, **timing)
+        try:
+            result = policy.wait(operation, "image {} to be created".format(spec['name']))
+        except OperationTimeout as e:
+            return dict(name=spec['name'],
+                        status="Timed out",
+                        msg="{}; pass the token to azure_rm_image_operation to wait for it".format(str(e)),
+                        location=spec['location'],
+                        resource_group=self.resource_group,
+                        token=token,
+                        snapshots=snapshot_names,
+                        duration=round(time.time() - started, 3),
+                        changed=True, **timing)
+        except Exception:
+            self._delete_capture_snapshots(snapshot_names)
+            raise
 
-            images = self.compute_client.images
-            source_vm = vms.get(resource_group_name=self.resource_group, vm_name=self.vm_name).id
-            params = Image(location=self.location, source_virtual_machine=SubResource(source_vm))
-            if self.check_mode:
-                return_data = dict(name=self.name,
-                                   status="Succeeded",
-                                   location=self.location,
-                                   resource_group=self.resource_group,
-                                   changed=True)
-            else:
-                vms.deallocate(self.resource_group, self.vm_name).wait()
-                vms.generalize(self.resource_group, self.vm_name)
-                operation = images.create_or_update(resource_group_name=self.resource_group,
-                                                    image_name=self.name, parameters=params)
-                operation.wait()
-                result = operation.result()
-
-                return_data = dict(name=result.name,
-                                   status=result.provisioning_state,
-                                   location=result.location,
-                                   resource_group=self.resource_group,
-                                   changed=True)
+        if self.replicate_to:
+            # Replication reads the disks of the image from these snapshots.
+            self.capture_snapshots.extend(snapshot_names)
         else:
-            return_data = dict(name=self.name,
-                               status="Image already exists",
-                               changed=False)
+            self._delete_capture_snapshots(snapshot_names)
+        return dict(name=result.name,
+                    status=result.provisioning_state,
+                    location=result.location,
+                    resource_group=self.resource_group,
+                    duration=round(time.time() - started, 3),
+                    changed=True, **timing)
+
+    def _vm_running(self, vm_name):
+        view = self.compute_client.virtual_machines.instance_view(self.resource_group, vm_name)
+        return any(status.code == 'PowerState/running' for status in view.statuses or [])
+
+    def _snapshot_vm(self, spec, vm, tags):
+        """
+        Snapshot the managed disks of a VM, stopping it for the time the
+        snapshots take if it is running. Returns the seconds it was stopped,
+        the SDK snapshots and the parameters of an image made from them.
+        """
+        if vm.storage_profile.os_disk.managed_disk is None:
+            raise ImageCaptureError("VM {} does not use managed disks and cannot be captured from snapshots".format(
+                spec['vm_name']))
+        vms = self.compute_client.virtual_machines
+        policy = self.polling_policy
+        disks = vm_disks(vm)
+        names = dict((disk['name'], "{}-{}".format(spec['name'], disk['name'])) for disk in disks)
+
+        running = self._vm_running(spec['vm_name'])
+        stopped = time.time()
+        taken = []
+        try:
+            if running:
+                try:
+                    policy.wait(vms.power_off(self.resource_group, spec['vm_name'], polling=policy.polling()),
+                                "VM {} to be stopped".format(spec['vm_name']))
+                except OperationTimeout as e:
+                    raise ImageCaptureError(str(e))
+            taken = self.snapshot_disks(spec['vm_name'], disks, names, vm.location,
+                                        tags={CAPTURE_TAG: spec['name']},
+                                        max_concurrency=len(disks))
+        except Exception as e:
+            if running:
+                self._restart_vm(spec['vm_name'], taken, cause=e)
+            raise
+        if running:
+            self._restart_vm(spec['vm_name'], taken)
+        downtime = round(time.time() - stopped, 3) if running else 0
+
+        snapshots = [info['snapshot'] for info in taken if info['snapshot'] is not None]
+        failed = failed_snapshots(taken)
+        if failed:
+            # Snapshots that timed out are still being created, and are
+            # deleted by name like the others.
+            self._delete_capture_snapshots([info['name'] for info in taken])
+            raise ImageCaptureError("Snapshots of VM {} could not be taken: {}".format(spec['vm_name'],
+                                                                                       ", ".join(failed)))
 
-        return return_data
+        models = self.compute_models
+
+        def image_disk(disk, snapshot, cls, **kwargs):
+            return cls(snapshot=models.SubResource(id=snapshot.id),
+                       caching=disk['disk'].caching,
+                       storage_account_type=disk['disk'].managed_disk.storage_account_type,
+                       **kwargs)
+
+        os_disk = vm.storage_profile.os_disk
+        params = models.Image(
+            location=spec['location'],
+            tags=tags,
+            storage_profile=models.ImageStorageProfile(
+                os_disk=image_disk(disks[0], snapshots[0], models.ImageOSDisk,
+                                   os_type=os_disk.os_type, os_state='Generalized'),
+                data_disks=[image_disk(disk, snapshot, models.ImageDataDisk, lun=disk['lun'])
+                            for disk, snapshot in zip(disks[1:], snapshots[1:])]))
+        return downtime, snapshots, params
+
+    def _restart_vm(self, vm_name, taken, cause=None):
+        """
+        Start a VM stopped for its capture snapshots. When it does not start in
+        time the capture is given up: the snapshots in ``taken`` are deleted
+        and the timeout is raised as an ImageCaptureError, together with
+        ``cause``, the error that ended the snapshots, if any.
+        """
+        policy = self.polling_policy
+        try:
+            policy.wait(self.compute_client.virtual_machines.start(self.resource_group, vm_name,
+                                                                   polling=policy.polling()),
+                        "VM {} to be started".format(vm_name))
+        except OperationTimeout as e:
+            self._delete_capture_snapshots([info['name'] for info in taken])
+            errors = [str(cause)] if cause is not None else []
+            failed = failed_snapshots(taken)
+            if failed:
+                errors.append("Snapshots of VM {} could not be taken: {}".format(vm_name, ", ".join(failed)))
+            raise ImageCaptureError("; ".join(errors + [str(e)]))
+
+    def _delete_capture_snapshots(self, names):
+        """
+        Delete the snapshots an image was captured from, by name. Failures are
+        ignored, as the image no longer depends on them.
+        """
+        policy = self.polling_policy
+        operations = []
+        for name in names:
+            try:
+                operations.append(self.compute_client.snapshots.delete(self.resource_group, name,
+                                                                       polling=policy.polling()))
+            except Exception:
+                pass
+        for operation in operations:
+            try:
+                policy.wait(operation, "capture snapshot to be deleted")
+            except Exception:
+                pass
 
     def delete_image(self):
 
         changed = False
         status = "Not found"
-        image_names = self._list_images()
-
-        found = any(elem['name'] == self.name for elem in image_names)
+        try:
+            found = self._image_exists(self.name)
+        except Exception as e:
+            self.fail("An exception occurred: {}".format(str(e)))
 
         if found:
             if self.check_mode:
@@ -247,17 +916,357 @@ class AzureRMImage(AzureRMModuleBase):
                 changed = "True"
             else:
                 images = self.compute_client.images
-                operation = images.delete(resource_group_name=self.resource_group, name=self.name)
-
-                operation.wait()
-                result = operation.result()
-                status = result.status
+                operation = images.delete(resource_group_name=self.resource_group, image_name=self.name,
+                                          polling=self.polling_policy.polling())
+                self.image_cache.invalidate(self.subscription_id, self.resource_group)
+                self.etag_cache.drop(self.subscription_id, self.resource_group, self.name)
 
-                if status == "Succeeded":
+                try:
+                    result = self.polling_policy.wait(operation, "image {} to be deleted".format(self.name))
+                    status = result.status
+                    changed = status == "Succeeded"
+                except OperationTimeout:
+                    status = "Timed out"
                     changed = True
 
         return dict(changed=changed,
-                    status=status)
+                    status=status,
+                    lookup=self.lookup)
+
+    def replicate_image(self):
+        """
+        Copy the image given by name to every region of replicate_to that has no
+        up-to-date copy yet, adding the outcome per region to the results.
+        """
+        client = self.snapshot_client
+        try:
+            source = client.images.get(self.resource_group, self.name)
+        except CloudError as e:
+            if e.status_code != 404 or not self.check_mode:
+                self.fail("Image {} could not be read for replication: {}".format(self.name, str(e)))
+            source = None
+
+        version = ''
+        if source is not None:
+            version = (source.tags or {}).get(self.created_tag) or ''
+        source_region = normalize_location(source.location if source is not None else self.location)
+
+        replicas = []
+        pending = []
+        for location in self.replicate_to:
+            name = self.replica_name.format(name=self.name, location=normalize_location(location))
+            replica = dict(location=location, name=name)
+            replicas.append(replica)
+            if normalize_location(location) == source_region:
+                replica.update(status="Source region", changed=False)
+                continue
+            try:
+                existing = client.images.get(self.resource_group, name)
+            except CloudError as e:
+                if e.status_code != 404:
+                    self.fail("Image {} could not be read: {}".format(name, str(e)))
+                existing = None
+            tags = existing.tags or {} if existing is not None else {}
+            if (source is not None and existing is not None and existing.provisioning_state == "Succeeded" and
+                    tags.get(REPLICA_OF_TAG) == source.id.lower() and tags.get(REPLICA_VERSION_TAG, '') == version):
+                replica.update(status="Up to date", changed=False)
+                continue
+            replica['outdated'] = existing is not None
+            pending.append(replica)
+
+        self.results['replicas'] = replicas
+        if not pending:
+            return
+        self.results['changed'] = True
+        if self.check_mode:
+            for replica in pending:
+                replica.update(status="Would be copied", changed=True)
+            return
+
+        try:
+            sources, staged = self._replication_sources(source)
+        except Exception as e:
+            for replica in pending:
+                replica.update(status="Failed", error=str(e), changed=False)
+            self.fail("Disks of image {} could not be prepared for replication: {}".format(self.name, str(e)),
+                      **self.results)
+
+        try:
+            outcomes = run_concurrently(lambda replica: self._replicate(replica, source, version, sources),
+                                        pending, self.max_concurrency)
+        finally:
+            self._release_sources(sources, staged)
+
+        for replica, (_, error) in zip(pending, outcomes):
+            if error is not None:
+                replica.update(status="Timed out" if isinstance(error, OperationTimeout) else "Failed",
+                               error=str(error))
+            replica['changed'] = replica['status'] != "Failed" or replica.pop('outdated')
+            replica.pop('outdated', None)
+
+        failed = [replica['location'] for replica in pending if replica['status'] != "Succeeded"]
+        if failed:
+            self.fail("Replicating image {} failed for {}".format(self.name, ", ".join(failed)), **self.results)
+
+    def _replication_sources(self, image):
+        """
+        Open every disk of an image for reading: disks the image was built from
+        snapshots of are read from those snapshots, managed disks through a
+        snapshot taken of them here, so that the copies of all regions are read
+        from one consistent source. Returns the sources, with their SAS url,
+        length and allocated ranges, and the ids of the snapshots taken.
+        """
+        models = self.snapshot_models
+        snapshots = self.snapshot_client.snapshots
+        policy = self.polling_policy
+
+        profile = image.storage_profile
+        disks = [('os', profile.os_disk)] + [('lun{}'.format(disk.lun), disk) for disk in profile.data_disks or []]
+        sources = []
+        staged = []
+        operations = []
+        for key, disk in disks:
+            source = dict(key=key, disk=disk)
+            sources.append(source)
+            if disk.snapshot is not None and disk.snapshot.id:
+                source['snapshot_id'] = disk.snapshot.id
+                continue
+            if disk.managed_disk is None or not disk.managed_disk.id:
+                raise ImageCaptureError("Disk {} of image {} is not a managed disk or snapshot".format(key, image.name))
+            name = "{}-replication-{}".format(image.name, key)
+            operations.append((source, name, snapshots.create_or_update(
+                self.resource_group, name,
+                models.Snapshot(location=image.location,
+                                creation_data=models.CreationData(create_option='Copy',
+                                                                  source_resource_id=disk.managed_disk.id),
+                                tags={REPLICA_OF_TAG: image.id.lower()}),
+                polling=policy.polling())))
+        for source, name, operation in operations:
+            snapshot = policy.wait(operation, "snapshot {} to be created".format(name))
+            source['snapshot_id'] = snapshot.id
+            staged.append(snapshot.id)
+
+        for source in sources:
+            group, name = resource_group_and_name(source['snapshot_id'])
+            access = policy.wait(snapshots.grant_access(group, name, 'Read', REPLICATION_ACCESS_SECONDS,
+                                                        polling=policy.polling()),
+                                 "read access to snapshot {}".format(name))
+            source['granted'] = True
+            source['sas'] = access.access_sas
+            source['size'] = get_blob_size(access.access_sas)
+            source['ranges'] = get_page_ranges(access.access_sas)
+        return sources, staged
+
+    def _release_sources(self, sources, staged):
+        """
+        Revoke the read access to the replication sources and delete the
+        snapshots taken for them. Failures are ignored, as the copies are done.
+        """
+        snapshots = self.snapshot_client.snapshots
+        policy = self.polling_policy
+        operations = []
+        for source in sources:
+            if source.get('granted'):
+                group, name = resource_group_and_name(source['snapshot_id'])
+                operations.append(snapshots.revoke_access(group, name, polling=policy.polling()))
+        for operation in operations:
+            try:
+                policy.wait(operation, "snapshot access to be revoked")
+            except Exception:
+                pass
+        operations = [snapshots.delete(*resource_group_and_name(snapshot_id), polling=policy.polling())
+                      for snapshot_id in staged]
+        for operation in operations:
+            try:
+                policy.wait(operation, "replication snapshot to be deleted")
+            except Exception:
+                pass
+
+    def _replicate(self, replica, source, version, sources):
+        """
+        Copy the image into one region: upload every source disk into a new
+        managed disk there, create the image from those disks and delete them.
+        Progress is kept in the replica dict as the copy goes along, so that a
+        copy that fails reports how far it got.
+        """
+        models = self.snapshot_models
+        client = self.snapshot_client
+        policy = self.polling_policy
+        started = time.time()
+        replica.update(status="Copying",
+                       bytes_total=sum(range_bytes(item['ranges']) for item in sources),
+                       bytes_copied=0,
+                       disks_copied=0)
+        lock = threading.Lock()
+
+        def progress(count):
+            with lock:
+                replica['bytes_copied'] += count
+
+        disk_ids = dict()
+        try:
+            if replica['outdated']:
+                replica['stage'] = "Deleting outdated copy"
+                policy.wait(client.images.delete(self.resource_group, replica['name'], polling=policy.polling()),
+                            "outdated image {} to be deleted".format(replica['name']))
+
+            for item in sources:
+                disk_name = "{}-{}".format(replica['name'], item['key'])
+                replica['stage'] = "Copying disk {}".format(item['key'])
+                disk = policy.wait(client.disks.create_or_update(
+                    self.resource_group, disk_name,
+                    models.Disk(location=replica['location'],
+                                creation_data=models.CreationData(create_option='Upload',
+                                                                  upload_size_bytes=item['size']),
+                                tags={REPLICA_OF_TAG: source.id.lower()}),
+                    polling=policy.polling()), "disk {} to be created".format(disk_name))
+                disk_ids[item['key']] = disk.id
+                access = policy.wait(client.disks.grant_access(self.resource_group, disk_name, 'Write',
+                                                               REPLICATION_ACCESS_SECONDS, polling=policy.polling()),
+                                     "write access to disk {}".format(disk_name))
+                try:
+                    copy_page_ranges(item['sas'], access.access_sas, item['ranges'], self.max_concurrency,
+                                     progress=progress)
+                finally:
+                    policy.wait(client.disks.revoke_access(self.resource_group, disk_name, polling=policy.polling()),
+                                "access to disk {} to be revoked".format(disk_name))
+                replica['disks_copied'] += 1
+                self.log("Replica {}: copied disk {}, {} of {} bytes".format(replica['name'], item['key'],
+                                                                             replica['bytes_copied'],
+                                                                             replica['bytes_total']))
+
+            replica['stage'] = "Creating image"
+            tags = dict(source.tags or {})
+            tags[REPLICA_OF_TAG] = source.id.lower()
+            tags[REPLICA_VERSION_TAG] = version
+
+            def image_disk(item, cls, **kwargs):
+                disk = item['disk']
+                return cls(managed_disk=models.SubResource(id=disk_ids[item['key']]),
+                           caching=disk.caching,
+                           storage_account_type=disk.storage_account_type,
+                           **kwargs)
+
+            os_disk = sources[0]['disk']
+            params = models.Image(
+                location=replica['location'],
+                tags=tags,
+                hyper_vgeneration=getattr(source, 'hyper_vgeneration', None),
+                storage_profile=models.ImageStorageProfile(
+                    os_disk=image_disk(sources[0], models.ImageOSDisk, os_type=os_disk.os_type,
+                                       os_state=os_disk.os_state),
+                    data_disks=[image_disk(item, models.ImageDataDisk, lun=item['disk'].lun)
+                                for item in sources[1:]],
+                    zone_resilient=source.storage_profile.zone_resilient))
+            policy.wait(client.images.create_or_update(self.resource_group, replica['name'], params,
+                                                       polling=policy.polling()),
+                        "image {} to be created".format(replica['name']))
+            self.etag_cache.drop(self.subscription_id, self.resource_group, replica['name'])
+            replica['status'] = "Succeeded"
+            replica.pop('stage')
+        finally:
+            self.image_cache.invalidate(self.subscription_id, self.resource_group)
+            operations = [client.disks.delete(self.resource_group, disk_id.split('/')[-1], polling=policy.polling())
+                          for disk_id in disk_ids.values()]
+            for operation in operations:
+                try:
+                    policy.wait(operation, "upload disk to be deleted")
+                except Exception:
+                    pass
+            replica['duration'] = round(time.time() - started, 3)
+
+    def prune_images(self):
+        """
+        Select the images to delete from a single listing of the resource group
+        and delete them concurrently. The listing is read directly rather than
+        from the inventory cache, as a stale listing must not decide what is
+        deleted.
+        """
+        if self.keep_latest is None and self.older_than is None:
+            self.fail("keep_latest or older_than is required when state is pruned")
+        if self.keep_latest is not None and self.keep_latest < 0:
+            self.fail("keep_latest must not be negative")
+        max_age = None
+        if self.older_than is not None:
+            max_age = parse_duration(self.older_than)
+            if max_age is None:
+                self.fail("Invalid older_than {}: expected a number followed by s, m, h, d or w".format(
+                    self.older_than))
+
+        try:
+            image_filter = ImageFilter(pattern=self.name_pattern,
+                                       pattern_type=self.name_pattern_type,
+                                       resource_group=self.resource_group)
+        except re.error as e:
+            self.fail("Invalid name_pattern {}: {}".format(self.name_pattern, str(e)))
+
+        try:
+            candidates = list(image_filter.filter(iter_images(self.compute_client, self.resource_group)))
+        except Exception as e:
+            self.fail("Images of resource group {} could not be listed: {}".format(self.resource_group, str(e)))
+
+        dated = []
+        skipped = []
+        for image in candidates:
+            created = parse_created((image.get('tags') or {}).get(self.created_tag))
+            if created is None:
+                skipped.append(image['name'])
+            else:
+                dated.append((created, image['name']))
+        dated.sort(reverse=True)
+
+        now = time.time()
+        kept = []
+        doomed = []
+        for index, (created, name) in enumerate(dated):
+            if self.keep_latest is not None and index < self.keep_latest:
+                kept.append(name)
+            elif max_age is not None and now - created <= max_age:
+                kept.append(name)
+            else:
+                doomed.append(dict(name=name, created=time.strftime(CREATED_FORMAT, time.gmtime(created))))
+
+        if self.check_mode or not doomed:
+            for image in doomed:
+                image['status'] = "Would be deleted"
+            return dict(changed=bool(doomed),
+                        deleted=doomed,
+                        kept=kept,
+                        skipped=skipped)
+
+        images = self.compute_client.images
+        policy = self.polling_policy
+
+        def delete(image):
+            operation = images.delete(resource_group_name=self.resource_group, image_name=image['name'],
+                                      polling=policy.polling())
+            self.etag_cache.drop(self.subscription_id, self.resource_group, image['name'])
+            try:
+                policy.wait(operation, "image {} to be deleted".format(image['name']))
+            except OperationTimeout:
+                return "Timed out"
+            return "Succeeded"
+
+        outcomes = run_concurrently(delete, doomed, self.max_concurrency)
+        self.image_cache.invalidate(self.subscription_id, self.resource_group)
+
+        for image, (status, error) in zip(doomed, outcomes):
+            if error is not None:
+                image['status'] = "Failed"
+                image['error'] = str(error)
+            else:
+                image['status'] = status
+
+        results = dict(changed=any(image['status'] != "Failed" for image in doomed),
+                       deleted=doomed,
+                       kept=kept,
+                       skipped=skipped)
+
+        failed = [image['name'] for image in doomed if image['status'] == "Failed"]
+        if failed:
+            self.fail("Deleting failed for {}".format(", ".join(failed)), **results)
+
+        return results
 
 
 def main():
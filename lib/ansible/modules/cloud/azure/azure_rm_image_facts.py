@@ -31,6 +31,173 @@ options:
     description:
       - "The name of the image being queried."
     required: false
+  names:
+    description:
+      - "List of image names to return facts for. A name may be given as C(resource_group/name) to only match
+         the image in that resource group. All names are looked up in a single pass over the image listing."
+    type: list
+    required: false
+  name_pattern:
+    description:
+      - "Only return images whose name matches this pattern, see I(name_pattern_type)."
+    required: false
+  name_pattern_type:
+    description:
+      - "How I(name_pattern) is interpreted: C(glob) matches the whole name against a shell-style wildcard
+         pattern, C(regex) searches the name for a Python regular expression."
+    choices:
+      - glob
+      - regex
+    default: glob
+    required: false
+  tags:
+    description:
+      - "Only return images carrying all of these tags. Either a list of tags, each a key or a C(key:value) pair,
+         or a dict of tag values as accepted by earlier versions of this module, where a null value only requires
+         the key."
+    type: raw
+    required: false
+  resource_group:
+    description:
+      - "Limit the query to this resource group. When given together with I(name), the image is fetched directly
+         instead of being searched for in the subscription-wide listing."
+    required: false
+  max_results:
+    description:
+      - "Stop after this many images have been found. The listing is read page by page, so no further pages
+         are requested once the limit is reached. When looking up a I(name) without a I(resource_group),
+         only the first match is returned unless I(max_results) is set."
+    type: int
+    required: false
+  inventory_cache_ttl:
+    description:
+      - "Number of seconds an image listing is cached on disk and shared with other tasks and
+         with azure_rm_image. 0 disables the cache."
+    type: int
+    default: 0
+    required: false
+  inventory_cache_path:
+    description:
+      - "Directory holding the image listing cache."
+    type: path
+    default: ~/.ansible/azure_image_cache
+    required: false
+  etag_revalidation:
+    description:
+      - "When an image is looked up by I(resource_group) and I(name), keep it in I(inventory_cache_path)
+         with the ETag it was served with, and revalidate it with a conditional request on later lookups.
+         An unchanged image is then answered with an empty C(304 Not Modified). The result reports in
+         I(lookup) whether the image was C(revalidated) or C(fetched)."
+    type: bool
+    default: false
+    required: false
+  image_index_path:
+    description:
+      - "Path of a local SQLite index of the images of the subscription. When set, lookups with the listing
+         backend are answered from the index, which stores name, resource group, location, managed flag,
+         tags, source VM and timestamps, and is indexed on name, resource group and tags. The index is
+         refreshed from the image listing when it is older than I(image_index_ttl); a refresh only rewrites
+         images that changed and drops those that disappeared. The result then has an I(image_index) entry
+         with the counts of that refresh."
+    required: false
+  image_index_ttl:
+    description:
+      - "Number of seconds after which the image index is refreshed before it is queried."
+    default: 300
+    required: false
+  backend:
+    description:
+      - "How images are looked up. C(listing) reads the image listing of the subscription or resource group and
+         filters it in the module. C(resource_graph) sends a single Azure Resource Graph query which filters,
+         projects and pages on the service side, which is much faster across many resource groups. The
+         returned I(azure_images) have the same fields with both backends. The resource_graph backend does
+         not use the I(inventory_cache_ttl) cache."
+    choices:
+      - listing
+      - resource_graph
+    default: listing
+    required: false
+  resource_graph_endpoint:
+    description:
+      - "Base URL the Resource Graph queries are sent to. Defaults to the resource manager endpoint of the
+         selected cloud."
+    required: false
+  diagnostics:
+    description:
+      - "Add a C(metrics) block to the result listing every Azure API call made, its duration, the number of
+         pages read for listings and the number of status polls for long-running operations."
+    type: bool
+    default: false
+    required: false
+  token_cache:
+    description:
+      - "Keep the Azure AD access token acquired for I(client_id) and I(tenant) in I(token_cache_path), and reuse
+         it in later tasks for as long as it stays valid for at least five more minutes, instead of acquiring a
+         new one every task. Tokens are kept per tenant, client and scope, encrypted with a key derived from
+         I(secret). Only service principal credentials are cached. The result reports in I(token_cache)
+         whether the token was a C(hit) or a C(miss), or C(unsupported) for other credentials. Requires the
+         cryptography package."
+    type: bool
+    default: false
+    required: false
+  token_cache_path:
+    description:
+      - "Directory holding the token cache."
+    type: path
+    default: ~/.ansible/azure_token_cache
+    required: false
+  request_rate:
+    description:
+      - "Most Azure API requests per second sent by the tasks of this module for the subscription, in the
+         same process. Without it, requests are only slowed down once Azure reports that few requests remain
+         in the C(x-ms-ratelimit-remaining-*) response headers or throttles one with HTTP 429, and sped up
+         again while it does not, up to I(request_rate)."
+    type: float
+    required: false
+  request_burst:
+    description:
+      - "Requests that may be sent at once before I(request_rate) applies. Requests are also slowed down once
+         Azure reports no more than this many remaining."
+    type: int
+    default: 10
+    required: false
+  throttle_retries:
+    description:
+      - "Times a request throttled by Azure is sent again, after the delay given by its C(Retry-After) header,
+         or after a randomized exponential backoff. Requests of all the operations running in the process wait
+         out a C(Retry-After) together."
+    type: int
+    default: 6
+    required: false
+  throttle_max_delay:
+    description:
+      - "Longest backoff, in seconds, before sending a throttled request again. A request is failed instead
+         when Azure asks for a longer delay."
+    type: int
+    default: 60
+    required: false
+  worker:
+    description:
+      - "Hand the task to a long-lived local worker process for this module, listening on a Unix socket in
+         I(worker_path), and start one when none is running. The worker keeps the authentication and the Azure
+         API connections of earlier tasks run with the same credentials, sparing every later task the Azure SDK
+         imports, the authentication and the connection setup. Tasks run by a worker report it in I(worker).
+         Not supported on Windows."
+    type: bool
+    default: false
+    required: false
+  worker_path:
+    description:
+      - "Directory holding the worker sockets."
+    type: path
+    default: ~/.ansible/azure_worker
+    required: false
+  worker_idle_timeout:
+    description:
+      - "Seconds after which a worker that was not handed any task exits."
+    type: int
+    default: 300
+    required: false
 
 short_description: "Capture Azure Virtual Machine Images"
 version_added: "2.9"
@@ -60,9 +227,46 @@ EXAMPLES = '''
         client_secret: "{{ secrets.client_secret }}"
         name: win2016-1
 
+    - name: List facts about several images in one pass
+      azure_rm_image_facts:
+        names:
+          - win2016-1
+          - images-rg/ubuntu1804-3
+        name_pattern: "centos-*"
+        tags:
+          - environment:production
+
+    - name: Find images across the subscription with a Resource Graph query
+      azure_rm_image_facts:
+        name_pattern: "^win20(16|19)-"
+        name_pattern_type: regex
+        backend: resource_graph
+
 '''
 
+import re
+import sqlite3
+import time
+from itertools import islice
+
+from ansible.module_utils.six import string_types
+
+from ansible.module_utils.azure_rm_worker import WORKER_ARGS, WorkerMixin, hand_off_to_worker
+
+if __name__ == '__main__':
+    # Hand the task to its worker, when one is running, before the Azure SDK
+    # is imported. See azure_rm_worker.
+    hand_off_to_worker(__file__)
+
 from ansible.module_utils.azure_rm_common import AzureRMModuleBase
+from ansible.module_utils.azure_rm_client_proxy import CLIENT_PROXY_ARGS, ClientProxyMixin
+from ansible.module_utils.azure_rm_token_cache import TOKEN_CACHE_ARGS, TokenCacheMixin
+from ansible.module_utils.azure_rm_throttle import THROTTLE_ARGS
+from ansible.module_utils.azure_rm_image_common import (IMAGE_CACHE_ARGS, LOOKUP_FETCHED, ImageETagCache,
+                                                        ImageFilter, ImageInventoryCache, get_image, iter_images)
+from ansible.module_utils.azure_rm_image_index import IMAGE_INDEX_ARGS, ImageIndex
+from ansible.module_utils.azure_rm_resource_graph import (RESOURCE_GRAPH_ARGS, ResourceGraphClient, ResourceGraphError,
+                                                          image_query, image_row_to_dict, session_transport)
 
 try:
     from msrestazure.azure_exceptions import CloudError
@@ -70,20 +274,74 @@ except:
     pass
 
 
-class AzureRMImageFacts(AzureRMModuleBase):
+class AzureRMImageFacts(WorkerMixin, TokenCacheMixin, ClientProxyMixin, AzureRMModuleBase):
     def __init__(self):
 
         self.module_arg_spec = dict(
             name=dict(
                 type='str',
                 required=False
+            ),
+            names=dict(
+                type='list',
+                required=False
+            ),
+            name_pattern=dict(
+                type='str',
+                required=False
+            ),
+            name_pattern_type=dict(
+                type='str',
+                required=False,
+                default='glob',
+                choices=['glob', 'regex']
+            ),
+            tags=dict(
+                type='raw',
+                required=False
+            ),
+            resource_group=dict(
+                type='str',
+                required=False
+            ),
+            max_results=dict(
+                type='int',
+                required=False
             )
         )
+        self.module_arg_spec.update(IMAGE_CACHE_ARGS)
+        self.module_arg_spec.update(CLIENT_PROXY_ARGS)
+        self.module_arg_spec.update(TOKEN_CACHE_ARGS)
+        self.module_arg_spec.update(THROTTLE_ARGS)
+        self.module_arg_spec.update(WORKER_ARGS)
+        self.module_arg_spec.update(RESOURCE_GRAPH_ARGS)
+        self.module_arg_spec.update(IMAGE_INDEX_ARGS)
 
         self.resource_group = None
         self.name = None
+        self.names = None
+        self.name_pattern = None
+        self.name_pattern_type = None
         self.location = None
         self.tags = None
+        self.max_results = None
+        self.inventory_cache_ttl = None
+        self.inventory_cache_path = None
+        self.image_cache = None
+        self.etag_revalidation = None
+        self.etag_cache = None
+        self.backend = None
+        self.image_index_path = None
+        self.image_index_ttl = None
+        self.image_index = None
+        self.resource_graph_endpoint = None
+        self.diagnostics = None
+        self.token_cache = None
+        self.token_cache_path = None
+        self.request_rate = None
+        self.request_burst = None
+        self.throttle_retries = None
+        self.throttle_max_delay = None
 
         self.results = dict(
             changed=False,
@@ -94,61 +352,175 @@ class AzureRMImageFacts(AzureRMModuleBase):
         super(AzureRMImageFacts, self).__init__(
             derived_arg_spec=self.module_arg_spec,
             supports_check_mode=True,
-            supports_tags=True)
+            supports_tags=False)
 
     def exec_module(self, **kwargs):
 
-        for key in list(self.module_arg_spec.keys()) + ['tags']:
+        for key in list(self.module_arg_spec.keys()):
             setattr(self, key, kwargs[key])
 
-        self.results['ansible_facts'] = (
-            self.get_item() if self.name
-            else self.list_items())
+        if isinstance(self.tags, string_types):
+            self.tags = [tag.strip() for tag in self.tags.split(',') if tag.strip()]
+        elif self.tags is not None and not isinstance(self.tags, (dict, list)):
+            self.fail("tags must be a list of key or key:value strings, or a dict")
+
+        self.image_cache = ImageInventoryCache(self.inventory_cache_path, self.inventory_cache_ttl)
+        self.etag_cache = ImageETagCache(self.inventory_cache_path, self.etag_revalidation)
+        if self.image_index_path and self.backend == 'listing':
+            try:
+                self.image_index = ImageIndex(self.image_index_path, self.image_index_ttl)
+            except (sqlite3.Error, OSError) as e:
+                self.fail("Image index {} could not be opened: {}".format(self.image_index_path, str(e)))
+
+        if self.names or self.name_pattern or self.tags:
+            self.results['ansible_facts'] = self.filter_items()
+        elif self.name:
+            self.results['ansible_facts'] = self.get_item()
+        else:
+            self.results['ansible_facts'] = self.list_items()
+
+        if self.image_index is not None:
+            self.image_index.close()
+
+        return self.add_metrics(self.results)
+
+    def _lookup_images(self, name=None, resource_group=None, max_results=None, image_filter=None):
+        """
+        Look up images using the narrowest API call the given filters allow:
+        a direct get when both resource group and name are known, a listing of
+        the resource group when only the group is known, and the listing of the
+        whole subscription only when no resource group is given. Listings are
+        consumed lazily and abandoned as soon as max_results images matched.
+        An ImageFilter further narrows down the listing in the same pass.
+        """
+        if self.image_index is not None:
+            if image_filter is None:
+                image_filter = ImageFilter(names=[name] if name else None, resource_group=resource_group)
+            return self._index_lookup(image_filter, max_results)
+
+        if resource_group and name:
+            try:
+                image, self.results['lookup'] = get_image(self.compute_client, self.etag_cache,
+                                                          self.subscription_id, resource_group, name)
+                return [image]
+            except CloudError as e:
+                if e.status_code == 404:
+                    self.results['lookup'] = LOOKUP_FETCHED
+                    return []
+                self.fail("Image {} could not be retrieved: {}".format(name, str(e)))
+            except Exception as e:
+                self.fail("An exception occurred: {}".format(str(e)))
+
+        if self.backend == 'resource_graph':
+            if image_filter is None:
+                image_filter = ImageFilter(names=[name] if name else None, resource_group=resource_group)
+            return self._query_images(image_filter, max_results)
 
-        return self.results
-
-    def _list_images(self):
         try:
-            images = self.compute_client.images
-            image_list = images.list()  # (resource_group_name=self.resource_group, name=self.name)
+            image_list = self.image_cache.get_or_fetch(self.subscription_id, resource_group,
+                                                       lambda: iter_images(self.compute_client, resource_group))
+            matches = (image for image in image_list
+                       if name is None or image['name'] == name)
+            if image_filter is not None:
+                matches = image_filter.filter(matches)
+            named_images = list(islice(matches, max_results))
         except CloudError:
             self.fail("No images found!")
         except Exception as e:
             self.fail("An exception occurred: {}".format(str(e)))
 
-        named_images = []
-
-        for image in image_list:
-            image_info = dict(name=image.name,
-                              location=image.location,
-                              resource_group=image.id.split("/")[4],
-                              managed=(not (image.storage_profile.os_disk.managed_disk is None))
-                              )
-            named_images.append(image_info)
-
         return named_images
 
+    def _index_lookup(self, image_filter, max_results=None):
+        index = self.image_index
+        resource_group = image_filter.resource_group
+        refreshed = False
+        try:
+            if not index.is_fresh(self.subscription_id, resource_group):
+                images = self.compute_client.images
+                if resource_group:
+                    listing = images.list_by_resource_group(resource_group_name=resource_group)
+                else:
+                    listing = images.list()
+                stats = index.refresh(self.subscription_id, resource_group, listing)
+                refreshed = True
+            else:
+                stats = dict()
+            self.results['image_index'] = dict(stats, refreshed=refreshed)
+            return index.query(self.subscription_id, image_filter, max_results)
+        except CloudError as e:
+            self.fail("Images could not be listed: {}".format(str(e)))
+        except sqlite3.Error as e:
+            self.fail("Image index {} could not be used: {}".format(self.image_index_path, str(e)))
+
+    def resource_graph_transport(self):
+        """
+        Transport for Resource Graph queries: a session signed with the module's
+        credentials, recording every request in the call metrics when
+        diagnostics are enabled.
+        """
+        post = session_transport(self.azure_auth.azure_credentials.signed_session())
+        if not self.diagnostics:
+            return post
+
+        def recorded_post(url, body):
+            entry = self.call_metrics.start('resource_graph.resources')
+            started = time.time()
+            try:
+                return post(url, body)
+            finally:
+                self.call_metrics.add(entry, 'duration', time.time() - started)
+                self.call_metrics.add(entry, 'pages', 1)
+        return recorded_post
+
+    def _query_images(self, image_filter, max_results=None):
+        endpoint = self.resource_graph_endpoint or self.azure_auth._cloud_environment.endpoints.resource_manager
+        client = ResourceGraphClient(self.resource_graph_transport(), endpoint, [self.subscription_id])
+        try:
+            return [image_row_to_dict(row) for row in client.query(image_query(image_filter, max_results))]
+        except ResourceGraphError as e:
+            self.fail(str(e))
+        except Exception as e:
+            self.fail("An exception occurred: {}".format(str(e)))
+
     def list_items(self):
 
-        image_names = self._list_images()
+        image_names = self._lookup_images(resource_group=self.resource_group,
+                                          max_results=self.max_results)
 
         return dict(azure_images=image_names,
                     status="Found",
                     changed=False)
 
-    def get_item(self):
+    def filter_items(self):
 
-        status = "Not found"
-        image_names = self._list_images()
-        image_item = []
+        names = list(self.names or [])
+        if self.name:
+            names.append(self.name)
+        try:
+            image_filter = ImageFilter(names=names,
+                                       pattern=self.name_pattern,
+                                       pattern_type=self.name_pattern_type,
+                                       resource_group=self.resource_group,
+                                       tags=self.tags)
+        except re.error as e:
+            self.fail("Invalid name_pattern {}: {}".format(self.name_pattern, str(e)))
+
+        images = self._lookup_images(resource_group=self.resource_group,
+                                     max_results=self.max_results,
+                                     image_filter=image_filter)
+        status = "Found" if images else "Not found"
+
+        return dict(azure_images=images,
+                    status=status,
+                    changed=False)
 
-        found = any(elem['name'] == self.name for elem in image_names)
+    def get_item(self):
 
-        if found:
-            for image in image_names:
-                if image['name'] == self.name:
-                    status = "Found"
-                    image_item.append(image)
+        image_item = self._lookup_images(name=self.name,
+                                         resource_group=self.resource_group,
+                                         max_results=self.max_results or 1)
+        status = "Found" if image_item else "Not found"
 
         return dict(azure_images=image_item,
                     status=status,
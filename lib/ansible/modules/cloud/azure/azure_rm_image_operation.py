@@ -0,0 +1,334 @@
+#!/usr/bin/python
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import, division, print_function
+
+__metaclass__ = type
+
+DOCUMENTATION = '''
+---
+author: "Emma Laurijssens van Engelenhoven"
+description:
+  - "Check on or wait for image captures started by azure_rm_image with wait=false.
+     Depends on pip azure module 2.0.0 or above and azure-mgmt-compute 2.1.0 and above."
+  - "Every operation is checked at the status URL of the capture recorded in its token, which also tells
+     why a capture failed, in I(error) of its operation. Once Azure no longer answers there, or for tokens
+     without one, the provisioning state of the image is checked instead."
+  - "Captures made with capture_mode=snapshot list the snapshots the image is created from in their token.
+     Once such an image has been created or has failed, the snapshots are deleted and reported in
+     I(snapshots_deleted) of its operation."
+module: azure_rm_image_operation
+options:
+  tokens:
+    description:
+      - "List of tokens returned by azure_rm_image in I(token) when it was run with wait=false."
+    type: list
+    required: true
+  wait:
+    description:
+      - "Wait until every operation has either succeeded or failed. When false the current state of
+         every operation is returned right away."
+    type: bool
+    default: false
+    required: false
+  timeout:
+    description:
+      - "Maximum number of seconds to wait when I(wait) is true. Operations still running at that
+         point are reported as not done."
+    type: int
+    default: 3600
+    required: false
+  poll_interval:
+    description:
+      - "Number of seconds before the first re-check of the running operations when I(wait) is true.
+         Later checks are spaced further apart, see I(poll_backoff)."
+    type: float
+    default: 2
+    required: false
+  poll_backoff:
+    description:
+      - "Factor by which the time between two checks grows, up to 30 seconds."
+    type: float
+    default: 1.5
+    required: false
+  diagnostics:
+    description:
+      - "Add a C(metrics) block to the result listing every Azure API call made, its duration, the number of
+         pages read for listings and the number of status polls for long-running operations."
+    type: bool
+    default: false
+    required: false
+  token_cache:
+    description:
+      - "Keep the Azure AD access token acquired for I(client_id) and I(tenant) in I(token_cache_path), and reuse
+         it in later tasks for as long as it stays valid for at least five more minutes, instead of acquiring a
+         new one every task. Tokens are kept per tenant, client and scope, encrypted with a key derived from
+         I(secret). Only service principal credentials are cached. The result reports in I(token_cache)
+         whether the token was a C(hit) or a C(miss), or C(unsupported) for other credentials. Requires the
+         cryptography package."
+    type: bool
+    default: false
+    required: false
+  token_cache_path:
+    description:
+      - "Directory holding the token cache."
+    type: path
+    default: ~/.ansible/azure_token_cache
+    required: false
+  request_rate:
+    description:
+      - "Most Azure API requests per second sent by the tasks of this module for the subscription, in the
+         same process. Without it, requests are only slowed down once Azure reports that few requests remain
+         in the C(x-ms-ratelimit-remaining-*) response headers or throttles one with HTTP 429, and sped up
+         again while it does not, up to I(request_rate)."
+    type: float
+    required: false
+  request_burst:
+    description:
+      - "Requests that may be sent at once before I(request_rate) applies. Requests are also slowed down once
+         Azure reports no more than this many remaining."
+    type: int
+    default: 10
+    required: false
+  throttle_retries:
+    description:
+      - "Times a request throttled by Azure is sent again, after the delay given by its C(Retry-After) header,
+         or after a randomized exponential backoff. Requests of all the operations running in the process wait
+         out a C(Retry-After) together."
+    type: int
+    default: 6
+    required: false
+  throttle_max_delay:
+    description:
+      - "Longest backoff, in seconds, before sending a throttled request again. A request is failed instead
+         when Azure asks for a longer delay."
+    type: int
+    default: 60
+    required: false
+
+short_description: "Check on Azure Virtual Machine image captures"
+version_added: "2.9"
+
+'''
+
+EXAMPLES = '''
+- name: Capture images
+  hosts: 127.0.0.1
+  connection: local
+
+  tasks:
+    - name: Start capturing images without waiting for them
+      azure_rm_image:
+        resource_group_name: "{{ resource_group_name }}"
+        vm_name: "{{ item }}"
+        name: "{{ item }}-image"
+        wait: false
+      loop: "{{ vm_names }}"
+      register: captures
+
+    - name: Wait for all captures to finish
+      azure_rm_image_operation:
+        tokens: "{{ captures.results | map(attribute='token') | list }}"
+        wait: true
+'''
+
+from ansible.module_utils.azure_rm_common import AzureRMModuleBase
+from ansible.module_utils.azure_rm_client_proxy import CLIENT_PROXY_ARGS, ClientProxyMixin
+from ansible.module_utils.azure_rm_token_cache import TOKEN_CACHE_ARGS, TokenCacheMixin
+from ansible.module_utils.azure_rm_throttle import THROTTLE_ARGS
+from ansible.module_utils.azure_rm_operations import POLLING_ARGS, OperationPolicy, wait_for_pollers
+
+import time
+
+try:
+    from msrestazure.azure_exceptions import CloudError
+except:
+    pass
+
+TERMINAL_STATES = ('Succeeded', 'Failed', 'Canceled')
+
+
+class AzureRMImageOperation(TokenCacheMixin, ClientProxyMixin, AzureRMModuleBase):
+    def __init__(self):
+
+        self.module_arg_spec = dict(
+            tokens=dict(
+                type='list',
+                required=True
+            ),
+            wait=dict(
+                type='bool',
+                required=False,
+                default=False
+            )
+        )
+        self.module_arg_spec.update(CLIENT_PROXY_ARGS)
+        self.module_arg_spec.update(TOKEN_CACHE_ARGS)
+        self.module_arg_spec.update(THROTTLE_ARGS)
+        self.module_arg_spec.update(POLLING_ARGS)
+
+        self.tokens = None
+        self.wait = None
+        self.timeout = None
+        self.poll_interval = None
+        self.poll_backoff = None
+        self.diagnostics = None
+        self.token_cache = None
+        self.token_cache_path = None
+        self.request_rate = None
+        self.request_burst = None
+        self.throttle_retries = None
+        self.throttle_max_delay = None
+        self._operation_session = None
+
+        self.results = dict(
+            changed=False,
+            operations=[]
+        )
+
+        super(AzureRMImageOperation, self).__init__(
+            derived_arg_spec=self.module_arg_spec,
+            supports_check_mode=True,
+            supports_tags=False)
+
+    def exec_module(self, **kwargs):
+
+        for key in list(self.module_arg_spec.keys()):
+            setattr(self, key, kwargs[key])
+
+        for token in self.tokens:
+            if not isinstance(token, dict) or token.get('kind') != 'image_capture':
+                self.fail("Not an image capture token: {}".format(token))
+            if token.get('subscription_id') != self.subscription_id:
+                self.fail("Token for image {} belongs to subscription {}".format(token.get('name'),
+                                                                                 token.get('subscription_id')))
+
+        policy = OperationPolicy(self.poll_interval, self.poll_backoff, self.timeout)
+        operations = [self.check_operation(token) for token in self.tokens]
+
+        for interval in (policy.intervals() if self.wait else []):
+            if all(op['done'] for op in operations):
+                break
+            time.sleep(interval)
+            operations = [op if op['done'] else self.check_operation(token)
+                          for op, token in zip(operations, self.tokens)]
+
+        if not self.check_mode:
+            self.delete_capture_snapshots(operations, policy)
+
+        self.results['operations'] = operations
+        self.results['done'] = all(op['done'] for op in operations)
+
+        failed = ["{} ({})".format(op['name'], op['error']) if op.get('error') else op['name']
+                  for op in operations if op['done'] and op['status'] != 'Succeeded']
+        if failed:
+            self.fail("Image capture failed for {}".format(", ".join(failed)), **self.results)
+
+        return self.add_metrics(self.results)
+
+    def check_operation(self, token):
+
+        status, error = None, None
+        if token.get('operation_url'):
+            status, error = self.operation_status(token['operation_url'])
+        if status is None:
+            try:
+                image = self.compute_client.images.get(resource_group_name=token['resource_group'],
+                                                       image_name=token['name'])
+                status = image.provisioning_state
+            except CloudError as e:
+                if e.status_code != 404:
+                    self.fail("Image {} could not be retrieved: {}".format(token['name'], str(e)))
+                status = "Failed"
+            except Exception as e:
+                self.fail("An exception occurred: {}".format(str(e)))
+
+        operation = dict(name=token['name'],
+                         resource_group=token['resource_group'],
+                         image_id=token.get('image_id'),
+                         status=status,
+                         done=status in TERMINAL_STATES,
+                         elapsed=round(time.time() - token.get('started', time.time()), 3))
+        if error:
+            operation['error'] = error
+        return operation
+
+    def operation_status(self, url):
+        """
+        Status and error message of a long-running operation, read from the URL
+        its poller polled. The status is None when the URL does not tell, such
+        as once Azure has expired the operation, so that the image is checked
+        instead.
+        """
+        if self._operation_session is None:
+            self._operation_session = self.azure_auth.azure_credentials.signed_session()
+        try:
+            response = self._operation_session.get(url, timeout=60)
+            if response.status_code == 202:
+                return "InProgress", None
+            if response.status_code != 200:
+                return None, None
+            body = response.json()
+        except Exception:
+            return None, None
+        if not isinstance(body, dict):
+            return None, None
+        return body.get('status'), (body.get('error') or {}).get('message')
+
+    def delete_capture_snapshots(self, operations, policy):
+        """
+        Delete the snapshots listed in the tokens of finished operations, which
+        the image no longer reads from. Snapshots already gone, such as those
+        deleted by an earlier check of the same token, are skipped; Azure does
+        not report deleting a missing snapshot as an error, so they are looked
+        up in a listing of their resource group first.
+        """
+        finished = [(op, token) for op, token in zip(operations, self.tokens)
+                    if op['done'] and token.get('snapshots')]
+        if not finished:
+            return
+        snapshots = self.compute_client.snapshots
+        existing = dict()
+        pollers = dict()
+        try:
+            for op, token in finished:
+                group = token['resource_group'].lower()
+                if group not in existing:
+                    existing[group] = set(snap.name for snap in snapshots.list_by_resource_group(token['resource_group']))
+                op['snapshots_deleted'] = []
+                for name in token['snapshots']:
+                    if name not in existing[group]:
+                        continue
+                    pollers[(op['name'], name)] = snapshots.delete(token['resource_group'], name,
+                                                                   polling=policy.polling())
+                    existing[group].discard(name)
+                    op['snapshots_deleted'].append(name)
+                    self.results['changed'] = True
+        except CloudError as e:
+            self.fail("Capture snapshots could not be deleted: {}".format(str(e)))
+        except Exception as e:
+            self.fail("An exception occurred: {}".format(str(e)))
+        # Deleting goes on in Azure once accepted, so the deletions are only
+        # waited for until the deadline of the run.
+        wait_for_pollers(pollers, policy)
+
+
+def main():
+    AzureRMImageOperation()
+
+
+if __name__ == '__main__':
+    main()
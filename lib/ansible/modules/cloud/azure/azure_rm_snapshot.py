@@ -30,7 +30,8 @@ author: "Emma Laurijssens van Engelenhoven, building on the module built by Derr
 description:
   - "Capture an Azure Virtual Machine managed image to create other managed virtual machines with. 
      The VM should be generalized usimg sysprep. After this command runs, the Virtual Machine will be unusable.
-     Depends on pip azure module 2.0.0 or above and azure-mgmt-compute 2.1.0 and above."
+     Depends on pip azure module 2.0.0 or above and azure-mgmt-compute 2.1.0 and above.
+     I(incremental) depends on azure-mgmt-compute 10.0.0 and above."
 module: azure_managed_image_capture
 options:
   resource_group:
@@ -62,7 +63,177 @@ options:
       - "The location where the image should be stored. Should be within the resource group."
     default: westus
     required: true
-        
+  prefix:
+    description:
+      - "Text put before the disk name in the name of every snapshot. When deleting or rotating, only
+         snapshots whose name starts with it are considered."
+    required: false
+  suffix:
+    description:
+      - "Text put after the disk name in the name of every snapshot."
+    required: false
+  state:
+    description:
+      - "C(present) takes a snapshot of every disk of the VM. C(absent) deletes the snapshots of the VM: those
+         tagged by this module with the VM and its disks, and untagged ones taken from one of its disks whose
+         name is I(prefix) followed by the disk name. All deletes run at the same time."
+    choices:
+      - present
+      - absent
+    default: present
+    required: false
+  keep:
+    description:
+      - "Rotate the snapshots of the VM: per disk, keep this many of the most recent ones and delete the
+         rest. With state=present the rotation happens after the new snapshots were taken, which count
+         towards I(keep). With state=absent only the older snapshots are deleted instead of all of them."
+    type: int
+    required: false
+  incremental:
+    description:
+      - "Create incremental snapshots, which only store the blocks that changed since the previous snapshot
+         of the same disk. The previous snapshot is the most recent incremental snapshot in the resource
+         group tagged with the source disk, or, for untagged snapshots, whose name starts with I(prefix)
+         followed by the disk name and that was taken from the same disk. Use a I(suffix) that differs per
+         run, such as a date, so every run adds a snapshot to the chain."
+      - "Requires azure-mgmt-compute 10.0.0 or above, which provides compute API version 2019-07-01."
+    type: bool
+    default: false
+    required: false
+  estimate_changed_bytes:
+    description:
+      - "With I(incremental), report per disk the number of bytes that changed since the previous snapshot
+         in the chain, or the number of allocated bytes for the first snapshot of a disk. This temporarily
+         grants read access to the snapshots involved."
+    type: bool
+    default: true
+    required: false
+  max_concurrency:
+    description:
+      - "Maximum number of disk snapshots that are started at the same time. All started snapshots are
+         then waited for together."
+    type: int
+    default: 8
+    required: false
+  export_to:
+    description:
+      - "With state=present, download every snapshot taken to a local VHD file named after the snapshot in
+         this directory, once all snapshots have finished. Only the allocated ranges of the snapshot are read,
+         and the rest of the file is left sparse. Every range read is checked against the MD5 the blob
+         service reports for it, and recorded in a C(.manifest) file next to the VHD, so that an export that
+         failed is resumed when the same snapshot is exported again. This temporarily grants read access to
+         the snapshots. The result reports per snapshot the bytes downloaded and resumed in C(export)."
+    type: path
+    required: false
+  export_concurrency:
+    description:
+      - "Maximum number of ranges of a snapshot read at the same time by I(export_to)."
+    type: int
+    default: 16
+    required: false
+  return_fields:
+    description:
+      - "Names of the fields to return for the VM and for each snapshot, for example C(id) and C(status).
+         The name is always returned. By default all fields are returned."
+    type: list
+    required: false
+  poll_interval:
+    description:
+      - "Number of seconds before the first status check of the snapshot operations. Later checks are
+         spaced further apart, see I(poll_backoff)."
+    type: float
+    default: 2
+    required: false
+  poll_backoff:
+    description:
+      - "Factor by which the time between two status checks grows, up to 30 seconds."
+    type: float
+    default: 1.5
+    required: false
+  timeout:
+    description:
+      - "Maximum number of seconds to wait for the snapshots. Snapshots that have not finished by then are
+         reported with status C(Timed out) and C(timed_out) is set in the result."
+    type: int
+    default: 3600
+    required: false
+  diagnostics:
+    description:
+      - "Add a C(metrics) block to the result listing every Azure API call made, its duration, the number of
+         pages read for listings and the number of status polls for long-running operations."
+    type: bool
+    default: false
+    required: false
+  token_cache:
+    description:
+      - "Keep the Azure AD access token acquired for I(client_id) and I(tenant) in I(token_cache_path), and reuse
+         it in later tasks for as long as it stays valid for at least five more minutes, instead of acquiring a
+         new one every task. Tokens are kept per tenant, client and scope, encrypted with a key derived from
+         I(secret). Only service principal credentials are cached. The result reports in I(token_cache)
+         whether the token was a C(hit) or a C(miss), or C(unsupported) for other credentials. Requires the
+         cryptography package."
+    type: bool
+    default: false
+    required: false
+  token_cache_path:
+    description:
+      - "Directory holding the token cache."
+    type: path
+    default: ~/.ansible/azure_token_cache
+    required: false
+  request_rate:
+    description:
+      - "Most Azure API requests per second sent by the tasks of this module for the subscription, in the
+         same process. Without it, requests are only slowed down once Azure reports that few requests remain
+         in the C(x-ms-ratelimit-remaining-*) response headers or throttles one with HTTP 429, and sped up
+         again while it does not, up to I(request_rate)."
+    type: float
+    required: false
+  request_burst:
+    description:
+      - "Requests that may be sent at once before I(request_rate) applies. Requests are also slowed down once
+         Azure reports no more than this many remaining."
+    type: int
+    default: 10
+    required: false
+  throttle_retries:
+    description:
+      - "Times a request throttled by Azure is sent again, after the delay given by its C(Retry-After) header,
+         or after a randomized exponential backoff. Requests of all the operations running in the process wait
+         out a C(Retry-After) together."
+    type: int
+    default: 6
+    required: false
+  throttle_max_delay:
+    description:
+      - "Longest backoff, in seconds, before sending a throttled request again. A request is failed instead
+         when Azure asks for a longer delay."
+    type: int
+    default: 60
+    required: false
+  worker:
+    description:
+      - "Hand the task to a long-lived local worker process for this module, listening on a Unix socket in
+         I(worker_path), and start one when none is running. The worker keeps the authentication and the Azure
+         API connections of earlier tasks run with the same credentials, sparing every later task the Azure SDK
+         imports, the authentication and the connection setup. Tasks run by a worker report it in I(worker).
+         Not supported on Windows."
+    type: bool
+    default: false
+    required: false
+  worker_path:
+    description:
+      - "Directory holding the worker sockets."
+    type: path
+    default: ~/.ansible/azure_worker
+    required: false
+  worker_idle_timeout:
+    description:
+      - "Seconds after which a worker that was not handed any task exits."
+    type: int
+    default: 300
+    required: false
+
 short_description: "Capture Azure Virtual Machine Images"
 version_added: "2.0"
 
@@ -85,6 +256,21 @@ EXAMPLES = '''
         vm_name: "{{ vm_name }}"
         location: "{{ location }}"
       register: capture_info
+
+    - name: Take a daily snapshot and keep those of the last week
+      azure_rm_snapshot:
+        resource_group: "{{ resource_group }}"
+        name: "{{ vm_name }}"
+        prefix: daily-
+        suffix: "-{{ ansible_date_time.date }}"
+        keep: 7
+
+    - name: Snapshot the disks of a VM and archive them locally
+      azure_rm_snapshot:
+        resource_group: "{{ resource_group }}"
+        name: "{{ vm_name }}"
+        prefix: archive-
+        export_to: /srv/archive/{{ vm_name }}
 '''
 
 RETURN = '''
@@ -92,20 +278,53 @@ azure_managed_disk:
     description: List of managed disk dicts.
     returned: always
     type: list
+state:
+    description:
+      - "The snapshotted VM in C(vm), with its OS and data disks, and one entry per disk snapshot in C(snapshots).
+         Both can be reduced with I(return_fields). With I(export_to), the C(export) of every snapshot holds
+         the C(path) of its VHD, its C(size), the C(allocated_bytes) and the C(downloaded_bytes) and
+         C(resumed_bytes) of them, and the C(duration) in seconds."
+    returned: when state is present
+    type: dict
+deleted:
+    description:
+      - "One entry per deleted snapshot with its C(name), C(disk), C(time_created) and C(status)."
+    returned: when state is absent or I(keep) is set
+    type: list
 '''
 
+from ansible.module_utils.azure_rm_worker import WORKER_ARGS, WorkerMixin, hand_off_to_worker
+
+if __name__ == '__main__':
+    # Hand the task to its worker, when one is running, before the Azure SDK
+    # is imported. See azure_rm_worker.
+    hand_off_to_worker(__file__)
+
 from ansible.module_utils.azure_rm_common import AzureRMModuleBase
-import jsonpickle
-import json
+from ansible.module_utils.azure_rm_client_proxy import CLIENT_PROXY_ARGS, ClientProxyMixin
+from ansible.module_utils.azure_rm_token_cache import TOKEN_CACHE_ARGS, TokenCacheMixin
+from ansible.module_utils.azure_rm_throttle import THROTTLE_ARGS
+from ansible.module_utils.azure_rm_operations import (POLLING_ARGS, OperationPolicy, OperationTimeout,
+                                                      run_concurrently, wait_for_pollers)
+from ansible.module_utils.azure_rm_page_blob import download_page_blob, get_blob_size, get_page_ranges, range_bytes
+from ansible.module_utils.azure_rm_compute_results import select_fields, snapshot_to_dict, vm_to_dict
+from ansible.module_utils.azure_rm_snapshot_common import (SOURCE_DISK_TAG, SOURCE_VM_TAG, SnapshotClientMixin,
+                                                           vm_disks)
+import os
+import time
 
 try:
     from msrestazure.azure_exceptions import CloudError
-    from azure.mgmt.compute.models import Snapshot
 
 except:
     pass
 
-class AzureRMVMSnapshot(AzureRMModuleBase):
+# Read access granted to a snapshot for export_to, long enough for the
+# download of a large disk; it is revoked as soon as the download ends.
+EXPORT_ACCESS_SECONDS = 24 * 3600
+
+
+class AzureRMVMSnapshot(WorkerMixin, SnapshotClientMixin, TokenCacheMixin, ClientProxyMixin, AzureRMModuleBase):
     def __init__(self):
 
         self.module_arg_spec = dict(
@@ -134,8 +353,45 @@ class AzureRMVMSnapshot(AzureRMModuleBase):
                 required=False,
                 default='present',
                 choices=['present', 'absent']
+            ),
+            incremental=dict(
+                type='bool',
+                required=False,
+                default=False
+            ),
+            estimate_changed_bytes=dict(
+                type='bool',
+                required=False,
+                default=True
+            ),
+            max_concurrency=dict(
+                type='int',
+                required=False,
+                default=8
+            ),
+            export_to=dict(
+                type='path',
+                required=False
+            ),
+            export_concurrency=dict(
+                type='int',
+                required=False,
+                default=16
+            ),
+            return_fields=dict(
+                type='list',
+                required=False
+            ),
+            keep=dict(
+                type='int',
+                required=False
             )
         )
+        self.module_arg_spec.update(CLIENT_PROXY_ARGS)
+        self.module_arg_spec.update(TOKEN_CACHE_ARGS)
+        self.module_arg_spec.update(THROTTLE_ARGS)
+        self.module_arg_spec.update(WORKER_ARGS)
+        self.module_arg_spec.update(POLLING_ARGS)
         self.results = dict(
             ansible_facts=dict(
                 azure_snapshot=[]
@@ -147,6 +403,24 @@ class AzureRMVMSnapshot(AzureRMModuleBase):
         self.suffix = None
         self.state = None
         self.location = None
+        self.incremental = None
+        self.estimate_changed_bytes = None
+        self.max_concurrency = None
+        self.export_to = None
+        self.export_concurrency = None
+        self.return_fields = None
+        self.keep = None
+        self.diagnostics = None
+        self.token_cache = None
+        self.token_cache_path = None
+        self.request_rate = None
+        self.request_burst = None
+        self.throttle_retries = None
+        self.throttle_max_delay = None
+        self.poll_interval = None
+        self.poll_backoff = None
+        self.timeout = None
+        self.polling_policy = None
 
         self.results = dict(
             changed=False,
@@ -163,6 +437,8 @@ class AzureRMVMSnapshot(AzureRMModuleBase):
         for key in list(self.module_arg_spec.keys()) + ['tags']:
             setattr(self, key, kwargs[key])
 
+        self.polling_policy = OperationPolicy(self.poll_interval, self.poll_backoff, self.timeout)
+
         try:
             resource_group = self.get_resource_group(self.resource_group)
         except CloudError:
@@ -171,16 +447,20 @@ class AzureRMVMSnapshot(AzureRMModuleBase):
                 .format(self.resource_group))
         if not self.location:
             self.location = resource_group.location
+        if self.keep is not None and self.keep < (1 if self.state == 'present' else 0):
+            self.fail("keep must be at least 1 when state is present, and not negative otherwise")
+        if self.incremental:
+            self.check_snapshot_api('incremental')
         if self.state == 'present':
             self.results['state'] = self.create_snapshot()
+            if self.keep is not None and not self.results['timed_out']:
+                self.results['deleted'] = self.delete_snapshots(self.keep)
         elif self.state == 'absent':
-            self.delete_snapshot()
-        return self.results
+            self.results['deleted'] = self.delete_snapshots(self.keep or 0)
+        return self.add_metrics(self.results)
 
     def create_snapshot(self):
 
-        snapshot = self.compute_client.snapshots
-
         try:
             vms = self.compute_client.virtual_machines
             vm = vms.get(resource_group_name=self.resource_group, vm_name=self.name)
@@ -191,53 +471,254 @@ class AzureRMVMSnapshot(AzureRMModuleBase):
 
         managed = not (vm.storage_profile.os_disk.managed_disk is None)
 
-        data_disks = vm.storage_profile.data_disks
-
-        result = dict(snap=json.loads(jsonpickle.encode(vm)),
-                      managed=managed
-        )
-
+        if not managed:
+            self.fail("VM {} does not use managed disks and cannot be snapshotted".format(self.name))
+
+        disks = vm_disks(vm)
+
+        previous = dict()
+        if self.incremental:
+            previous = self._previous_snapshots(disks)
+
+        taken = self.snapshot_disks(self.name, disks,
+                                    dict((disk['name'], self._snapshot_name(disk['name'])) for disk in disks),
+                                    self.location,
+                                    tags=self.tags,
+                                    incremental=self.incremental,
+                                    max_concurrency=self.max_concurrency)
+
+        snapshots = []
+        failed = False
+        timed_out = False
+        for disk, info in zip(disks, taken):
+            snapshot_info = dict(disk=info['disk'],
+                                 name=info['name'],
+                                 incremental=self.incremental)
+            if self.incremental:
+                snapshot_info['previous'] = previous.get(disk['id'].lower())
+            if info['snapshot'] is not None:
+                snapshot_info.update(snapshot_to_dict(info['snapshot']))
+            snapshot_info['status'] = info['status']
+            if 'error' in info:
+                snapshot_info['error'] = info['error']
+            snapshot_info['duration'] = info['duration']
+            failed = failed or info['status'] == "Failed"
+            timed_out = timed_out or info['status'] == "Timed out"
+            snapshots.append(snapshot_info)
+
+        if failed:
+            self.fail("Not all snapshots of VM {} could be created".format(self.name), snapshots=snapshots)
+
+        self.results['changed'] = True
+        self.results['timed_out'] = timed_out
+
+        if self.incremental and self.estimate_changed_bytes and not timed_out:
+            estimates = run_concurrently(lambda disk: self._changed_bytes(self._snapshot_name(disk['name']),
+                                                                          previous.get(disk['id'].lower())),
+                                         disks, self.max_concurrency)
+            for snapshot_info, (changed_bytes, error) in zip(snapshots, estimates):
+                snapshot_info['changed_bytes'] = changed_bytes
+                if error is not None:
+                    snapshot_info['changed_bytes_error'] = str(error)
+
+        if self.export_to and not timed_out:
+            export_failed = False
+            for snapshot_info, info in zip(snapshots, taken):
+                try:
+                    snapshot_info['export'] = self._export_snapshot(info['snapshot'])
+                except Exception as e:
+                    snapshot_info['export'] = dict(path=self._export_path(info['name']), error=str(e))
+                    export_failed = True
+            if export_failed:
+                self.fail("Not all snapshots of VM {} could be exported to {}".format(self.name, self.export_to),
+                          snapshots=snapshots)
+
+        result = dict(vm=select_fields(vm_to_dict(vm), self.return_fields),
+                      managed=managed,
+                      snapshots=[select_fields(snapshot_info, self.return_fields) for snapshot_info in snapshots]
+                      )
 
-        # disks = [dict(name=snap.storage_profile.os_disk.managed_disk.id.rsplit('/', 1)[-1],
-        #               id=snap.storage_profile.os_disk.managed_disk.id)]
-        #
-        # for disk in data_disks:
-        #     disks.append(dict(name=disk.managed_disk.id.rsplit('/', 1)[-1],
-        #                       id=disk.managed_disk.id))
-        #
-        # results = []
-        #
-        # for disk in disks:
-        #
-        #     creation_data = dict(createOption="Copy",
-        #                          sourceResourceId=disk["id"])
-        #
-        #     results.append(creation_data)
-        #
-        #     snap_source = Snapshot(location=self.location,
-        #                            creation_data=creation_data,
-        #                            sku=dict(name="Standard_LRS"))
-        #     try:
-        #         operation = snapshot.create_or_update(resource_group_name=self.resource_group,
-        #                                               snapshot_name="{}{}{}".format(self.prefix,
-        #                                                                             disk["name"],
-        #                                                                             self.suffix),
-        #                                               snapshot=snap_source)
-        #     except CloudError as e:
-        #         self.fail("Snapshot could not be created: {}".format(str(e)))
-        #     except Exception as e:
-        #         self.fail("An exception occurred: {}".format(str(e)))
-        #
-        #     operation.wait()
-        #
-        #     results.append(operation.result())
-        #
-        # result = json.loads(jsonpickle.encode(results))
-        #
         return result
 
-    def delete_snapshot(self):
-        pass
+    def _snapshot_name(self, disk_name):
+        return "{}{}{}".format(self.prefix or '', disk_name, self.suffix or '')
+
+    @property
+    def snapshot_operations(self):
+        """
+        The snapshot operations of snapshot_client when incremental snapshots
+        are taken, which need its newer API version, and of compute_client
+        otherwise. Listing, deleting and granting access to snapshots, even
+        incremental ones, work with either.
+        """
+        client = self.snapshot_client if self.incremental else self.compute_client
+        return client.snapshots
+
+    def _previous_snapshots(self, disks):
+        """
+        Map the id of every disk to the name of its most recent incremental snapshot.
+        """
+        disk_ids = dict((disk['id'].lower(), disk['name']) for disk in disks)
+        new_names = set(self._snapshot_name(disk['name']) for disk in disks)
+        latest = dict()
+
+        try:
+            for snap in self.snapshot_client.snapshots.list_by_resource_group(self.resource_group):
+                if not snap.incremental or snap.name in new_names:
+                    continue
+                source = self._snapshot_source(snap, disk_ids)
+                if source not in disk_ids:
+                    continue
+                if source not in latest or snap.time_created > latest[source].time_created:
+                    latest[source] = snap
+        except CloudError as e:
+            self.fail("Snapshots could not be listed: {}".format(str(e)))
+
+        return dict((source, snap.name) for source, snap in latest.items())
+
+    def _grant_read(self, snapshot_name, duration=3600):
+        snapshots = self.snapshot_operations
+        access = self.polling_policy.wait(snapshots.grant_access(self.resource_group, snapshot_name, 'Read', duration,
+                                                                 polling=self.polling_policy.polling()),
+                                          "read access to snapshot {}".format(snapshot_name))
+        return access.access_sas
+
+    def _revoke(self, snapshot_name):
+        snapshots = self.snapshot_operations
+        try:
+            self.polling_policy.wait(snapshots.revoke_access(self.resource_group, snapshot_name,
+                                                             polling=self.polling_policy.polling()),
+                                     "access to snapshot {} to be revoked".format(snapshot_name))
+        except OperationTimeout:
+            pass
+
+    def _changed_bytes(self, snapshot_name, previous_name):
+        """
+        Count the bytes that differ between a snapshot and the previous one in its
+        chain, or the allocated bytes when it is the first snapshot of its disk.
+        """
+        granted = []
+        try:
+            sas_urls = []
+            for name in [snapshot_name, previous_name]:
+                if name is None:
+                    sas_urls.append(None)
+                    continue
+                sas_urls.append(self._grant_read(name))
+                granted.append(name)
+            return range_bytes(get_page_ranges(sas_urls[0], sas_urls[1]))
+        finally:
+            for name in granted:
+                self._revoke(name)
+
+    def _export_path(self, snapshot_name):
+        return os.path.join(self.export_to, snapshot_name + '.vhd')
+
+    def _export_snapshot(self, snapshot):
+        """
+        Download a snapshot to a sparse VHD in export_to, resuming an earlier
+        export of the same snapshot, and return the export stats.
+        """
+        path = self._export_path(snapshot.name)
+        if not os.path.isdir(self.export_to):
+            os.makedirs(self.export_to)
+        started = time.time()
+        sas_url = self._grant_read(snapshot.name, EXPORT_ACCESS_SECONDS)
+        try:
+            size = get_blob_size(sas_url)
+            export = download_page_blob(sas_url, path, size, get_page_ranges(sas_url),
+                                        dict(snapshot=snapshot.id.lower(), time_created=str(snapshot.time_created)),
+                                        max_concurrency=self.export_concurrency)
+        finally:
+            self._revoke(snapshot.name)
+        export['path'] = path
+        export['duration'] = round(time.time() - started, 3)
+        return export
+
+    def _snapshot_source(self, snap, disk_ids):
+        """
+        Return the lowercased id of the disk of this VM a snapshot was taken from,
+        or None when it is not a snapshot of this VM. Snapshots taken by this
+        module are recognized by their tags, untagged ones by their source disk
+        and a name made of the prefix and the disk name.
+        """
+        tags = snap.tags or {}
+        source = tags.get(SOURCE_DISK_TAG)
+        if source is not None:
+            if source in disk_ids or tags.get(SOURCE_VM_TAG, '').lower() == self.name.lower():
+                return source
+            return None
+        candidate = (snap.creation_data.source_resource_id or '').lower()
+        if candidate in disk_ids and snap.name.startswith("{}{}".format(self.prefix or '', disk_ids[candidate])):
+            return candidate
+        return None
+
+    def delete_snapshots(self, keep=0):
+        """
+        Delete the snapshots of the VM, except for the ``keep`` most recent ones
+        of every disk. All deletes are started before any of them is waited for.
+        When the VM no longer exists, its snapshots are still found by their tags.
+        """
+        try:
+            vm = self.compute_client.virtual_machines.get(resource_group_name=self.resource_group,
+                                                          vm_name=self.name)
+            disks = vm_disks(vm)
+        except CloudError as e:
+            if e.status_code != 404:
+                self.fail("VM {} could not be retrieved: {}".format(self.name, str(e)))
+            disks = []
+        disk_ids = dict((disk['id'].lower(), disk['name']) for disk in disks)
+
+        snapshots = self.snapshot_operations
+        by_disk = dict()
+        try:
+            for snap in snapshots.list_by_resource_group(self.resource_group):
+                if not snap.name.startswith(self.prefix or ''):
+                    continue
+                source = self._snapshot_source(snap, disk_ids)
+                if source is not None:
+                    by_disk.setdefault(source, []).append(snap)
+        except CloudError as e:
+            self.fail("Snapshots could not be listed: {}".format(str(e)))
+
+        doomed = []
+        for source, snaps in by_disk.items():
+            snaps.sort(key=lambda snap: snap.time_created.isoformat() if snap.time_created else '', reverse=True)
+            doomed.extend(dict(name=snap.name,
+                               disk=source.rsplit('/', 1)[-1],
+                               time_created=snap.time_created.isoformat() if snap.time_created else None)
+                          for snap in snaps[keep:])
+
+        operations = run_concurrently(lambda item: snapshots.delete(resource_group_name=self.resource_group,
+                                                                    snapshot_name=item['name'],
+                                                                    polling=self.polling_policy.polling()),
+                                      doomed, self.max_concurrency)
+        finished = wait_for_pollers(dict((item['name'], operation)
+                                         for item, (operation, error) in zip(doomed, operations)
+                                         if error is None),
+                                    self.polling_policy)
+
+        failed = False
+        for item, (operation, error) in zip(doomed, operations):
+            if error is None and item['name'] not in finished:
+                item['status'] = "Timed out"
+            elif error is None:
+                try:
+                    operation.result()
+                    item['status'] = "Deleted"
+                except Exception as e:
+                    error = e
+            if error is not None:
+                item['status'] = "Failed"
+                item['error'] = str(error)
+                failed = True
+
+        if any(item['status'] != "Failed" for item in doomed):
+            self.results['changed'] = True
+        if failed:
+            self.fail("Not all snapshots of VM {} could be deleted".format(self.name), deleted=doomed)
+
+        return doomed
 
 
 def main():